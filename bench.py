@@ -0,0 +1,422 @@
+#!/usr/bin/python
+#
+# POWERLORD benchmarks
+#
+# Times the core game systems without opening a window (SDL's dummy video driver), on square maps of
+# several sizes with several numbers of monsters around the player. Levels and monster placement are
+# seeded, so two runs of the same code do the same work. The results are written as JSON, to compare
+# runs before and after a change. Run it from the game directory, it needs libtcod and the font. Example:
+#
+#   python bench.py --sizes 100,200 --monsters 0,50,200 --output before.json
+#   python bench.py --scenarios render,ai --repeat 20
+#   python bench.py --startup 5                 #time the game's startup in 5 new processes instead
+
+import os
+import sys
+import json
+import random
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import subprocess
+import collections
+
+import powerlord
+
+libtcod = powerlord.libtcod
+
+AI_TURNS = 1000  #monster turns per run of the ai scenario
+BLOCKED_QUERIES = 10000  #is_blocked() calls per run of the queries scenario
+WALK_QUERIES = 1000  #can_walk_between() calls per run of the queries scenario
+WALK_DISTANCE = 10  #can_walk_between() is asked about tiles at most this far apart
+LIBRARY_CALLS = 10000  #calls of each libtcod function per run of the calls scenario
+
+
+def init_headless():
+	#open the root console on SDL's dummy video driver, with no frame rate limit, and make the consoles the
+	#game draws on
+	os.environ['SDL_VIDEODRIVER'] = 'dummy'
+	powerlord.init_window('POWERLORD benchmark', 0)
+
+
+def finish_pregeneration():
+	#wait for the level generated in the background, so it doesn't run during the timings
+	if powerlord.next_level is not None:
+		powerlord.next_level.thread.join()
+
+
+def start_game(size, monsters, seed):
+	#a new game on a size x size map, with monsters soldiers on the free tiles closest to the player instead
+	#of the generated ones. the player can't die, the monsters attack it. returns the objects other than
+	#the bench monsters, which stay put.
+	powerlord.MAP_WIDTH = powerlord.MAP_HEIGHT = size
+	finish_pregeneration()
+	if powerlord.current_level is not None:
+		libtcod.map_delete(powerlord.current_level.fov_map)  #the previous game's
+	powerlord.new_game(seed)
+	finish_pregeneration()
+	powerlord.player.fighter.hp = 10 ** 9
+	(powerlord.camera_x, powerlord.camera_y) = (0, 0)
+
+	others = [obj for obj in powerlord.objects if not obj.ai]
+	place_monsters(others, monsters, random.Random(seed))
+	powerlord.move_camera(powerlord.player.x, powerlord.player.y)
+	return others
+
+
+def place_monsters(others, count, rng):
+	#replace the objects of the current level with others plus count monsters around the player
+	objects = powerlord.objects
+	objects[:] = others
+	taken = set((obj.x, obj.y) for obj in others if obj.blocks)
+	for (x, y) in tiles_around(powerlord.player.x, powerlord.player.y):
+		if count == 0:
+			break
+		if (x, y) in taken:
+			continue
+		fighter_component = powerlord.Fighter(hp=10, defense=0, xp=10, power=5, constitution=0, facing=rng.randint(1, 8),
+											  death_function=powerlord.monster_death, move_speed=5, attack_speed=20)
+		objects.append(powerlord.Object(x, y, 's', 'Kodian Soldier', libtcod.white, blocks=True,
+										fighter=fighter_component, ai=powerlord.BasicMonster()))
+		count -= 1
+	powerlord.object_index = powerlord.SpatialIndex(objects)
+	powerlord.fov_recompute = True
+
+
+def tiles_around(x, y):
+	#the walkable tiles of the current level in order of walking distance from (x, y)
+	map = powerlord.map
+	(width, height) = (len(map), len(map[0]))
+	seen = set([(x, y)])
+	queue = collections.deque([(x, y)])
+	while queue:
+		(x, y) = queue.popleft()
+		yield (x, y)
+		for dx in (-1, 0, 1):
+			for dy in (-1, 0, 1):
+				(nx, ny) = (x + dx, y + dy)
+				if (nx, ny) not in seen and 0 <= nx < width and 0 <= ny < height and not map[nx][ny].blocked:
+					seen.add((nx, ny))
+					queue.append((nx, ny))
+
+
+#every scenario takes the map size, the number of monsters and the seed, sets up the game and returns
+#(prepare, run, operations). prepare(i), if not None, is called before run number i and isn't timed,
+#operations is how many times run() does the thing measured.
+
+def bench_generate(size, monsters, seed):
+	powerlord.MAP_WIDTH = powerlord.MAP_HEIGHT = size
+
+	def run(i):
+		level = powerlord.generate_level(1, seed + i)
+		libtcod.map_delete(level.fov_map)
+
+	return (None, run, 1)
+
+
+def bench_fov(size, monsters, seed):
+	start_game(size, monsters, seed)
+
+	def run(i):
+		old = powerlord.fov_map
+		powerlord.initialize_fov()
+		libtcod.map_delete(old)
+		powerlord.current_level.fov_map = powerlord.fov_map
+
+	return (None, run, 1)
+
+
+def bench_render(size, monsters, seed):
+	start_game(size, monsters, seed)
+
+	def run(i):
+		powerlord.fov_recompute = True
+		powerlord.render_all()
+
+	return (None, run, 1)
+
+
+def bench_ai(size, monsters, seed):
+	start_game(size, monsters, seed)
+
+	def run(i):
+		movers = [obj for obj in powerlord.objects if obj.ai]
+		for turn in range(AI_TURNS):
+			movers[turn % len(movers)].ai.take_turn()
+
+	return (None, run, AI_TURNS)
+
+
+def bench_queries(size, monsters, seed):
+	start_game(size, monsters, seed)
+	rng = random.Random(seed)
+	spots = [(rng.randrange(size), rng.randrange(size)) for i in range(BLOCKED_QUERIES)]
+	walks = []
+	while len(walks) < WALK_QUERIES:
+		(x, y) = (rng.randrange(size), rng.randrange(size))
+		(dx, dy) = (rng.randint(-WALK_DISTANCE, WALK_DISTANCE), rng.randint(-WALK_DISTANCE, WALK_DISTANCE))
+		if 0 <= x + dx < size and 0 <= y + dy < size:
+			walks.append((x, y, x + dx, y + dy))
+
+	def run(i):
+		is_blocked = powerlord.is_blocked
+		can_walk_between = powerlord.can_walk_between
+		for (x, y) in spots:
+			is_blocked(x, y)
+		for (x1, y1, x2, y2) in walks:
+			can_walk_between(x1, y1, x2, y2)
+
+	return (None, run, BLOCKED_QUERIES + WALK_QUERIES)
+
+
+def bench_calls(size, monsters, seed):
+	#the libtcod functions the game calls thousands of times a frame, on tiles of the screen: the FOV lookup,
+	#a roll, a color darkened and a character drawn with it
+	start_game(size, monsters, seed)
+	rng = random.Random(seed)
+	cells = [(rng.randrange(powerlord.CAMERA_WIDTH), rng.randrange(powerlord.CAMERA_HEIGHT)) for i in range(LIBRARY_CALLS)]
+
+	def run(i):
+		(fov_map, game_rng, con) = (powerlord.fov_map, powerlord.game_rng, powerlord.con)
+		for (x, y) in cells:
+			libtcod.map_is_in_fov(fov_map, x, y)
+			libtcod.random_get_int(game_rng, 1, 8)
+			libtcod.console_put_char_ex(con, x, y, '@', libtcod.white, libtcod.red * 0.5)
+
+	return (None, run, LIBRARY_CALLS * 4)
+
+
+def bench_aoe(size, monsters, seed):
+	#a confusion, a freeze and a fireball on the player's position. the monsters are placed again before
+	#every run, as the spells kill them
+	others = start_game(size, monsters, seed)
+	player = powerlord.player
+
+	def prepare(i):
+		place_monsters(others, monsters, random.Random(seed))
+
+	def run(i):
+		powerlord.resolve_confuse(player.x, player.y)
+		powerlord.resolve_freeze(player.x, player.y)
+		powerlord.resolve_fireball(player.x, player.y)
+
+	return (prepare, run, 3)
+
+
+def bench_saveload(size, monsters, seed):
+	start_game(size, monsters, seed)
+
+	def prepare(i):
+		finish_pregeneration()  #started by the previous load
+
+	def run(i):
+		powerlord.save_game()
+		powerlord.load_game()
+
+	return (prepare, run, 1)
+
+
+SCENARIOS = collections.OrderedDict([
+	('generate', bench_generate),
+	('fov', bench_fov),
+	('render', bench_render),
+	('ai', bench_ai),
+	('queries', bench_queries),
+	('calls', bench_calls),
+	('aoe', bench_aoe),
+	('saveload', bench_saveload),
+])
+
+NO_MONSTERS = set(['generate', 'fov', 'calls'])  #scenarios the number of monsters makes no difference to
+NEEDS_MONSTERS = set(['ai'])  #scenarios skipped without monsters
+
+
+def run_scenario(name, size, monsters, seed, repeat):
+	#time repeat runs of a scenario, in milliseconds
+	(prepare, run, operations) = SCENARIOS[name](size, monsters, seed)
+	clock = timeit.default_timer
+	times = []
+	for i in range(repeat):
+		if prepare is not None:
+			prepare(i)
+		start = clock()
+		run(i)
+		times.append((clock() - start) * 1000)
+
+	times.sort()
+	mean = sum(times) / len(times)
+	return {
+		'scenario': name,
+		'size': size,
+		'monsters': None if name in NO_MONSTERS else monsters,
+		'seed': seed,
+		'runs': repeat,
+		'operations': operations,
+		'min_ms': times[0],
+		'median_ms': times[len(times) / 2],
+		'mean_ms': mean,
+		'max_ms': times[-1],
+		'operations_per_s': operations * 1000 / max(mean, 1e-9),
+	}
+
+
+def run_suite(scenarios, sizes, monster_counts, seed, repeat):
+	#yield the results of every scenario for every size and number of monsters
+	for name in scenarios:
+		for size in sizes:
+			for monsters in monster_counts:
+				if name in NEEDS_MONSTERS and monsters == 0:
+					continue
+				yield run_scenario(name, size, monsters, seed, repeat)
+				if name in NO_MONSTERS:
+					break
+
+
+class QuitAfterFirstTick:
+	#input session that presses nothing during the first tick and Escape after it, which ends the game
+	def start(self, seed, state):
+		pass
+
+	def key(self, tick):
+		if tick > 1:
+			return libtcod.Key(libtcod.KEY_ESCAPE, 0, 1)
+		return libtcod.Key()
+
+	def check_for_keypress(self, tick, flags):
+		return self.key(tick)
+
+	def wait_for_keypress(self, tick, flush=True):
+		return libtcod.Key(libtcod.KEY_ESCAPE, 0, 1)
+
+	def mouse_get_status(self, tick):
+		return libtcod.Mouse()
+
+	def tick(self, tick):
+		pass
+
+	def stop(self, tick):
+		pass
+
+	def close(self):
+		pass
+
+
+def startup_child(seed):
+	#run by measure_startup() in a new process: start a game from the game directory, play its first tick
+	#and print the startup marks it reached as JSON
+	init_headless()
+	home = os.getcwd()
+	directory = tempfile.mkdtemp(prefix='powerlord-startup')
+	os.chdir(directory)  #the game saves when it ends
+	try:
+		powerlord.input_session = QuitAfterFirstTick()
+		powerlord.new_game(seed)
+		powerlord.play_game()
+		finish_pregeneration()
+	finally:
+		os.chdir(home)
+		shutil.rmtree(directory, ignore_errors=True)
+	json.dump(powerlord.startup_times, sys.stdout)
+
+
+def measure_startup(runs, seed):
+	#start the game runs times, each in a new Python process so nothing is loaded or cached yet, and time how
+	#long it takes to get to each startup mark (see powerlord.mark_startup()), in milliseconds
+	marks = collections.defaultdict(list)
+	for i in range(runs):
+		child = subprocess.Popen([sys.executable, '-c', 'import bench; bench.startup_child(%d)' % seed],
+								 stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+		output = child.communicate()[0]
+		if child.returncode != 0:
+			raise RuntimeError('the startup run exited with status %d' % child.returncode)
+		for (name, seconds) in json.loads(output).items():
+			marks[name].append(seconds * 1000)
+
+	results = {}
+	for (name, times) in marks.items():
+		times.sort()
+		budget = powerlord.STARTUP_BUDGET.get(name)
+		results[name] = {
+			'runs': len(times),
+			'min_ms': times[0],
+			'median_ms': times[len(times) / 2],
+			'max_ms': times[-1],
+			'budget_ms': budget and budget * 1000,
+		}
+	return results
+
+
+def parse_list(text):
+	return [int(value) for value in text.split(',')]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the POWERLORD game systems without a window.')
+	parser.add_argument('--scenarios', default=None, metavar='NAME,NAME,...',
+						help='scenarios to run (default: all of ' + ', '.join(SCENARIOS) + ', none with --startup)')
+	parser.add_argument('--sizes', default='100,200', type=parse_list, metavar='N,N,...',
+						help='square map sizes, at least the camera size plus one (default 100,200)')
+	parser.add_argument('--monsters', default='0,20,100', type=parse_list, metavar='N,N,...',
+						help='numbers of monsters around the player (default 0,20,100)')
+	parser.add_argument('--seed', type=int, default=1, help='seed of the levels and monster placement (default 1)')
+	parser.add_argument('--repeat', type=int, default=5, help='timed runs of every scenario (default 5)')
+	parser.add_argument('--startup', type=int, default=0, metavar='N',
+						help='time the startup of N new game processes against STARTUP_BUDGET (default 0)')
+	parser.add_argument('--output', default=None, help='file to write the results to (default: stdout)')
+	args = parser.parse_args(argv)
+
+	if args.scenarios is None:
+		args.scenarios = '' if args.startup else ','.join(SCENARIOS)
+	scenarios = [name for name in args.scenarios.split(',') if name]
+	for name in scenarios:
+		if name not in SCENARIOS:
+			parser.error('unknown scenario: ' + name)
+	smallest = max(powerlord.CAMERA_WIDTH, powerlord.CAMERA_HEIGHT) + 1
+	if min(args.sizes) < smallest:
+		parser.error('maps must be at least %d tiles wide for the camera' % smallest)
+
+	output = args.output and os.path.abspath(args.output)
+	startup = {}
+	if args.startup:
+		startup = measure_startup(args.startup, args.seed)
+		for (name, result) in sorted(startup.items(), key=lambda item: item[1]['median_ms']):
+			over = result['budget_ms'] is not None and result['median_ms'] > result['budget_ms']
+			sys.stderr.write('startup %-11s %9.2f ms median%s\n' % (
+				name, result['median_ms'], ', over the budget of %d ms' % result['budget_ms'] if over else ''))
+	init_headless()
+	#saving and the level store write files, keep them out of the game directory
+	home = os.getcwd()
+	directory = tempfile.mkdtemp(prefix='powerlord-bench')
+	os.chdir(directory)
+	results = []
+	try:
+		for result in run_suite(scenarios, args.sizes, args.monsters, args.seed, args.repeat):
+			sys.stderr.write('%-9s size %4d monsters %4s: %9.2f ms median\n' % (
+				result['scenario'], result['size'], result['monsters'], result['median_ms']))
+			results.append(result)
+		finish_pregeneration()
+	finally:
+		os.chdir(home)
+		shutil.rmtree(directory, ignore_errors=True)
+
+	report = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'seed': args.seed,
+		'repeat': args.repeat,
+		'results': results,
+		'startup': startup,
+	}
+	out = sys.stdout
+	if output:
+		out = open(output, 'w')
+	json.dump(report, out, indent=1, sort_keys=True)
+	out.write('\n')
+	if out is not sys.stdout:
+		out.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# POWERLORD combat log
+#
+# Streams combat events (attacks, criticals and limb losses, backstabs, spell hits, deaths) to disk for
+# analysing fights afterwards. The game only appends events to a queue; a writer thread turns them into
+# one compact JSON array per line and rotates the file when it grows too big. Example:
+#
+#   import combatlog
+#   for event in combatlog.read_events('combat.log'):
+#       if event.crit: print event.tick, event.attacker, event.target, event.damage, event.limb
+
+import os
+import sys
+import json
+import time
+import threading
+import collections
+
+#one record per event. kind is 'attack', 'miss', 'blocked', 'backstab', 'spell' or 'death', limb is the limb
+#lost to a critical hit ('head', 'l_arm', 'r_arm', 'l_leg', 'r_leg'), x and y are where the target stood
+Event = collections.namedtuple('Event', 'tick kind attacker target damage crit limb spell x y depth')
+
+FLUSH_INTERVAL = 0.5  #seconds between writes
+
+
+class CombatLog:
+	#writes events to path from a background thread. when the file passes max_bytes it is renamed to path.1
+	#(path.1 to path.2 and so on) and a new one is started, keeping at most backups old files
+	def __init__(self, path, max_bytes=1024 * 1024, backups=3):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.pending = collections.deque()
+		self.wake = threading.Event()
+		self.closed = False
+		self.file = open(path, 'ab')
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def write(self, event):
+		#queue an event, this is all the game thread does
+		self.pending.append(event)
+
+	def run(self):
+		while not self.closed:
+			self.wake.wait(FLUSH_INTERVAL)
+			self.flush()
+
+	def flush(self):
+		#write out the queued events. deque.popleft() is safe against write() from the game thread
+		lines = []
+		try:
+			while True:
+				lines.append(json.dumps(self.pending.popleft(), separators=(',', ':')))
+		except IndexError:
+			pass
+		if not lines:
+			return
+		try:
+			self.file.write('\n'.join(lines) + '\n')
+			self.file.flush()
+			if self.file.tell() >= self.max_bytes:
+				self.rotate()
+		except (EnvironmentError, ValueError), e:
+			#a full disk or a locked file loses these events, but the writer thread keeps going
+			sys.stderr.write('combat log: %s\n' % e)
+
+	def rotate(self):
+		self.file.close()
+		try:
+			if self.backups > 0:
+				#drop the oldest backup first, os.rename() doesn't replace files on Windows
+				oldest = self.path + '.' + str(self.backups)
+				if os.path.exists(oldest):
+					os.remove(oldest)
+				for i in range(self.backups - 1, 0, -1):
+					if os.path.exists(self.path + '.' + str(i)):
+						os.rename(self.path + '.' + str(i), self.path + '.' + str(i + 1))
+				os.rename(self.path, self.path + '.1')
+			else:
+				os.remove(self.path)
+		finally:
+			#if the renames failed this appends to the old file, and the next flush tries again
+			self.file = open(self.path, 'ab')
+
+	def close(self):
+		#stop the writer thread and write what is left
+		self.closed = True
+		self.wake.set()
+		self.thread.join()
+		self.flush()
+		self.file.close()
+
+
+def log_files(path):
+	#the files of a log, oldest first
+	files = [path + '.' + str(i) for i in range(1, 100) if os.path.exists(path + '.' + str(i))]
+	files.reverse()
+	if os.path.exists(path):
+		files.append(path)
+	return files
+
+
+def read_events(path, follow=False):
+	#yield the events of a log, rotated files included, oldest first. with follow, keep waiting for new
+	#events of the current file like tail -f (stop with Ctrl+C)
+	for name in log_files(path):
+		f = open(name, 'rb')
+		try:
+			while True:
+				line = f.readline()
+				if line.endswith('\n'):
+					yield Event(*json.loads(line))
+				elif follow and name == path:
+					f.seek(-len(line), os.SEEK_CUR)  #a line still being written
+					time.sleep(FLUSH_INTERVAL)
+				else:
+					break
+		finally:
+			f.close()
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+#
+# POWERLORD level generator batch runner
+#
+# Generates many levels in parallel and prints one JSON summary per level, for tuning the
+# dungeon generator settings. Example:
+#
+#   python levelgen.py --seeds 0:10000 --set ROOM_MAX_SIZE=20 --set MAX_ROOMS=30 > levels.jsonl
+#   python levelgen.py --seeds 2000 --compare
+#   python levelgen.py --seeds 20 --generator caves --sizes 100,250,500,1000
+
+import sys
+import time
+import json
+import argparse
+import collections
+import multiprocessing
+
+import powerlord
+
+#generator settings that can be overridden from the command line
+CONFIG_NAMES = ['MAP_WIDTH', 'MAP_HEIGHT', 'ROOM_MAX_SIZE', 'ROOM_MIN_SIZE', 'MAX_ROOMS', 'MAX_ROOM_MONSTERS',
+				'MAX_ROOM_ITEMS', 'MAX_ROOM_FEATURES', 'CAVE_FILL', 'CAVE_SMOOTHING', 'CAVE_MIN_REGION']
+
+REPORT_INTERVAL = 2.0  #seconds between throughput reports
+GENERATOR_NEEDS = {'caves': powerlord.import_numpy}  #generators that need more than the game, and what imports it
+
+
+def apply_config(config):
+	#override the generator settings in this process
+	for name, value in config.items():
+		if name not in CONFIG_NAMES:
+			raise ValueError('Unknown generator setting: ' + name)
+		setattr(powerlord, name, value)
+
+
+def walk_from(level, x, y):
+	#breadth-first walk from (x, y) over tiles that aren't walls or blocking features (monsters move, so
+	#they don't count). returns the number of steps to every tile reached.
+	map = level.map
+	width = len(map)
+	height = len(map[0])
+	features = set((obj.x, obj.y) for obj in level.objects if obj.blocks and not obj.fighter)
+
+	steps = {(x, y): 0}
+	queue = collections.deque([(x, y)])
+	while queue:
+		(x, y) = queue.popleft()
+		step = steps[(x, y)] + 1
+		for dx in (-1, 0, 1):
+			for dy in (-1, 0, 1):
+				nx = x + dx
+				ny = y + dy
+				if (nx, ny) in steps or nx < 0 or ny < 0 or nx >= width or ny >= height:
+					continue
+				if map[nx][ny].blocked or (nx, ny) in features:
+					continue
+				steps[(nx, ny)] = step
+				queue.append((nx, ny))
+	return steps
+
+
+def summarize(level, seed, generator):
+	#compact description of a generated level
+	walkable = level.blocked.count(b'\x00')
+	steps = walk_from(level, level.player_x, level.player_y)
+
+	boss_distance = None
+	for obj in level.objects:
+		if obj.fighter and obj.fighter.death_function == powerlord.victory_death:
+			boss_distance = steps.get((obj.x, obj.y))
+
+	open_features = sum(1 for obj in level.objects if obj.blocks and not obj.fighter)
+	return {
+		'seed': seed,
+		'generator': generator,
+		'depth': level.depth,
+		'rooms': len(level.rooms),
+		'regions': len(level.regions.regions),
+		'walkable': walkable,
+		'reachable': len(steps),
+		'connected': len(steps) + open_features >= walkable,
+		'monsters': sum(1 for obj in level.objects if obj.ai),
+		'items': sum(1 for obj in level.objects if obj.item or obj.equipment),
+		'features': open_features,
+		'boss_distance': boss_distance,
+	}
+
+
+def init_worker(config):
+	apply_config(config)
+
+
+def summarize_seed(job):
+	(seed, depth, generator, timing_only) = job
+	start = time.time()
+	level = powerlord.generate_level(depth, seed, generator)
+	elapsed = time.time() - start
+	if timing_only:
+		summary = {'seed': seed, 'generator': generator}
+	else:
+		summary = summarize(level, seed, generator)
+	summary['time'] = elapsed
+	powerlord.libtcod.map_delete(level.fov_map)
+	return summary
+
+
+def generate_batch(seeds, config=None, depth=1, generator=None, processes=None, chunksize=16, timing_only=False):
+	#generate the level for every seed across a pool of processes, yielding the summaries as they
+	#are finished (not in seed order). config maps generator setting names to values, generator is
+	#a key of powerlord.LEVEL_GENERATORS. with timing_only the summaries only hold the seed and the
+	#generation time, which skips walking the whole level.
+	if config is None:
+		config = {}
+	if generator is None:
+		generator = powerlord.LEVEL_GENERATOR
+	jobs = ((seed, depth, generator, timing_only) for seed in seeds)
+	pool = multiprocessing.Pool(processes, init_worker, (config,))
+	try:
+		for summary in pool.imap_unordered(summarize_seed, jobs, chunksize):
+			yield summary
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def compare(seeds, config, depth, processes):
+	#run the same seeds through every generator and print a table of speed and level shape
+	sys.stderr.write('%-8s %10s %8s %9s %9s %9s %13s\n' %
+					 ('gen', 'levels/s', 'rooms', 'walkable', 'monsters', 'connected', 'boss distance'))
+	for generator in sorted(powerlord.LEVEL_GENERATORS):
+		try:
+			GENERATOR_NEEDS.get(generator, lambda: None)()
+		except ImportError, e:
+			sys.stderr.write('%-8s skipped: %s\n' % (generator, e))
+			continue
+		summaries = []
+		start = time.time()
+		for summary in generate_batch(seeds, config, depth, generator, processes):
+			summaries.append(summary)
+		elapsed = time.time() - start
+
+		count = float(len(summaries))
+		distances = [summary['boss_distance'] for summary in summaries if summary['boss_distance'] is not None]
+		sys.stderr.write('%-8s %10.1f %8.1f %9.0f %9.1f %8.0f%% %13.1f\n' % (
+			generator, count / max(elapsed, 1e-9),
+			sum(summary['rooms'] for summary in summaries) / count,
+			sum(summary['walkable'] for summary in summaries) / count,
+			sum(summary['monsters'] for summary in summaries) / count,
+			100 * sum(1 for summary in summaries if summary['connected']) / count,
+			sum(distances) / max(len(distances), 1.0)))
+
+
+def benchmark_sizes(sizes, seeds, config, depth, generator, processes):
+	#time the generator on square maps of every size
+	sys.stderr.write('%6s %10s %10s %10s %10s\n' % ('size', 'levels/s', 'mean ms', 'median ms', 'max ms'))
+	for size in sizes:
+		sized = dict(config, MAP_WIDTH=size, MAP_HEIGHT=size)
+		times = []
+		start = time.time()
+		for summary in generate_batch(seeds, sized, depth, generator, processes, 1, True):
+			times.append(summary['time'])
+		elapsed = time.time() - start
+
+		times.sort()
+		sys.stderr.write('%6d %10.2f %10.1f %10.1f %10.1f\n' % (size, len(times) / max(elapsed, 1e-9),
+																  1000 * sum(times) / len(times),
+																  1000 * times[len(times) / 2], 1000 * times[-1]))
+
+
+def parse_seeds(text):
+	#"100" is seeds 0-99, "100:200" is seeds 100-199
+	if ':' in text:
+		(first, last) = text.split(':')
+		return xrange(int(first), int(last))
+	return xrange(int(text))
+
+
+def parse_setting(text):
+	(name, value) = text.split('=')
+	return (name.upper(), int(value))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Generate POWERLORD levels in parallel and summarize them.')
+	parser.add_argument('--seeds', default='1000', help='number of seeds, or a first:last range (default 1000)')
+	parser.add_argument('--depth', type=int, default=1, help='dungeon level to generate (default 1)')
+	parser.add_argument('--generator', choices=sorted(powerlord.LEVEL_GENERATORS), default=powerlord.LEVEL_GENERATOR,
+						help='level generator to use (default ' + powerlord.LEVEL_GENERATOR + ')')
+	parser.add_argument('--compare', action='store_true', help='benchmark every generator on the same seeds')
+	parser.add_argument('--sizes', default=None, metavar='N,N,...',
+						help='benchmark generation time on square maps of these sizes')
+	parser.add_argument('--set', action='append', default=[], type=parse_setting, metavar='NAME=VALUE',
+						help='override a generator setting, e.g. MAX_ROOMS=30 (' + ', '.join(CONFIG_NAMES) + ')')
+	parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per core)')
+	parser.add_argument('--output', default=None, help='file to write the summaries to (default: stdout)')
+	parser.add_argument('--quiet', action='store_true', help="don't print the summaries, only the throughput")
+	args = parser.parse_args(argv)
+
+	config = dict(args.set)
+	apply_config(config)  #fail early on unknown names
+	seeds = parse_seeds(args.seeds)
+
+	if args.compare:
+		compare(seeds, config, args.depth, args.processes)
+		return
+	if args.sizes:
+		sizes = [int(size) for size in args.sizes.split(',')]
+		benchmark_sizes(sizes, seeds, config, args.depth, args.generator, args.processes)
+		return
+
+	out = sys.stdout
+	if args.output:
+		out = open(args.output, 'w')
+
+	count = 0
+	disconnected = 0
+	start = time.time()
+	last_report = start
+	for summary in generate_batch(seeds, config, args.depth, args.generator, args.processes):
+		count += 1
+		if not summary['connected'] or summary['boss_distance'] is None:
+			disconnected += 1
+		if not args.quiet:
+			out.write(json.dumps(summary, sort_keys=True) + '\n')
+
+		now = time.time()
+		if now - last_report >= REPORT_INTERVAL:
+			last_report = now
+			sys.stderr.write('%d/%d levels, %.1f levels/s\n' % (count, len(seeds), count / (now - start)))
+
+	elapsed = time.time() - start
+	if out is not sys.stdout:
+		out.close()
+	sys.stderr.write('%d levels in %.2fs: %.1f levels/s, %d disconnected\n' %
+					 (count, elapsed, count / max(elapsed, 1e-9), disconnected))
+
+
+if __name__ == '__main__':
+	main()
@@ -26,19 +26,60 @@
 #
 
 import sys
+import os
+import array
+import json
+import timeit
 import ctypes
 from ctypes import *
 
-try:  #import NumPy if available
-	import numpy
-	numpy_available = True
-except ImportError:
-	numpy_available = False
-
+def _is_ndarray(a):
+	#NumPy is not imported here, it takes a while; if a is an array, whoever made it imported it already
+	numpy = sys.modules.get('numpy')
+	return numpy is not None and isinstance(a, numpy.ndarray)
+
+class _Library(object):
+    # the shared library, loaded the first time one of its functions is used rather than on import, so
+    # the game can be imported by tools that never call it. the result and argument types declared with
+    # _declare() are set on the functions when it is loaded.
+    def __init__(self, path):
+        self._path = path
+        self._types = []  # (function name, attribute, value)
+        self._cdll = None
+
+    def _declare(self, name, attribute, value):
+        if self._cdll is None:
+            self._types.append((name, attribute, value))
+        else:
+            setattr(getattr(self._cdll, name), attribute, value)
+
+    def _load(self):
+        self._cdll = ctypes.CDLL(self._path)
+        for (name, attribute, value) in self._types:
+            setattr(getattr(self._cdll, name), attribute, value)
+        if _lib is self:  # while counting calls, they have to go through the counter
+            _bind_fast_paths(self._cdll)
+        return self._cdll
+
+    def __getattr__(self, name):
+        # the function from the library, kept as an attribute so the next lookups don't come here
+        if name.startswith('__'):
+            raise AttributeError(name)
+        cdll = self._cdll
+        if cdll is None:
+            cdll = self._load()
+        function = getattr(cdll, name)
+        setattr(self, name, function)
+        return function
+
+# the path is taken now, as before, in case the working directory changes before the first call
 if sys.platform.find('linux') != -1:
-    _lib = ctypes.cdll['./libtcod.so']
+    _lib = _Library(os.path.abspath('./libtcod.so'))
 else:
-    _lib = ctypes.cdll['./libtcod-mingw.dll']
+    _lib = _Library(os.path.abspath('./libtcod-mingw.dll'))
+
+def _declare(name, attribute, value):
+    _lib._declare(name, attribute, value)
 
 HEXVERSION = 0x010500
 STRVERSION = "1.5.0"
@@ -52,37 +93,31 @@ class Color(Structure):
                 ('g', c_uint, 8),
                 ('b', c_uint, 8),
                 ]
-
-    def __init__(self, r=0,g=0,b=0):
-        self.r = r
-        self.g = g
-        self.b = b
+    # Color(r, g, b) is set up by Structure's own __init__, written in C, which is faster than one here
 
     def __eq__(self, c):
         return (self.r == c.r) and (self.g == c.g) and (self.b == c.b)
 
+    # the arithmetic is done here, as libtcod's color.c does it, rather than with a call into the library:
+    # the game does it for every tile it draws, and it doesn't need the library loaded
     def __mul__(self, c):
-	iret=0
         if isinstance(c,Color):
-            iret=_lib.TCOD_color_multiply_wrapper(col_to_int(self), col_to_int(c))
-        else:
-            iret=_lib.TCOD_color_multiply_scalar_wrapper(col_to_int(self), c_float(c))
-        return int_to_col(iret)
+            return Color(self.r * c.r / 255, self.g * c.g / 255, self.b * c.b / 255)
+        if 0 <= c <= 1:  # the usual darkening, nothing to clamp
+            return Color(int(self.r * c), int(self.g * c), int(self.b * c))
+        return Color(_clamp(int(self.r * c)), _clamp(int(self.g * c)), _clamp(int(self.b * c)))
 
     def __add__(self, c):
-        iret=_lib.TCOD_color_add_wrapper(col_to_int(self), col_to_int(c))
-        return int_to_col(iret)
+        return Color(min(255, self.r + c.r), min(255, self.g + c.g), min(255, self.b + c.b))
 
     def __sub__(self, c):
-        iret=_lib.TCOD_color_subtract_wrapper(col_to_int(self), col_to_int(c))
-        return int_to_col(iret)
+        return Color(max(0, self.r - c.r), max(0, self.g - c.g), max(0, self.b - c.b))
+
+def _clamp(v):
+    return max(0, min(255, v))
 
 def int_to_col(i) :
-    c=Color()
-    c.r=(i&0xFF0000)>>16
-    c.g=(i&0xFF00)>>8
-    c.b=(i&0xFF)
-    return c
+    return Color((i&0xFF0000)>>16, (i&0xFF00)>>8, i&0xFF)
 
 def col_to_int(c) :
     return (int(c.r) <<16) | (c.g<<8) | c.b;
@@ -176,8 +211,8 @@ gold=Color(255,255,102)
 
 # color functions
 def color_lerp(c1, c2, a):
-    iret = _lib.TCOD_color_lerp_wrapper(col_to_int(c1), col_to_int(c2), c_float(a))
-    return int_to_col(iret)
+    return Color(int(c1.r + (c2.r - c1.r) * a) & 0xFF, int(c1.g + (c2.g - c1.g) * a) & 0xFF,
+                 int(c1.b + (c2.b - c1.b) * a) & 0xFF)
 
 def color_set_hsv(c, h, s, v):
     _lib.TCOD_color_set_HSV(byref(c), c_float(h), c_float(s), c_float(v))
@@ -227,11 +262,10 @@ class Key(Structure):
               ('shift', c_uint, 8),
               ]
 
-_lib.TCOD_console_wait_for_keypress.restype = Key
-_lib.TCOD_console_check_for_keypress.restype = Key
-_lib.TCOD_console_credits_render.restype = c_uint
-_lib.TCOD_console_set_custom_font.argtypes=[c_char_p,c_int]
-
+_declare('TCOD_console_wait_for_keypress', 'restype', Key)
+_declare('TCOD_console_check_for_keypress', 'restype', Key)
+_declare('TCOD_console_credits_render', 'restype', c_uint)
+_declare('TCOD_console_set_custom_font', 'argtypes', [c_char_p,c_int])
 # background rendering modes
 BKGND_NONE = 0
 BKGND_SET = 1
@@ -474,6 +508,30 @@ def console_put_char_ex(con, x, y, c, fore, back):
     else:
         _lib.TCOD_console_put_char_ex(con, x, y, c, fore, back)
 
+def console_put_chars(con, xs, ys, cs, fores, backs):
+    # put many characters with their colors in one call, from parallel sequences of the positions, the
+    # characters (codes or one letter strings) and their foreground and background colors (Colors, or ints
+    # from col_to_int()). libtcod has no call for this, so it puts them one by one from here, with the
+    # function looked up once and every color converted once
+    if not len(xs) == len(ys) == len(cs) == len(fores) == len(backs):
+        raise ValueError('the positions, characters and colors must all be as many')
+    # ctypes doesn't take NumPy's ints
+    (xs, ys, cs, fores, backs) = [a.tolist() if _is_ndarray(a) else a for a in (xs, ys, cs, fores, backs)]
+    put = _lib.TCOD_console_put_char_ex
+    colors = {}
+    for (x, y, c, fore, back) in zip(xs, ys, cs, fores, backs):
+        if type(c) is str:
+            c = ord(c)
+        if type(fore) is not Color:
+            if fore not in colors:
+                colors[fore] = int_to_col(fore)
+            fore = colors[fore]
+        if type(back) is not Color:
+            if back not in colors:
+                colors[back] = int_to_col(back)
+            back = colors[back]
+        put(con, x, y, c, fore, back)
+
 def console_set_back(con, x, y, col, flag=BKGND_SET):
     _lib.TCOD_console_set_back(con, x, y, col, flag)
 
@@ -596,61 +654,127 @@ def console_delete(con):
     _lib.TCOD_console_delete(con)
 
 # fast color filling
-def console_fill_foreground(con,r,g,b) :
-	if (numpy_available and isinstance(r, numpy.ndarray) and
-		isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
-		#numpy arrays, use numpy's ctypes functions
-		r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-		g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-		b = numpy.ascontiguousarray(b, dtype=numpy.int_)
-		cr = r.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-		cg = g.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-		cb = b.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-		
-	elif (isinstance(r, list) and isinstance(g, list) and isinstance(b, list)):
-		#simple python lists, convert using ctypes
-		cr = (c_int * len(r))(*r)
-		cg = (c_int * len(g))(*g)
-		cb = (c_int * len(b))(*b)
-	else:
-		raise TypeError('R, G and B must all be of the same type (list or NumPy array)')
-	
-	if len(r) != len(g) or len(r) != len(b):
-		raise TypeError('R, G and B must all have the same size.')
-	
-	_lib.TCOD_console_fill_foreground(con, cr, cg, cb)
-
-def console_fill_background(con,r,g,b) :
-	if (numpy_available and isinstance(r, numpy.ndarray) and
-		isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
-		#numpy arrays, use numpy's ctypes functions
-		
-		r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-		g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-		b = numpy.ascontiguousarray(b, dtype=numpy.int_)
-		cr = r.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-		cg = g.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-		cb = b.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-		
-	elif (isinstance(r, list) and isinstance(g, list) and isinstance(b, list)):
-		#simple python lists, convert using ctypes
-		cr = (c_int * len(r))(*r)
-		cg = (c_int * len(g))(*g)
-		cb = (c_int * len(b))(*b)
-	else:
-		raise TypeError('R, G and B must all be of the same type (list or NumPy array)')
-	
-	if len(r) != len(g) or len(r) != len(b):
-		raise TypeError('R, G and B must all have the same size.')
-	
-	_lib.TCOD_console_fill_background(con, cr, cg, cb)
+# the colors of the cells, a row after the other (x + y * width), as three planes r, g and b, or with g and b
+# left out as one buffer of interleaved r, g, b bytes. planes of C ints (NumPy int32 arrays, array.array('i'),
+# ctypes c_int arrays, memoryviews of them) are handed to libtcod where they are, without a copy; lists and
+# arrays of other types are converted first. buffers that don't say they hold C ints (bytearray, mmap, str)
+# are refused as planes. libtcod only takes planes, so the interleaved form is always copied into them, see
+# _planes().
+class _Py_buffer(Structure):
+    # Python 2.7's Py_buffer, for the buffers from_buffer() doesn't take: memoryviews and read-only ones
+    _fields_ = [('buf', c_void_p), ('obj', c_void_p), ('len', c_ssize_t), ('itemsize', c_ssize_t),
+                ('readonly', c_int), ('ndim', c_int), ('format', c_char_p), ('shape', c_void_p),
+                ('strides', c_void_p), ('suboffsets', c_void_p), ('smalltable', c_ssize_t * 2),
+                ('internal', c_void_p)]
+
+_PyBUF_FORMAT = 0x0004
+_PyBUF_C_CONTIGUOUS = 0x0038
+_get_buffer = PYFUNCTYPE(c_int, py_object, POINTER(_Py_buffer), c_int)(('PyObject_GetBuffer', pythonapi))
+_release_buffer = PYFUNCTYPE(None, POINTER(_Py_buffer))(('PyBuffer_Release', pythonapi))
+
+def _is_int_format(format, itemsize):
+    if sys.byteorder == 'little':
+        format = format.lstrip('@=<')
+    else:
+        format = format.lstrip('@=>!')
+    return itemsize == sizeof(c_int) and format in ('i', 'I', 'l', 'L')
+
+def _int_pointer(a, n, held):
+    # a pointer to the first n C ints of a plane, into a itself when it is a buffer of them. what has to
+    # live until libtcod is done with it, or be released then (see _release()), is added to held
+    if _is_ndarray(a):
+        numpy = sys.modules['numpy']
+        a = numpy.ascontiguousarray(a, dtype=numpy.intc)  # a itself when it already is
+        if a.size < n:
+            raise ValueError('%d colors for %d cells' % (a.size, n))
+        held.append(a)
+        return a.ctypes.data_as(POINTER(c_int))
+    if isinstance(a, (list, tuple)) or (isinstance(a, array.array) and not _is_int_format(a.typecode, a.itemsize)):
+        if len(a) < n:
+            raise ValueError('%d colors for %d cells' % (len(a), n))
+        return (c_int * n)(*a[:n])
+    if isinstance(a, array.array) or (isinstance(a, Array) and
+                                      _is_int_format(getattr(a._type_, '_type_', ''), sizeof(a._type_))):
+        return (c_int * n).from_buffer(a)  # array.array('i') and c_int arrays, where they are
+    view = _Py_buffer()  # memoryviews and read-only buffers, their format says what they hold
+    _get_buffer(a, byref(view), _PyBUF_FORMAT | _PyBUF_C_CONTIGUOUS)
+    held.append(view)
+    if not _is_int_format(view.format or 'B', view.itemsize):
+        raise TypeError('color planes must hold C ints, not %r' % view.format)
+    if view.len < n * sizeof(c_int):
+        raise ValueError('%d colors for %d cells' % (view.len / sizeof(c_int), n))
+    return cast(view.buf, POINTER(c_int))
+
+def _release(held):
+    for view in held:
+        if isinstance(view, _Py_buffer):
+            _release_buffer(byref(view))
+
+def _planes(r, g, b, n):
+    # r, g and b, or the planes of the first n cells of r as interleaved r, g, b bytes
+    if g is None and b is None:
+        if _is_ndarray(r):
+            numpy = sys.modules['numpy']
+            rgb = numpy.asarray(r).reshape(-1, 3)
+            if len(rgb) < n:
+                raise ValueError('%d colors for %d cells' % (len(rgb), n))
+            return [numpy.ascontiguousarray(plane, dtype=numpy.intc) for plane in rgb[:n].T]
+        # without NumPy the planes are built from slices of the bytes, copying them. bytearrays, arrays and
+        # lists are sliced where they are, anything else (str, memoryview, mmap) is copied to a bytearray first
+        rgb = r
+        if not isinstance(r, (bytearray, array.array, list, tuple)):
+            rgb = bytearray(r)
+        if len(rgb) < 3 * n:
+            raise ValueError('%d colors for %d cells' % (len(rgb) / 3, n))
+        return [(c_int * n)(*rgb[i:3 * n:3]) for i in range(3)]
+    if g is None or b is None:
+        raise TypeError('R, G and B must all be given, or R alone as interleaved RGB')
+    return (r, g, b)
+
+def _fill(function, con, r, g, b):
+    n = console_get_width(con) * console_get_height(con)
+    held = []
+    try:
+        (r, g, b) = _planes(r, g, b, n)
+        function(con, _int_pointer(r, n, held), _int_pointer(g, n, held), _int_pointer(b, n, held))
+    finally:
+        _release(held)
+
+def _fill_rect(set_color, function, con, x, y, w, h, r, g, b):
+    # libtcod can only fill a whole console, a smaller rectangle is set a cell at a time from the planes
+    if (x, y, w, h) == (0, 0, console_get_width(con), console_get_height(con)):
+        _fill(function, con, r, g, b)
+        return
+    n = w * h
+    held = []
+    try:
+        (r, g, b) = [_int_pointer(plane, n, held) for plane in _planes(r, g, b, n)]
+        i = 0
+        for cy in range(y, y + h):
+            for cx in range(x, x + w):
+                set_color(con, cx, cy, Color(r[i] & 0xFF, g[i] & 0xFF, b[i] & 0xFF))
+                i += 1
+    finally:
+        _release(held)
+
+def console_fill_foreground(con, r, g=None, b=None):
+    _fill(_lib.TCOD_console_fill_foreground, con, r, g, b)
+
+def console_fill_background(con, r, g=None, b=None):
+    _fill(_lib.TCOD_console_fill_background, con, r, g, b)
+
+def console_fill_foreground_rect(con, x, y, w, h, r, g=None, b=None):
+    # the colors of the w x h cells from (x, y), a row after the other
+    _fill_rect(console_set_fore, _lib.TCOD_console_fill_foreground, con, x, y, w, h, r, g, b)
+
+def console_fill_background_rect(con, x, y, w, h, r, g=None, b=None):
+    _fill_rect(console_set_back, _lib.TCOD_console_fill_background, con, x, y, w, h, r, g, b)
 
 ############################
 # sys module
 ############################
-_lib.TCOD_sys_get_last_frame_length.restype = c_float
-_lib.TCOD_sys_elapsed_seconds.restype = c_float
-
+_declare('TCOD_sys_get_last_frame_length', 'restype', c_float)
+_declare('TCOD_sys_elapsed_seconds', 'restype', c_float)
 # high precision time functions
 def sys_set_fps(fps):
     _lib.TCOD_sys_set_fps(fps)
@@ -710,9 +834,8 @@ def sys_register_SDL_renderer(func):
 ############################
 # line module
 ############################
-_lib.TCOD_line_step.restype = c_uint
-_lib.TCOD_line.restype=c_uint
-
+_declare('TCOD_line_step', 'restype', c_uint)
+_declare('TCOD_line', 'restype', c_uint)
 def line_init(xo, yo, xd, yd):
     _lib.TCOD_line_init(xo, yo, xd, yd)
 
@@ -736,8 +859,7 @@ def line(xo,yo,xd,yd,py_callback) :
 ############################
 # image module
 ############################
-_lib.TCOD_image_is_pixel_transparent.restype = c_uint
-
+_declare('TCOD_image_is_pixel_transparent', 'restype', c_uint)
 def image_new(width, height):
     return _lib.TCOD_image_new(width, height)
 
@@ -827,8 +949,7 @@ class Mouse(Structure):
               ('wheel_down', c_uint, 8),
               ]
 
-_lib.TCOD_mouse_is_cursor_visible.restype = c_uint
-
+_declare('TCOD_mouse_is_cursor_visible', 'restype', c_uint)
 def mouse_show_cursor(visible):
     _lib.TCOD_mouse_show_cursor(c_int(visible))
 
@@ -846,12 +967,11 @@ def mouse_get_status():
 ############################
 # parser module
 ############################
-_lib.TCOD_struct_get_name.restype = c_char_p
-_lib.TCOD_struct_is_mandatory.restype = c_uint
-_lib.TCOD_parser_get_bool_property.restype = c_uint
-_lib.TCOD_parser_get_float_property.restype = c_float
-_lib.TCOD_parser_get_string_property.restype = c_char_p
-
+_declare('TCOD_struct_get_name', 'restype', c_char_p)
+_declare('TCOD_struct_is_mandatory', 'restype', c_uint)
+_declare('TCOD_parser_get_bool_property', 'restype', c_uint)
+_declare('TCOD_parser_get_float_property', 'restype', c_float)
+_declare('TCOD_parser_get_string_property', 'restype', c_char_p)
 class Dice(Structure):
     _fields_=[('nb_dices', c_int),
               ('nb_faces', c_int),
@@ -1010,8 +1130,8 @@ def parser_get_list_property(parser, name):
 ############################
 # random module
 ############################
-_lib.TCOD_random_get_float.restype = c_float
-_lib.TCOD_random_get_gaussian_float.restype = c_float
+_declare('TCOD_random_get_float', 'restype', c_float)
+_declare('TCOD_random_get_gaussian_float', 'restype', c_float)
 RNG_MT = 0
 RNG_CMWC = 1
 
@@ -1048,16 +1168,15 @@ def random_delete(rnd):
 ############################
 # noise module
 ############################
-_lib.TCOD_noise_perlin.restype = c_float
-_lib.TCOD_noise_simplex.restype = c_float
-_lib.TCOD_noise_wavelet.restype = c_float
-_lib.TCOD_noise_fbm_perlin.restype = c_float
-_lib.TCOD_noise_fbm_simplex.restype = c_float
-_lib.TCOD_noise_fbm_wavelet.restype = c_float
-_lib.TCOD_noise_turbulence_perlin.restype = c_float
-_lib.TCOD_noise_turbulence_simplex.restype = c_float
-_lib.TCOD_noise_turbulence_wavelet.restype = c_float
-
+_declare('TCOD_noise_perlin', 'restype', c_float)
+_declare('TCOD_noise_simplex', 'restype', c_float)
+_declare('TCOD_noise_wavelet', 'restype', c_float)
+_declare('TCOD_noise_fbm_perlin', 'restype', c_float)
+_declare('TCOD_noise_fbm_simplex', 'restype', c_float)
+_declare('TCOD_noise_fbm_wavelet', 'restype', c_float)
+_declare('TCOD_noise_turbulence_perlin', 'restype', c_float)
+_declare('TCOD_noise_turbulence_simplex', 'restype', c_float)
+_declare('TCOD_noise_turbulence_wavelet', 'restype', c_float)
 NOISE_DEFAULT_HURST = 0.5
 NOISE_DEFAULT_LACUNARITY = 2.0
 
@@ -1163,10 +1282,9 @@ def map_delete(m):
 ############################
 # pathfinding module
 ############################
-_lib.TCOD_path_compute.restype = c_uint
-_lib.TCOD_path_is_empty.restype = c_uint
-_lib.TCOD_path_walk.restype = c_uint
-
+_declare('TCOD_path_compute', 'restype', c_uint)
+_declare('TCOD_path_is_empty', 'restype', c_uint)
+_declare('TCOD_path_walk', 'restype', c_uint)
 def path_new_using_map(m, dcost=1.41):
     return _lib.TCOD_path_new_using_map(c_void_p(m), c_float(dcost))
 
@@ -1217,12 +1335,11 @@ def path_walk(p, recompute):
 def path_delete(p):
     _lib.TCOD_path_delete(p)
 
-_lib.TCOD_dijkstra_path_set.restype = c_uint
-_lib.TCOD_dijkstra_is_empty.restype = c_uint
-_lib.TCOD_dijkstra_size.restype = c_int
-_lib.TCOD_dijkstra_path_walk.restype = c_uint
-_lib.TCOD_dijkstra_get_distance.restype = c_float
-
+_declare('TCOD_dijkstra_path_set', 'restype', c_uint)
+_declare('TCOD_dijkstra_is_empty', 'restype', c_uint)
+_declare('TCOD_dijkstra_size', 'restype', c_int)
+_declare('TCOD_dijkstra_path_walk', 'restype', c_uint)
+_declare('TCOD_dijkstra_get_distance', 'restype', c_float)
 def dijkstra_new(m, dcost=1.41):
     return _lib.TCOD_dijkstra_new(c_void_p(m), c_float(dcost))
 
@@ -1283,14 +1400,13 @@ class _CBsp(Structure):
                 ('horizontal', c_uint, 32),
                 ]
 
-_lib.TCOD_bsp_new_with_size.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_left.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_right.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_father.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_is_leaf.restype = c_uint
-_lib.TCOD_bsp_contains.restype = c_uint
-_lib.TCOD_bsp_find_node.restype = POINTER(_CBsp)
-
+_declare('TCOD_bsp_new_with_size', 'restype', POINTER(_CBsp))
+_declare('TCOD_bsp_left', 'restype', POINTER(_CBsp))
+_declare('TCOD_bsp_right', 'restype', POINTER(_CBsp))
+_declare('TCOD_bsp_father', 'restype', POINTER(_CBsp))
+_declare('TCOD_bsp_is_leaf', 'restype', c_uint)
+_declare('TCOD_bsp_contains', 'restype', c_uint)
+_declare('TCOD_bsp_find_node', 'restype', POINTER(_CBsp))
 # python class encapsulating the _CBsp pointer
 class Bsp(object):
     def __init__(self, cnode):
@@ -1413,10 +1529,9 @@ class _CHeightMap(Structure):
               ('values', POINTER(c_float)),
               ]
 
-_lib.TCOD_heightmap_new.restype = POINTER(_CHeightMap)
-_lib.TCOD_heightmap_get_value.restype = c_float
-_lib.TCOD_heightmap_has_land_on_border.restype = c_uint
-
+_declare('TCOD_heightmap_new', 'restype', POINTER(_CHeightMap))
+_declare('TCOD_heightmap_get_value', 'restype', c_float)
+_declare('TCOD_heightmap_has_land_on_border', 'restype', c_uint)
 class HeightMap(object):
     def __init__(self, chm):
         pchm = cast(chm, POINTER(_CHeightMap))
@@ -1562,8 +1677,7 @@ def heightmap_delete(hm):
 # name generator module
 ############################
 
-_lib.TCOD_namegen_get_nb_sets_wrapper.restype = c_int
-
+_declare('TCOD_namegen_get_nb_sets_wrapper', 'restype', c_int)
 def namegen_parse(filename,random=0) :
 	_lib.TCOD_namegen_parse(filename,random)
 
@@ -1587,3 +1701,189 @@ def namegen_destroy() :
 	_lib.TCOD_namegen_destroy()
 
 
+############################
+# fast paths
+############################
+# when the library is loaded, the wrappers of the functions the game calls thousands of times a frame are
+# replaced: by the library function itself where the wrapper only passed its arguments on, otherwise by a
+# wrapper that calls it from a closure instead of looking it up on _lib. their result types are declared.
+# of their arguments only the map or generator is declared, as a pointer, so it isn't passed as a C int on
+# 64-bit builds. ctypes converts the arguments after the declared ones, the ints and Colors, itself: with
+# all of them declared every argument goes through from_param(), which makes a call about three times
+# slower. the handles map_new() and random_new() return are still C ints, as everywhere in this wrapper,
+# and the console ones aren't declared, so a handle above 2 ** 31 on a 64-bit build is still cut short.
+_declare('TCOD_map_is_in_fov', 'restype', c_bool)
+_declare('TCOD_map_is_transparent', 'restype', c_bool)
+_declare('TCOD_map_is_walkable', 'restype', c_bool)
+_declare('TCOD_random_get_int', 'restype', c_int)
+for _name in ('TCOD_map_is_in_fov', 'TCOD_map_is_transparent', 'TCOD_map_is_walkable', 'TCOD_random_get_int'):
+    _declare(_name, 'argtypes', [c_void_p])
+_declare('TCOD_console_put_char', 'restype', None)
+_declare('TCOD_console_put_char_ex', 'restype', None)
+_declare('TCOD_console_set_char', 'restype', None)
+_declare('TCOD_console_set_back', 'restype', None)
+_declare('TCOD_console_set_fore', 'restype', None)
+
+_FAST_PATHS = ['map_is_in_fov', 'map_is_transparent', 'map_is_walkable', 'random_get_int', 'console_put_char',
+               'console_put_char_ex', 'console_set_char', 'console_set_back', 'console_set_fore']
+
+def _bind_fast_paths(cdll):
+    global map_is_in_fov, map_is_transparent, map_is_walkable, random_get_int
+    global console_put_char, console_put_char_ex, console_set_char, console_set_back, console_set_fore
+    map_is_in_fov = cdll.TCOD_map_is_in_fov
+    map_is_transparent = cdll.TCOD_map_is_transparent
+    map_is_walkable = cdll.TCOD_map_is_walkable
+    random_get_int = cdll.TCOD_random_get_int
+
+    put_char = cdll.TCOD_console_put_char
+    put_char_ex = cdll.TCOD_console_put_char_ex
+    set_char = cdll.TCOD_console_set_char
+    set_back = cdll.TCOD_console_set_back
+    console_set_fore = cdll.TCOD_console_set_fore
+
+    def console_put_char(con, x, y, c, flag=BKGND_SET):
+        if type(c) is str:
+            c = ord(c)
+        put_char(con, x, y, c, flag)
+
+    def console_put_char_ex(con, x, y, c, fore, back):
+        if type(c) is str:
+            c = ord(c)
+        put_char_ex(con, x, y, c, fore, back)
+
+    def console_set_char(con, x, y, c):
+        if type(c) is str:
+            c = ord(c)
+        set_char(con, x, y, c)
+
+    def console_set_back(con, x, y, col, flag=BKGND_SET):
+        set_back(con, x, y, col, flag)
+
+def _unbind_fast_paths():
+    # back to the wrappers calling through _lib
+    globals().update(_wrappers)
+
+
+############################
+# foreign call counter
+############################
+# opt-in: call_counter_enable() puts a CallCounter in place of _lib, which counts every call into
+# the library and the time it takes, per function and per calling line of the game. disabled, the
+# wrappers call _lib directly and pay nothing.
+
+class CallCounter(object):
+    def __init__(self, lib, site_file):
+        self._lib = lib
+        self.site_file = site_file
+        self.functions = {}  # name -> [calls, seconds]
+        self.sites = {}  # (name, file, line, caller) -> [calls, seconds]
+        self.frame = {}  # name -> calls since the last frame ended
+        self.last_frame = {}
+        self.peak_frame = {}  # name -> most calls in one frame
+        self.frames = 0
+        self._site_files = {}  # file name -> is it site_file
+
+    def __getattr__(self, name):
+        # wrap a library function the first time it is used
+        function = getattr(self._lib, name)
+        counted = self._wrap(name, function)
+        self.__dict__[name] = counted
+        return counted
+
+    def _wrap(self, name, function):
+        functions = self.functions
+        frame = self.frame
+        timer = timeit.default_timer
+        def counted(*args):
+            start = timer()
+            try:
+                return function(*args)
+            finally:
+                elapsed = timer() - start
+                entry = functions.get(name)
+                if entry is None:
+                    entry = functions[name] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += elapsed
+                frame[name] = frame.get(name, 0) + 1
+                site = self._site(name)
+                entry = self.sites.get(site)
+                if entry is None:
+                    entry = self.sites[site] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += elapsed
+        return counted
+
+    def _site(self, name):
+        # the innermost line of site_file that led to this call
+        f = sys._getframe(2)
+        while f is not None:
+            file = f.f_code.co_filename
+            is_site = self._site_files.get(file)
+            if is_site is None:
+                is_site = self._site_files[file] = os.path.basename(file) == self.site_file
+            if is_site:
+                return (name, self.site_file, f.f_lineno, f.f_code.co_name)
+            f = f.f_back
+        return (name, None, 0, None)
+
+    def end_frame(self):
+        # call once per frame to get per-frame numbers
+        for name, calls in self.frame.items():
+            if calls > self.peak_frame.get(name, 0):
+                self.peak_frame[name] = calls
+        self.last_frame = dict(self.frame)
+        self.frame.clear()
+        self.frames += 1
+
+    def report(self):
+        frames = max(self.frames, 1)
+        functions = {}
+        for name, (calls, seconds) in self.functions.items():
+            functions[name] = {'calls': calls, 'ms': seconds * 1000, 'per_frame': calls / float(frames),
+                               'last_frame': self.last_frame.get(name, 0), 'peak_frame': self.peak_frame.get(name, 0)}
+        sites = []
+        for (name, file, line, caller), (calls, seconds) in self.sites.items():
+            sites.append({'function': name, 'file': file, 'line': line, 'caller': caller, 'calls': calls,
+                          'ms': seconds * 1000, 'per_frame': calls / float(frames)})
+        sites.sort(key=lambda site: -site['calls'])
+        return {'frames': self.frames, 'calls': sum(calls for calls, seconds in self.functions.values()),
+                'functions': functions, 'sites': sites}
+
+    def summary(self, top=15):
+        # the busiest call sites as text
+        report = self.report()
+        lines = ['%d calls in %d frames' % (report['calls'], report['frames']),
+                 '%10s %9s %9s  %s' % ('calls', 'ms', '/frame', 'site')]
+        for site in report['sites'][:top]:
+            lines.append('%10d %9.1f %9.1f  %s:%d %s() %s' % (site['calls'], site['ms'], site['per_frame'],
+                         site['file'], site['line'], site['caller'], site['function']))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        f = open(path, 'w')
+        try:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+def call_counter_enable(site_file='powerlord.py'):
+    # start counting library calls, attributing them to lines of site_file. returns the CallCounter
+    global _lib
+    if not isinstance(_lib, CallCounter):
+        _lib = CallCounter(_lib, site_file)
+        _unbind_fast_paths()
+    return _lib
+
+def call_counter_disable():
+    # stop counting, returns the CallCounter with the numbers so far
+    global _lib
+    counter = _lib
+    if isinstance(counter, CallCounter):
+        _lib = counter._lib
+        if _lib._cdll is not None:
+            _bind_fast_paths(_lib._cdll)
+        return counter
+    return None
+
+_wrappers = dict((name, globals()[name]) for name in _FAST_PATHS)
@@ -4,9 +4,24 @@
 #2014 Russell Mosely
 
 import libtcodpy as libtcod
+import sys
+import time
 import math
 import textwrap
 import shelve
+import os
+import zlib
+import cPickle
+import collections
+import threading
+import heapq
+
+import combatlog
+import profiler
+import replay
+
+import_started = time.time()  #stands in for the process start time where /proc isn't there, see process_age()
+numpy = None  #NumPy is only needed by the cave generator, which imports it (see import_numpy())
 
 #-------Real time
 PLAYER_SPEED = 2
@@ -16,6 +31,12 @@ DEFAULT_ATTACK_SPEED = 20
 #NPCs move at half speed of player
 NPC_SPEED = int(PLAYER_SPEED * 2)
 
+#wait for a key on every turn of the player, and only then let the monsters move. the game doesn't
+#tick, or use the CPU, while the player thinks; actions that take no time (menus, picking up, spells)
+#don't end the turn
+TURN_BASED = False
+KEY_BUFFER_SIZE = 8  #keys kept for later while the player can't act on them
+
 #--------------------
 #Window size / camera
 #--------------------
@@ -38,10 +59,12 @@ PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH
 MSG_HEIGHT = PANEL_HEIGHT - 1
+MSG_WRAP_WIDTH = 70  #messages are split into lines of this many characters
 INVENTORY_WIDTH = 50
 
 CAMERA_WIDTH = 80  #63
 CAMERA_HEIGHT = SCREEN_HEIGHT - PANEL_HEIGHT
+BUCKET_SIZE = 16  #objects are indexed by squares of this many tiles, so drawing only looks at the ones on screen
 
 #Set bottom panel to match color of right panel
 RIGHT_PANEL_COLOR = libtcod.black
@@ -52,11 +75,46 @@ BOTTOM_PANEL_COLOR = RIGHT_PANEL_COLOR
 #--------------------------
 ROOM_MAX_SIZE = 25
 ROOM_MIN_SIZE = 15
-MAX_ROOMS = 15
+MAX_ROOMS = 15  #placement attempts for the 'rooms' generator, exact number of rooms for 'bsp'
+LEVEL_GENERATOR = 'rooms'  #'rooms', 'bsp' or 'caves', see LEVEL_GENERATORS
+
+#Cave generator (needs NumPy)
+CAVE_FILL = 45  #percentage of tiles that start as walls
+CAVE_SMOOTHING = 4  #smoothing passes
+CAVE_MIN_REGION = 30  #caves with fewer tiles than this are filled in
+
+#What to do with a level where features seal off monsters, items or the boss: 'repair' removes features until
+#everything can be reached, 'reject' generates it again from the next seed, None keeps it as it is
+LEVEL_CONNECTIVITY = 'repair'
 MAX_ROOM_MONSTERS = 10
 MAX_ROOM_ITEMS = 5
 MAX_ROOM_FEATURES = 6
 
+#-----------
+#Level store
+#-----------
+LEVEL_CACHE_SIZE = 5  #number of recently visited levels kept in memory
+LEVEL_CACHE_BUDGET = 4 * 1024 * 1024  #bytes of level data kept in memory before the oldest levels go to disk
+LEVEL_CACHE_DIR = 'levels'
+
+#----------
+#Combat log
+#----------
+COMBAT_LOG = None  #file to stream combat events to for analysis (see combatlog.py), e.g. 'combat.log'
+COMBAT_LOG_MAX_BYTES = 1024 * 1024  #size at which the log is rotated
+COMBAT_LOG_BACKUPS = 3  #rotated files kept
+
+#--------
+#Profiler
+#--------
+PROFILE = False  #time the phases of every frame, F3 shows them in the side panel (see profiler.py)
+PROFILE_FILE = 'profile.json'  #where the profile is written when the game quits
+COUNT_LIBTCOD_CALLS = False  #count the calls into libtcod per function and per line of this file
+LIBTCOD_CALLS_FILE = 'libtcod_calls.json'  #where the counts are written when the game quits
+RECORD_INPUT = None  #file to record the seed and input of every new game to, e.g. 'session.rec' (see replay.py)
+REPLAY_CHECKPOINT = 100  #game ticks between the state checksums written to recordings
+STARTUP_BUDGET = {'first_frame': 1.0, 'first_tick': 1.5}  #seconds after the process starts (see bench.py --startup)
+
 #-----------------------
 #Spell ranges and damage
 #-----------------------
@@ -122,6 +180,8 @@ color_light_ground = libtcod.darker_grey
 color_ground_texture = libtcod.desaturated_red
 
 FADE_COLOR_TRANSITION = libtcod.black  #Color for screen transition
+TARGET_RANGE_COLOR = libtcod.Color(0, 0, 60)  #added to the background of the tiles that can be targeted
+TARGET_CURSOR_COLOR = libtcod.light_cyan  #background of the tile under the mouse while targeting
 
 
 class Tile:
@@ -156,6 +216,16 @@ class Rect:
 		return (self.x1 <= other.x2 and self.x2 >= other.x1 and
 				self.y1 <= other.y2 and self.y2 >= other.y1)
 
+	def tiles(self):
+		#the floor tiles of the room, inside its walls
+		return [(x, y) for x in range(self.x1 + 1, self.x2) for y in range(self.y1 + 1, self.y2)]
+
+	def random_spot(self, rng, margin=1):
+		#random tile inside the rectangle, at least margin tiles from its edge
+		x = libtcod.random_get_int(rng, self.x1 + margin, self.x2 - margin)
+		y = libtcod.random_get_int(rng, self.y1 + margin, self.y2 - margin)
+		return (x, y)
+
 
 class Object:
 	#this is a generic object: the player, a monster, an item, the stairs...
@@ -223,6 +293,7 @@ class Object:
 			if not is_blocked(self.x + dx, self.y + dy):
 				self.x += dx
 				self.y += dy
+				object_index.move(self, self.x - dx, self.y - dy)
 				self.fighter.tick = self.fighter.tick + self.fighter.move_speed
 		else:
 			self.fighter.tick = self.fighter.tick + 1
@@ -269,21 +340,29 @@ class Object:
 		global objects
 		objects.remove(self)
 		objects.insert(0, self)
+		object_index.send_to_back(self)
 
 	def draw(self):
-		#only show if it's visible to the player
-		if libtcod.map_is_in_fov(fov_map, self.x, self.y) or (self.always_visible and map[self.x][self.y].explored):
-			(x, y) = to_camera_coordinates(self.x, self.y)
-			if x is not None:
-				#set the color and then draw the character that represents this object at its position
-				if is_in_view(self.x, self.y, player.x, player.y, player.fighter.facing):
-					libtcod.console_set_foreground_color(con, self.color)
-					libtcod.console_put_char(con, x, y, self.char, libtcod.BKGND_NONE)
+		#only show if it's visible to the player. what the player sees of the tiles on screen is in view_mask,
+		#filled in by render_all()
+		(x, y) = to_camera_coordinates(self.x, self.y)
+		if x is None:
+			return
+		view = view_mask[x * CAMERA_HEIGHT + y]
+		if view == 0:
+			if not (self.always_visible and map[self.x][self.y].explored):
+				return
+			in_view = is_in_view(self.x, self.y, player.x, player.y, player.fighter.facing)
+		else:
+			in_view = view == 2
 
-				else:
-					if self.ai:
-						libtcod.console_set_foreground_color(con, libtcod.red)
-						libtcod.console_put_char(con, x, y, '?', libtcod.BKGND_NONE)
+		#draw the character that represents this object at its position, in its color
+		if in_view:
+			map_frame.put(x, y, self.char, self.color)
+
+		else:
+			if self.ai:
+				map_frame.put(x, y, '?', libtcod.red)
 
 
 
@@ -291,14 +370,14 @@ class Object:
 		#erase the character that represents this object
 		(x, y) = to_camera_coordinates(self.x, self.y)
 		if x is not None:
-			libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+			map_frame.put(x, y, ' ', libtcod.white)
 
 
 
 class Fighter:
 	#combat-related properties and methods (monster, player, NPC).
 	def __init__(self, hp, defense, power, constitution, xp, move_speed, death_function=None, protected=0, head=True, l_arm=True,
-				 r_arm=True, l_leg=True, r_leg=True, attack_speed=DEFAULT_ATTACK_SPEED):
+				 r_arm=True, l_leg=True, r_leg=True, attack_speed=DEFAULT_ATTACK_SPEED, facing=None):
 		self.xp = xp
 		self.max_hp = hp
 		self.hp = hp
@@ -308,7 +387,9 @@ class Fighter:
 		self.power = power
 		self.constitution = constitution
 		self.death_function = death_function
-		self.facing = libtcod.random_get_int(0, 1, 8)
+		if facing is None:
+			facing = libtcod.random_get_int(game_rng, 1, 8)
+		self.facing = facing
 		self.tick = 0
 		self.move_speed = move_speed
 		self.attack_speed = attack_speed
@@ -323,14 +404,15 @@ class Fighter:
 	def attack(self, target):
 		#a simple formula for attack damage
 
-		damage = libtcod.random_get_int(0, 1, self.power + self.souls) - target.fighter.defense
-		crit_roll = libtcod.random_get_int(0, 1, 20) #1 in 10 chance to crit
+		damage = libtcod.random_get_int(game_rng, 1, self.power + self.souls) - target.fighter.defense
+		crit_roll = libtcod.random_get_int(game_rng, 1, 20) #1 in 10 chance to crit
 		if self.souls > self.max_souls:
 			self.souls = self.max_souls
 		if damage > 0 and target.fighter.protected == 0:
 			if crit_roll == 1:
 
-				limb_roll = libtcod.random_get_int(0, 0, 4)#roll for limb loss
+				limb_roll = libtcod.random_get_int(game_rng, 0, 4)#roll for limb loss
+				limb = None  #the limb lost, for the combat log
 				#enemy takes double damage
 				damage *= 2 #double damage
 				message('[CRITICAL] ' + self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' damage.',
@@ -342,11 +424,13 @@ class Fighter:
 						message('[CRITICAL] The force from the strike lops off the head of the ' + target.name + '.')
 						#remove head and instant-kill target
 						target.fighter.head = False
+						limb = 'head'
 						target.fighter.hp /= 2 #hp is changed to 1 instead of 0 to prevent god_mode bug
 				elif limb_roll == 1: #left arm
 					if target.fighter.l_arm == True:
 						message('[CRITICAL] The force from the strike crushes the LEFT ARM of the ' + target.name + '.')
 						target.fighter.l_arm = False
+						limb = 'l_arm'
 						if target.name == 'The Powerlord':
 							player.fighter.power /= 2 #half the player's strength
 							message('[CRITICAL] Your strength has been halved due to limb loss!')
@@ -356,6 +440,7 @@ class Fighter:
 					if target.fighter.r_arm == True:
 						message('[CRITICAL] The force from the strike crushes the RIGHT ARM of the ' + target.name + '.')
 						target.fighter.r_arm = False
+						limb = 'r_arm'
 						if target.name == 'The Powerlord':
 							player.fighter.power /= 2 #half the player's strength
 							message('[CRITICAL] Your strength has been halved due to limb loss!')
@@ -365,6 +450,7 @@ class Fighter:
 					if target.fighter.l_leg == True:
 						message('[CRITICAL] The force from the strike crushes the LEFT LEG of the ' + target.name + '.')
 						target.fighter.l_leg = False
+						limb = 'l_leg'
 						if target.name == 'The Powerlord':
 							player.fighter.move_speed = 30 #half the player's move speed
 							message('[CRITICAL] Your movement speed has been halved!')
@@ -374,11 +460,13 @@ class Fighter:
 					if target.fighter.r_leg == True:
 						message('[CRITICAL] The force from the strike crushes the RIGHT LEG of the ' + target.name + '.')
 						target.fighter.r_leg = False
+						limb = 'r_leg'
 						if target.name == 'The Powerlord':
 							player.fighter.move_speed = 30 #half the player's move speed
 							message('[CRITICAL] Your movement speed has been halved!')
 						else:
 							target.fighter.move_speed *=2
+				log_combat('attack', self.owner, target, damage, crit=True, limb=limb)
 
 
 
@@ -387,21 +475,24 @@ class Fighter:
 
 			else:
 				#make the target take some damage
-				message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' damage.',
-					libtcod.desaturated_red)
+				message('%s attacks %s for %d damage.', libtcod.desaturated_red, self.owner.name.capitalize(), target.name,
+						damage)
+				log_combat('attack', self.owner, target, damage)
 
 				target.fighter.take_damage(damage)
 		elif target.fighter.protected > 0:
 			message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but a mysterious force protects him.',
 					libtcod.red)
+			log_combat('blocked', self.owner, target, 0)
 		else:
 			message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect!', libtcod.red)
+			log_combat('miss', self.owner, target, 0)
 		self.tick += self.attack_speed
 		self.owner.wait = self.attack_speed
 
 	def backstab(self, target):
 		if target.fighter.protected == 0:
-			rand = libtcod.random_get_int(0, 1, 5)
+			rand = libtcod.random_get_int(game_rng, 1, 5)
 			if rand == 1:
 				message(
 					self.owner.name.capitalize() + ' snaps the neck of the ' + target.name + ', killing him instantly!',
@@ -420,10 +511,12 @@ class Fighter:
 			elif rand == 5:
 				message(self.owner.name.capitalize() + ' guts the unaware ' + target.name + ' with one savage slash!',
 						libtcod.red)
+			log_combat('backstab', self.owner, target, target.fighter.hp)
 			target.fighter.take_damage(target.fighter.hp)
 		elif target.fighter.protected > 0:
 			message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but mysterious magic protects him.',
 					libtcod.red)
+			log_combat('blocked', self.owner, target, 0)
 
 		self.tick = self.tick + self.attack_speed
 
@@ -434,6 +527,7 @@ class Fighter:
 
 			#check for death. if there's a death function, call it
 			if self.hp <= 0:
+				log_combat('death', None, self.owner)
 				function = self.death_function
 				if function is not None:
 					function(self.owner)
@@ -451,6 +545,8 @@ class BasicMonster:
 	memory_x = None
 	memory_y = None
 	broken_los = True
+	route = None  #waypoints to the remembered location
+	route_target = None  #the location the route was found for
 
 	#AI for a basic monster.
 	def take_turn(self):
@@ -465,27 +561,27 @@ class BasicMonster:
 			broken_los = False
 			#move towards player if far away
 			if monster.distance_to(player) >= 2:
-				talk = libtcod.random_get_int(0, 1, 600)
+				talk = libtcod.random_get_int(game_rng, 1, 600)
 				if talk == 1:
-					message(self.owner.name + ': ' + 'The Powerlord!')
+					message('%s: The Powerlord!', libtcod.white, self.owner.name)
 				elif talk == 2:
-					message('The ' + self.owner.name + ' draws his blade.')
+					message('The %s draws his blade.', libtcod.white, self.owner.name)
 				elif talk == 3:
-					message(self.owner.name + ': ' + 'No mercy!')
+					message('%s: No mercy!', libtcod.white, self.owner.name)
 				elif talk == 4:
-					message(self.owner.name + ': ' + 'Stand and fight!')
+					message('%s: Stand and fight!', libtcod.white, self.owner.name)
 				elif talk == 5:
-					message(self.owner.name + ': ' + 'You do not stand a chance against me heathen.')
+					message('%s: You do not stand a chance against me heathen.', libtcod.white, self.owner.name)
 				elif talk == 6:
-					message(self.owner.name + ': ' + 'Halt, criminal scum!')
+					message('%s: Halt, criminal scum!', libtcod.white, self.owner.name)
 				elif talk == 7:
-					message(self.owner.name + ': ' + 'We have you now!')
+					message('%s: We have you now!', libtcod.white, self.owner.name)
 				elif talk == 8:
-					message(self.owner.name + ': ' + 'Its no use!')
+					message('%s: Its no use!', libtcod.white, self.owner.name)
 				elif talk == 9:
-					message(self.owner.name + ': ' + 'Throw down your weapons and I may let you live.')
+					message('%s: Throw down your weapons and I may let you live.', libtcod.white, self.owner.name)
 				elif talk == 10:
-					message(self.owner.name + ': ' + 'Run while you still can, coward!')
+					message('%s: Run while you still can, coward!', libtcod.white, self.owner.name)
 				monster.move_towards(player.x, player.y)
 
 			#close enough, attack! (if the player is still alive.)
@@ -495,9 +591,10 @@ class BasicMonster:
 		elif self.memory_x != None and self.memory_y != None and monster.distance(self.memory_x, self.memory_y) > 0:
 			#if can't see player but has a memory of player
 			self.broken_los = True
-			monster.move_towards(self.memory_x, self.memory_y)
+			(x, y) = self.waypoint(monster)
+			monster.move_towards(x, y)
 
-		if (monster.x == self.memory_x and monster.y == self.memory_y) or libtcod.random_get_int(0, 0,
+		if (monster.x == self.memory_x and monster.y == self.memory_y) or libtcod.random_get_int(game_rng, 0,
 																								 100) > AI_INTEREST:
 			self.broken_los = True
 			self.memory_x = None
@@ -505,13 +602,26 @@ class BasicMonster:
 
 		if self.memory_x == None or self.memory_y == None:  #fake a memory so the monster wanders to location in line of sight
 			while True:
-				x = libtcod.random_get_int(0, monster.x - 10, monster.x + 10)
-				y = libtcod.random_get_int(0, monster.y - 10, monster.y + 10)
-				if can_walk_between(monster.x, monster.y, x, y): break
+				x = libtcod.random_get_int(game_rng, monster.x - 10, monster.x + 10)
+				y = libtcod.random_get_int(game_rng, monster.y - 10, monster.y + 10)
+				if same_region((monster.x, monster.y), (x, y)) and can_walk_between(monster.x, monster.y, x, y): break
 			self.broken_los = True
 			self.memory_x = x
 			self.memory_y = y
-
+			self.route_target = (x, y)
+			self.route = []  #in a straight line, no need for a route
+
+	def waypoint(self, monster):
+		#the tile to walk towards on the way to the remembered location. the route is found when the memory
+		#changes (a noise, losing sight of the player) and followed one waypoint at a time.
+		if self.route_target != (self.memory_x, self.memory_y):
+			self.route_target = (self.memory_x, self.memory_y)
+			self.route = find_route(monster.x, monster.y, self.memory_x, self.memory_y)
+		while self.route and self.route[0] == (monster.x, monster.y):
+			del self.route[0]
+		if self.route:
+			return self.route[0]
+		return (self.memory_x, self.memory_y)
 # class BasicComp:
 #
 # 	#AI for a basic companion (combat NPC).
@@ -554,15 +664,15 @@ class ConfusedMonster:
 	def take_turn(self):
 		if self.num_turns > 0:  #still confused...
 			#move in a random direction, and decrease the number of turns confused
-			self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+			self.owner.move(libtcod.random_get_int(game_rng, -1, 1), libtcod.random_get_int(game_rng, -1, 1))
 			self.num_turns -= 1
-			talk = libtcod.random_get_int(0, 1, 10)
+			talk = libtcod.random_get_int(game_rng, 1, 10)
 			if talk == 1:
-				message('The ' + self.owner.name + ' fails to shield his eyes.')
+				message('The %s fails to shield his eyes.', libtcod.white, self.owner.name)
 			elif talk == 2:
-				message('The ' + self.owner.name + ' is blinded by the light.')
+				message('The %s is blinded by the light.', libtcod.white, self.owner.name)
 			elif talk == 3:
-				message('The ' + self.owner.name + ' attemps to crawl away.')
+				message('The %s attemps to crawl away.', libtcod.white, self.owner.name)
 
 		else:  #restore the previous AI (this one will be deleted because it's not referenced anymore)
 			self.owner.ai = self.old_ai
@@ -605,6 +715,7 @@ class Item:
 		else:
 			inventory.append(self.owner)
 			objects.remove(self.owner)
+			object_index.remove(self.owner)
 			message('You picked up a ' + self.owner.name + '!', libtcod.green)
 
 	def drop(self):
@@ -613,6 +724,7 @@ class Item:
 		inventory.remove(self.owner)
 		self.owner.x = player.x
 		self.owner.y = player.y
+		object_index.add(self.owner)
 		message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 
 	def use(self):
@@ -625,7 +737,10 @@ class Item:
 		if self.use_function is None:
 			message('The ' + self.owner.name + ' cannot be used.')
 		else:
-			if self.use_function() != 'cancelled':
+			result = self.use_function()
+			if result == 'targeting':
+				targeting.item = self.owner  #destroyed once a target is chosen
+			elif result != 'cancelled':
 				inventory.remove(self.owner)  #destroy after use, unless it was cancelled for some reason
 
 
@@ -651,117 +766,343 @@ def is_blocked(x, y):
 	return False
 
 
-def create_room(room):
-	global map
-	#go through the tiles in the rectangle and make them passable
+def create_room(level, room):
+	#go through the columns of the rectangle and make the tiles inside passable, one slice per column
+	h = level.height
 	for x in range(room.x1 + 1, room.x2):
-		for y in range(room.y1 + 1, room.y2):
-			map[x][y].blocked = False
-			map[x][y].block_sight = False
+		level.blocked[x * h + room.y1 + 1:x * h + room.y2] = bytearray(room.y2 - room.y1 - 1)
 
 
-def create_h_tunnel(x1, x2, y):
-	global map
-	#horizontal tunnel. min() and max() are used in case x1>x2
-	for x in range(min(x1, x2), max(x1, x2) + 1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False
+def create_h_tunnel(level, x1, x2, y):
+	#horizontal tunnel. min() and max() are used in case x1>x2. the tiles of a row are level.height apart
+	h = level.height
+	level.blocked[min(x1, x2) * h + y:max(x1, x2) * h + y + 1:h] = bytearray(abs(x2 - x1) + 1)
 
 
-def create_v_tunnel(y1, y2, x):
-	global map
+def create_v_tunnel(level, y1, y2, x):
 	#vertical tunnel
-	for y in range(min(y1, y2), max(y1, y2) + 1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False
+	h = level.height
+	level.blocked[x * h + min(y1, y2):x * h + max(y1, y2) + 1] = bytearray(abs(y2 - y1) + 1)
+
+
+def connect_rooms(level, room1, room2):
+	#connect the centers of two rooms with an L-shaped tunnel
+	(prev_x, prev_y) = room1.center()
+	(new_x, new_y) = room2.center()
+
+	#draw a coin (random number that is either 0 or 1)
+	if libtcod.random_get_int(level.rng, 0, 1) == 1:
+		#first move horizontally, then vertically
+		create_h_tunnel(level, prev_x, new_x, prev_y)
+		create_v_tunnel(level, prev_y, new_y, new_x)
+	else:
+		#first move vertically, then horizontally
+		create_v_tunnel(level, prev_y, new_y, prev_x)
+		create_h_tunnel(level, prev_x, new_x, new_y)
+
+
+class RoomPlacer:
+	#remembers which tiles are taken by rooms (their walls included) in a byte plane laid out like
+	#Level.blocked, so testing a new room costs one slice search per column instead of a Rect.intersect()
+	#against every room placed so far
+	def __init__(self, width, height):
+		self.height = height
+		self.taken = bytearray(width * height)
+
+	def fits(self, room):
+		#same answer as checking room.intersect() against every added room
+		h = self.height
+		for x in range(room.x1, room.x2 + 1):
+			if self.taken.find(b'\x01', x * h + room.y1, x * h + room.y2 + 1) != -1:
+				return False
+		return True
 
+	def add(self, room):
+		h = self.height
+		for x in range(room.x1, room.x2 + 1):
+			self.taken[x * h + room.y1:x * h + room.y2 + 1] = b'\x01' * (room.y2 - room.y1 + 1)
 
-def make_map():
-	global map, objects
 
-	#the list of objects with just the player
-	objects = [player]
+def level_seed(depth):
+	#seed for the level at the given depth, so each game always builds the same dungeon
+	return (game_seed * 1000003 + depth) & 0xFFFFFFFF
 
-	#fill map with "blocked" tiles
-	map = [[Tile(True)
-			for y in range(MAP_HEIGHT)]
-		   for x in range(MAP_WIDTH)]
 
-	rooms = []
-	num_rooms = 0
+def generate_level(depth, seed, generator=None):
+	#build a complete level, FOV map included, without touching the current one.
+	#everything random comes from an RNG made from the seed, so it is safe to call from another thread
+	#and the same seed always gives the same level. generator is a key of LEVEL_GENERATORS.
+	if generator is None:
+		generator = LEVEL_GENERATOR
+
+	while True:
+		level = Level(MAP_WIDTH, MAP_HEIGHT)
+		level.depth = depth
+		level.rng = libtcod.random_new_from_seed(seed)
+
+		LEVEL_GENERATORS[generator](level)
+		place_boss(level, level.rooms[-1])  #places the boss in the last room we created
+
+		libtcod.random_delete(level.rng)
+		level.rng = 0
+		level.regions = RegionMap(level.width, level.height, level.blocked, level.objects)
+
+		if LEVEL_CONNECTIVITY is None or not unreachable_objects(level):
+			break
+		if LEVEL_CONNECTIVITY == 'repair':
+			repair_level(level)
+			break
+		#rejected, try the next seed of a fixed sequence so the result stays deterministic
+		seed = (seed * 1103515245 + 12345) & 0xFFFFFFFF
+
+	level.nav = NavGraph(level)
+	level.build_tiles()
+	level.fov_map = new_fov_map(level.map)
+	return level
+
+
+def make_rooms(level):
+	#the classic generator: try MAX_ROOMS random rooms, keep the ones that don't overlap and connect
+	#each to the previous one
+	rooms = level.rooms
+	placer = RoomPlacer(level.width, level.height)
 
 	for r in range(MAX_ROOMS):
 		#random width and height
-		w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-		h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		w = libtcod.random_get_int(level.rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		h = libtcod.random_get_int(level.rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
 		#random position without going out of the boundaries of the map
-		x = libtcod.random_get_int(0, 1, MAP_WIDTH - w - 2)
-		y = libtcod.random_get_int(0, 1, MAP_HEIGHT - h - 2)
+		x = libtcod.random_get_int(level.rng, 1, level.width - w - 2)
+		y = libtcod.random_get_int(level.rng, 1, level.height - h - 2)
 
 		#"Rect" class makes rectangles easier to work with
 		new_room = Rect(x, y, w, h)
 
-		#run through the other rooms and see if they intersect with this one
-		failed = False
-		for other_room in rooms:
-			if new_room.intersect(other_room):
-				failed = True
-				break
-
-		if not failed:
+		if placer.fits(new_room):
 			#this means there are no intersections, so this room is valid
+			placer.add(new_room)
 
 			#"paint" it to the map's tiles
-			create_room(new_room)
-
-			#add some contents to this room, such as monsters, if this isn't the player's starting room
-			if num_rooms != 0:
-				place_objects(new_room)
+			create_room(level, new_room)
 
-			#center coordinates of new room, will be useful later
-			(new_x, new_y) = new_room.center()
-
-			if num_rooms == 0:
+			if not rooms:
 				#this is the first room, where the player starts at
-				player.x = new_x
-				player.y = new_y
-
-
-
+				(level.player_x, level.player_y) = new_room.center()
 			else:
-				#all rooms after the first:
-				#connect it to the previous room with a tunnel
+				#add some contents to this room, such as monsters, if this isn't the player's starting room
+				place_objects(level, new_room)
 
-				#center coordinates of previous room
-				(prev_x, prev_y) = rooms[num_rooms - 1].center()
-
-				#draw a coin (random number that is either 0 or 1)
-				if libtcod.random_get_int(0, 0, 1) == 1:
-					#first move horizontally, then vertically
-					create_h_tunnel(prev_x, new_x, prev_y)
-					create_v_tunnel(prev_y, new_y, new_x)
-				else:
-					#first move vertically, then horizontally
-					create_v_tunnel(prev_y, new_y, prev_x)
-					create_h_tunnel(prev_x, new_x, new_y)
+				#all rooms after the first: connect it to the previous room with a tunnel
+				connect_rooms(level, rooms[-1], new_room)
 
 			#finally, append the new room to the list
 			rooms.append(new_room)
-			num_rooms += 1
-	place_boss(rooms[num_rooms - 1])  #places the boss in the last room we created
 
 
-def place_boss(room):
+def make_bsp_rooms(level):
+	#split the map with libtcod's BSP tree until there are exactly MAX_ROOMS leaves, biggest leaf first,
+	#then put one room in every leaf. rooms are connected in the order of the leaves, so neighbours in
+	#the tree are joined by short tunnels.
+	min_leaf = ROOM_MIN_SIZE + 1
+	root = libtcod.bsp_new_with_size(1, 1, level.width - 2, level.height - 2)
+	leaves = [root]
+
+	while len(leaves) < MAX_ROOMS:
+		#split the biggest leaf that is still big enough
+		candidates = [node for node in leaves if node.w >= 2 * min_leaf or node.h >= 2 * min_leaf]
+		if not candidates:
+			libtcod.bsp_delete(root)
+			raise ValueError('The map is too small for ' + str(MAX_ROOMS) + ' rooms of at least ' +
+							 str(ROOM_MIN_SIZE) + ' tiles.')
+		node = max(candidates, key=lambda node: node.w * node.h)
+
+		horizontal = node.h > node.w
+		if node.w < 2 * min_leaf:
+			horizontal = True
+		elif node.h < 2 * min_leaf:
+			horizontal = False
+		if horizontal:
+			position = libtcod.random_get_int(level.rng, node.y + min_leaf, node.y + node.h - min_leaf)
+		else:
+			position = libtcod.random_get_int(level.rng, node.x + min_leaf, node.x + node.w - min_leaf)
+		libtcod.bsp_split_once(node, horizontal, position)
+
+		i = leaves.index(node)
+		leaves[i:i + 1] = [libtcod.bsp_left(node), libtcod.bsp_right(node)]
+
+	for node in leaves:
+		#a random room that fits in the leaf, leaving a gap to the next leaf
+		w = libtcod.random_get_int(level.rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, node.w - 1))
+		h = libtcod.random_get_int(level.rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, node.h - 1))
+		x = libtcod.random_get_int(level.rng, node.x, node.x + node.w - w - 1)
+		y = libtcod.random_get_int(level.rng, node.y, node.y + node.h - h - 1)
+		new_room = Rect(x, y, w, h)
+		create_room(level, new_room)
+		if level.rooms:
+			connect_rooms(level, level.rooms[-1], new_room)
+		level.rooms.append(new_room)
+	libtcod.bsp_delete(root)
+
+	#the player starts in the first room, the others get their contents
+	(level.player_x, level.player_y) = level.rooms[0].center()
+	for room in level.rooms[1:]:
+		place_objects(level, room)
+
+
+class CaveArea:
+	#a part of a cave, used in place of a Rect when placing objects
+	def __init__(self, xs, ys):
+		self.xs = xs
+		self.ys = ys
+		#bounding box, like a Rect
+		(self.x1, self.x2) = (min(xs), max(xs))
+		(self.y1, self.y2) = (min(ys), max(ys))
+
+	def __len__(self):
+		return len(self.xs)
+
+	def center(self):
+		#the tile of the area closest to its middle
+		cx = float(sum(self.xs)) / len(self.xs)
+		cy = float(sum(self.ys)) / len(self.ys)
+		i = min(range(len(self.xs)), key=lambda i: (self.xs[i] - cx) ** 2 + (self.ys[i] - cy) ** 2)
+		return (self.xs[i], self.ys[i])
+
+	def tiles(self):
+		return zip(self.xs, self.ys)
+
+	def random_spot(self, rng, margin=1):
+		#random tile of the area. caves have no walls of their own to keep away from, so margin is ignored
+		i = libtcod.random_get_int(rng, 0, len(self.xs) - 1)
+		return (self.xs[i], self.ys[i])
+
+
+def count_wall_neighbours(walls):
+	#number of walls among the 8 neighbours of every tile, counting the outside of the map as walls
+	(w, h) = walls.shape
+	padded = numpy.ones((w + 2, h + 2), dtype=numpy.uint8)
+	padded[1:-1, 1:-1] = walls
+	count = numpy.zeros((w, h), dtype=numpy.uint8)
+	for dx in (0, 1, 2):
+		for dy in (0, 1, 2):
+			if dx != 1 or dy != 1:
+				count += padded[dx:dx + w, dy:dy + h]
+	return count
+
+
+def label_regions(open):
+	#label the 8-connected regions of open tiles. every region is labelled with the flat index (x * height + y)
+	#of its first tile; walls get the label open.size. each pass takes the smallest label around every tile,
+	#then follows labels to the tile they point at, which roughly halves the passes needed on long caves.
+	(w, h) = open.shape
+	none = open.size
+	labels = numpy.where(open, numpy.arange(open.size).reshape(w, h), none)
+	padded = numpy.empty((w + 2, h + 2), dtype=labels.dtype)
+	while True:
+		padded.fill(none)
+		padded[1:-1, 1:-1] = labels
+		smallest = labels.copy()
+		for dx in (0, 1, 2):
+			for dy in (0, 1, 2):
+				numpy.minimum(smallest, padded[dx:dx + w, dy:dy + h], smallest)
+		smallest[~open] = none
+
+		flat = smallest.ravel()
+		inside = flat < none
+		flat[inside] = flat[flat[inside]]
+
+		if numpy.array_equal(smallest, labels):
+			return labels
+		labels = smallest
+
+
+def import_numpy():
+	#import NumPy the first time caves are made rather than with the game, it takes a while to load
+	global numpy
+	if numpy is None:
+		try:
+			import numpy
+		except ImportError:
+			raise ImportError('The cave generator needs NumPy.')
+
+
+def make_caves(level):
+	#cellular automata caves: random fill, CAVE_SMOOTHING passes of the 4-5 rule, then caves smaller than
+	#CAVE_MIN_REGION are filled in and the others are joined to the biggest with tunnels. everything works on
+	#whole NumPy planes, so it stays fast on very large maps. for placing objects the caves are cut into
+	#areas about the size of a room.
+	import_numpy()
+	(w, h) = (level.width, level.height)
+	random = numpy.random.RandomState(libtcod.random_get_int(level.rng, 0, 0x7FFFFFFF))
+
+	walls = random.randint(0, 100, (w, h)) < CAVE_FILL
+	walls[0, :] = walls[-1, :] = walls[:, 0] = walls[:, -1] = True
+	for i in range(CAVE_SMOOTHING):
+		#a tile becomes a wall if most of its neighbours are, and stays one if half of them are
+		neighbours = count_wall_neighbours(walls)
+		walls = (neighbours >= 5) | (walls & (neighbours >= 4))
+		walls[0, :] = walls[-1, :] = walls[:, 0] = walls[:, -1] = True
+
+	#fill in the small pockets
+	labels = label_regions(~walls)
+	sizes = numpy.bincount(labels[~walls], minlength=walls.size)
+	caves = ~walls & (sizes[numpy.where(walls, 0, labels)] >= CAVE_MIN_REGION)
+	roots = numpy.flatnonzero(sizes >= CAVE_MIN_REGION)
+	if len(roots) == 0:
+		raise ValueError('No cave of at least ' + str(CAVE_MIN_REGION) + ' tiles in a ' + str(w) + 'x' +
+						 str(h) + ' map.')
+
+	#join every cave to the biggest one, from the first tile of one to the first tile of the other
+	main = roots[numpy.argmax(sizes[roots])]
+	(main_x, main_y) = divmod(int(main), h)
+	open = caves.copy()
+	for root in roots:
+		(x, y) = divmod(int(root), h)
+		open[min(x, main_x):max(x, main_x) + 1, y] = True
+		open[main_x, min(y, main_y):max(y, main_y) + 1] = True
+
+	#cut the caves into areas on a grid of ROOM_MAX_SIZE, the biggest ones become the rooms
+	(xs, ys) = numpy.nonzero(caves)
+	keys = labels[xs, ys].astype(numpy.int64) * (w * h) + (xs // ROOM_MAX_SIZE) * h + ys // ROOM_MAX_SIZE
+	order = numpy.argsort(keys, kind='mergesort')
+	(xs, ys, keys) = (xs[order], ys[order], keys[order])
+	starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+	areas = []
+	for (start, end) in zip(starts, numpy.r_[starts[1:], len(keys)]):
+		if end - start >= ROOM_MIN_SIZE:
+			areas.append(CaveArea(xs[start:end].tolist(), ys[start:end].tolist()))
+	if len(areas) < 2:
+		raise ValueError('The caves of a ' + str(w) + 'x' + str(h) + ' map are too small to play.')
+
+	#the player starts in the biggest area and the boss waits in the one furthest from it
+	start = max(areas, key=len)
+	(level.player_x, level.player_y) = start.center()
+	areas.remove(start)
+	areas.sort(key=lambda area: (area.x1 - level.player_x) ** 2 + (area.y1 - level.player_y) ** 2)
+	level.rooms = [start] + areas
+
+	level.blocked = bytearray((~open).astype(numpy.uint8).tobytes())
+	for area in areas:
+		place_objects(level, area)
+
+
+LEVEL_GENERATORS = {
+	'rooms': make_rooms,
+	'bsp': make_bsp_rooms,
+	'caves': make_caves,
+}
+
+
+def place_boss(level, room):
 	blocked = True
 	while blocked:
-		x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-		y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
-		blocked = is_blocked(x, y)
-	fighter_component = Fighter(hp=25, defense=5, power=5, constitution=0, xp=55, death_function=victory_death, move_speed=8,
+		(x, y) = room.random_spot(level.rng)
+		blocked = level.is_blocked(x, y)
+	fighter_component = Fighter(hp=25, defense=5, power=5, constitution=0, xp=55, facing=libtcod.random_get_int(level.rng, 1, 8), death_function=victory_death, move_speed=8,
 								attack_speed=20, protected=0)
 	ai_component = BasicMonster()
 	monster = Object(x, y, 'C', 'Kodian Leader', libtcod.red, blocks=True, fighter=fighter_component, ai=ai_component)
-	objects.append(monster)
+	level.add_object(monster)
 
 	#NPCS
 	# fighter_component = Fighter(hp=200, defense=100, power=5, constitution=0, xp=0, death_function=None, move_speed=4,
@@ -792,28 +1133,26 @@ def place_boss(room):
 	count = 0  #COUNT CHANGED
 	while count < 3:
 		while blocked:
-			x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-			y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
-			blocked = is_blocked(x, y)
+			(x, y) = room.random_spot(level.rng)
+			blocked = level.is_blocked(x, y)
 		count = count + 1
-		fighter_component = Fighter(hp=10, defense=2, power=5, constitution=0, xp=20, death_function=sorcerer_death, move_speed=8,
+		fighter_component = Fighter(hp=10, defense=2, power=5, constitution=0, xp=20, facing=libtcod.random_get_int(level.rng, 1, 8), death_function=sorcerer_death, move_speed=8,
 									attack_speed=20, protected=0)
 		ai_component = BasicMonster()
 		monster = Object(x, y, 'S', 'Kodian Ninja Wizard', libtcod.orange, blocks=True, fighter=fighter_component,
 						 ai=ai_component)
-		objects.append(monster)
+		level.add_object(monster)
 
 
-def place_objects(room):
+def place_objects(level, room):
 	#place random room features
-	num_features = libtcod.random_get_int(0, 0, MAX_ROOM_FEATURES)
+	num_features = libtcod.random_get_int(level.rng, 0, MAX_ROOM_FEATURES)
 
 	for i in range(num_features):
-		x = libtcod.random_get_int(0, room.x1 + 2, room.x2 - 2)
-		y = libtcod.random_get_int(0, room.y1 + 2, room.y2 - 2)
+		(x, y) = room.random_spot(level.rng, 2)
 		#only place it if the tile is not blocked
-		if not is_blocked(x, y):
-			chance = libtcod.random_get_int(0, 0, 110)
+		if not level.is_blocked(x, y):
+			chance = libtcod.random_get_int(level.rng, 0, 110)
 			if chance < 10:
 				feature = Object(x, y, libtcod.CHAR_BLOCK1, 'pile of rubble', libtcod.light_gray, blocks=True)
 			elif chance < 20:
@@ -832,23 +1171,22 @@ def place_objects(room):
 				feature = Object(x, y, 22, 'altar', libtcod.light_gray, blocks=True)
 			else:
 				feature = Object(x, y, libtcod.CHAR_DHLINE, 'altar', libtcod.light_gray, blocks=True)
-			objects.append(feature)
+			level.add_object(feature)
 
 	#choose random number of monsters
 
-	num_monsters = libtcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
+	num_monsters = libtcod.random_get_int(level.rng, 0, MAX_ROOM_MONSTERS)
 
 	for i in range(num_monsters):
 		#choose random spot for this monster
-		x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-		y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+		(x, y) = room.random_spot(level.rng)
 
 		#only place it if the tile is not blocked
-		if not is_blocked(x, y):
-			chance = libtcod.random_get_int(0, 0, 100)
+		if not level.is_blocked(x, y):
+			chance = libtcod.random_get_int(level.rng, 0, 100)
 			if chance < 50 + 20:  #60% chance of getting a solider
 				#create a soldier
-				fighter_component = Fighter(hp=10, defense=0, xp=10, power=5, constitution=0, death_function=monster_death,
+				fighter_component = Fighter(hp=10, defense=0, xp=10, power=5, constitution=0, facing=libtcod.random_get_int(level.rng, 1, 8), death_function=monster_death,
 											move_speed=5, attack_speed=20, protected=0)
 				ai_component = BasicMonster()
 
@@ -856,7 +1194,7 @@ def place_objects(room):
 								 blocks=True, fighter=fighter_component, ai=ai_component)
 			elif chance < 50 + 30:
 				#create a bandit
-				fighter_component = Fighter(hp=5, defense=0, xp=5, power=3, constitution=0, death_function=monster_death, move_speed=4,
+				fighter_component = Fighter(hp=5, defense=0, xp=5, power=3, constitution=0, facing=libtcod.random_get_int(level.rng, 1, 8), death_function=monster_death, move_speed=4,
 											attack_speed=20, protected=0)
 				ai_component = BasicMonster()
 
@@ -864,7 +1202,7 @@ def place_objects(room):
 								 blocks=True, fighter=fighter_component, ai=ai_component)
 			elif chance < 50 + 40:
 				#create a guard
-				fighter_component = Fighter(hp=10, defense=0, xp=40, power=3, constitution=0, death_function=monster_death,
+				fighter_component = Fighter(hp=10, defense=0, xp=40, power=3, constitution=0, facing=libtcod.random_get_int(level.rng, 1, 8), death_function=monster_death,
 											move_speed=7, attack_speed=20, protected=0)
 				ai_component = BasicMonster()
 
@@ -873,27 +1211,26 @@ def place_objects(room):
 
 			else:
 				#create a knight
-				fighter_component = Fighter(hp=20, defense=0, xp=45, power=7, constitution=0, death_function=monster_death,
+				fighter_component = Fighter(hp=20, defense=0, xp=45, power=7, constitution=0, facing=libtcod.random_get_int(level.rng, 1, 8), death_function=monster_death,
 											move_speed=7, attack_speed=20, protected=0)
 				ai_component = BasicMonster()
 
 				monster = Object(x, y, 'K', 'Kodian Knight', libtcod.dark_orange,
 								 blocks=True, fighter=fighter_component, ai=ai_component)
 
-			objects.append(monster)
+			level.add_object(monster)
 
 
 	#choose random number of items
-	num_items = libtcod.random_get_int(0, 0, MAX_ROOM_ITEMS)
+	num_items = libtcod.random_get_int(level.rng, 0, MAX_ROOM_ITEMS)
 
 	for i in range(num_items):
 		#choose random spot for this item
-		x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-		y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+		(x, y) = room.random_spot(level.rng)
 
 		#only place it if the tile is not blocked
-		if not is_blocked(x, y):
-			dice = libtcod.random_get_int(0, 0, 80)
+		if not level.is_blocked(x, y):
+			dice = libtcod.random_get_int(level.rng, 0, 80)
 			if dice < 30:
 				#create a stone
 				item_component = Item(use_function=throw_stone)
@@ -923,8 +1260,7 @@ def place_objects(room):
 				#create fireball scroll
 				item_component = Item(use_function=cast_fireball)
 				item = Object(x, y, '#', 'Scroll of Flames', libtcod.desaturated_red, item=item_component)
-			objects.append(item)
-			item.send_to_back()  #items appear below other objects
+			level.add_object(item, to_back=True)  #items appear below other objects
 			item.always_visible = True
 
 
@@ -932,8 +1268,8 @@ def npc_name():
 	firstName_bank = ["Karles", "Reto", "Brice", "Malro", "Tericus", "Leb"]
 	lastName_bank = ["Alzen", "Lehr", "Jedin", "Cherer", "Delluc", "Seibold"]
 
-	firstName = firstName_bank[libtcod.random_get_int(0, 0, len(firstName_bank) - 1)] + " "
-	lastName = lastName_bank[libtcod.random_get_int(0, 0, len(lastName_bank) - 1)]
+	firstName = firstName_bank[libtcod.random_get_int(game_rng, 0, len(firstName_bank) - 1)] + " "
+	lastName = lastName_bank[libtcod.random_get_int(game_rng, 0, len(lastName_bank) - 1)]
 
 	return firstName + lastName
 
@@ -959,21 +1295,130 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 
 def get_names_under_mouse():
 	#return a string with the names of all objects under the mouse
-	mouse = libtcod.mouse_get_status()
+	mouse = input_frame.mouse
 	(x, y) = (mouse.cx, mouse.cy)
+	if x >= CAMERA_WIDTH or y >= CAMERA_HEIGHT:
+		return ''  #over the panels
+	in_sight = view_mask[x * CAMERA_HEIGHT + y] == 2
 	(x, y) = (camera_x + x, camera_y + y)  #from screen to map coordinates
 
 	#create a list with the names of all objects at the mouse's coordinates and in FOV
-	names = [obj.name for obj in objects
-			 if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y) and is_in_view(obj.x, obj.y,
-																										  player.x,
-																										  player.y,
-																										  player.fighter.facing)]
+	names = [obj.name for obj in object_index.query(x, y, x, y)
+			 if obj.x == x and obj.y == y and in_sight]
 
 	names = ', '.join(names)  #join the names, separated by commas
 	return names.capitalize()
 
 
+class SpatialIndex:
+	#the objects of the current level in buckets of BUCKET_SIZE x BUCKET_SIZE tiles, so the ones in a
+	#rectangle can be found without going through all of them. it also remembers the order of the objects
+	#list (objects sent to the back are drawn first), so what it finds can be drawn in the same order.
+	def __init__(self, objects):
+		self.buckets = {}  #(column, row) of the bucket -> objects in it
+		self.order = {}  #object -> its place in the drawing order
+		self.first = 0
+		self.last = 0
+		for obj in objects:
+			self.add(obj)
+
+	def bucket(self, x, y):
+		return self.buckets.setdefault((x / BUCKET_SIZE, y / BUCKET_SIZE), [])
+
+	def add(self, obj):
+		#same as objects.append()
+		self.last += 1
+		self.order[obj] = self.last
+		self.bucket(obj.x, obj.y).append(obj)
+
+	def remove(self, obj):
+		del self.order[obj]
+		self.bucket(obj.x, obj.y).remove(obj)
+
+	def send_to_back(self, obj):
+		#same as objects.insert(0, obj)
+		self.first -= 1
+		self.order[obj] = self.first
+
+	def move(self, obj, old_x, old_y):
+		#the object moved from (old_x, old_y) to where it is now
+		if (old_x / BUCKET_SIZE, old_y / BUCKET_SIZE) != (obj.x / BUCKET_SIZE, obj.y / BUCKET_SIZE):
+			self.bucket(old_x, old_y).remove(obj)
+			self.bucket(obj.x, obj.y).append(obj)
+
+	def query(self, x1, y1, x2, y2):
+		#the objects of the buckets that overlap the tiles x1..x2, y1..y2 (some may be just outside), in
+		#drawing order
+		found = []
+		for column in range(x1 / BUCKET_SIZE, x2 / BUCKET_SIZE + 1):
+			for row in range(y1 / BUCKET_SIZE, y2 / BUCKET_SIZE + 1):
+				found.extend(self.buckets.get((column, row), ()))
+		found.sort(key=self.order.get)
+		return found
+
+
+object_index = SpatialIndex([])
+
+
+class MapFrame:
+	#what the map console shows, cell by cell (x * height + y), so each frame only the cells that changed are
+	#written. render_all() fills the background when the FOV changes and puts the objects on it every frame,
+	#flush() compares that with the last frame. colors are kept as ints (libtcod.col_to_int) to compare quickly.
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.blank_char = ord(' ')
+		self.blank_fore = libtcod.col_to_int(libtcod.white)
+		self.background = [libtcod.col_to_int(libtcod.black)] * (width * height)
+		self.chars = None
+		self.fores = None
+		self.shown = None  #(char, foreground, background) of every cell on the console, None if unknown
+		self.marks = {}  #cell -> background shown in its place, for the targeting overlay
+		self.changed = 0  #cells written by the last flush()
+		self.clear()
+
+	def clear(self):
+		#start a new frame on the background
+		self.chars = [self.blank_char] * (self.width * self.height)
+		self.fores = [self.blank_fore] * (self.width * self.height)
+
+	def put(self, x, y, char, color):
+		if type(char) == str:
+			char = ord(char)
+		self.chars[x * self.height + y] = char
+		self.fores[x * self.height + y] = libtcod.col_to_int(color)
+
+	def invalidate(self):
+		#something else drew on the console, repaint all of it next time
+		self.shown = None
+
+	def flush(self, console):
+		#write the cells that changed since the last frame to the console
+		cells = zip(self.chars, self.fores, self.background)
+		for (i, back) in self.marks.iteritems():
+			cells[i] = (cells[i][0], cells[i][1], back)
+		shown = self.shown
+		if shown is None:
+			changed = range(len(cells))
+		else:
+			changed = [i for i in xrange(len(cells)) if cells[i] != shown[i]]
+		if changed:
+			height = self.height
+			xs = [i / height for i in changed]
+			ys = [i % height for i in changed]
+			(chars, fores, backs) = zip(*[cells[i] for i in changed])
+			libtcod.console_put_chars(console, xs, ys, chars, fores, backs)
+		self.shown = cells
+		self.changed = len(changed)
+
+
+map_frame = MapFrame(CAMERA_WIDTH, CAMERA_HEIGHT)
+
+#what the player sees of every tile on screen (x * CAMERA_HEIGHT + y): 0 not in FOV, 1 in FOV but behind the
+#player, 2 in sight
+view_mask = bytearray(CAMERA_WIDTH * CAMERA_HEIGHT)
+
+
 def move_camera(target_x, target_y):
 	global camera_x, camera_y, fov_recompute
 
@@ -1003,23 +1448,73 @@ def to_camera_coordinates(x, y):
 
 
 def render_all():
-	global fov_map, color_dark_wall, color_light_wall
-	global color_dark_ground, color_light_ground
 	global fov_recompute
-	global follow_player
 
 	move_camera(player.x, player.y)
 	#calculate where monsters can see so it can be displayed
+	render_vision()
+
+	if fov_recompute:
+		#recompute FOV if needed (the player moved or something)
+		fov_recompute = False
+		render_tiles()
+
+	render_objects()
+	if targeting is not None:
+		targeting.in_range = None  #the player or the camera may have moved
+	mark_overlays()
+	blit_map()
+	render_panels()
+
+
+def render_overlays():
+	#a frame while aiming or animating in which nothing moved: what was drawn last stays, only the overlays
+	#and the names under the mouse are drawn again, and only if they changed
+	if not animations and (targeting is None or targeting.cell == targeting.shown):
+		return
+	mark_overlays()
+	blit_map()
+	render_panels()
+
+
+def mark_overlays():
+	#put the targeting overlay and this frame of the animations in map_frame.marks. the animations that are
+	#over are dropped
+	marks = {}
+	if targeting is not None:
+		targeting.mark(marks)
+	if animations:
+		now = time.time()
+		animations[:] = [animation for animation in animations if animation.draw(marks, now)]
+	map_frame.marks = marks
+
+
+def update_view():
+	#the part of render_all() the game logic depends on, without drawing anything: the camera, which turns
+	#mouse clicks into map positions, and the player's FOV, which the monsters check on their turn
+	global fov_recompute
+	move_camera(player.x, player.y)
+	if fov_recompute:
+		fov_recompute = False
+		libtcod.map_compute_fov(fov_map, player.x, player.y, VIEW_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+
+
+def render_vision():
+	#mark the tiles the monsters in sight can see, for the red overlay
 	for y in range(MAP_HEIGHT):
 		for x in range(MAP_WIDTH):
 			map[x][y].seen = 0
 
+	player_fov = False  #whether the FOV map holds the player's FOV
 	for object in objects:
-		libtcod.map_compute_fov(fov_map, player.x, player.y, VIEW_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+		if not player_fov:
+			libtcod.map_compute_fov(fov_map, player.x, player.y, VIEW_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+			player_fov = True
 		if libtcod.map_is_in_fov(fov_map, object.x, object.y) and object.ai and is_in_view(object.x, object.y, player.x,
 																						   player.y,
 																						   player.fighter.facing):
 			libtcod.map_compute_fov(fov_map, object.x, object.y, ENEMY_VIEW_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+			player_fov = False
 			for y in range(object.y - ENEMY_VIEW_RADIUS, object.y + ENEMY_VIEW_RADIUS + 1):
 				for x in range(object.x - ENEMY_VIEW_RADIUS + 1, object.x + ENEMY_VIEW_RADIUS + 1):
 					if y > 0 and y < MAP_HEIGHT and x > 0 and x < MAP_WIDTH:
@@ -1030,61 +1525,101 @@ def render_all():
 								map[x][y].seen += 1 - (1 * (distance / ENEMY_VIEW_RADIUS))
 							if map[x][y].seen > 1:
 								map[x][y].seen = 1
-
-	if fov_recompute:
-		#recompute FOV if needed (the player moved or something)
-		fov_recompute = False
+	if not player_fov:
+		#the monsters check the player's FOV on their turn, don't leave one of theirs in the map
 		libtcod.map_compute_fov(fov_map, player.x, player.y, VIEW_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-		libtcod.console_clear(con)
-
-		#go through all tiles, and set their background color according to the FOV
-		for y in range(CAMERA_HEIGHT):
-			for x in range(CAMERA_WIDTH):
-				(map_x, map_y) = (camera_x + x, camera_y + y)
-				if libtcod.map_is_in_fov(fov_map, map_x, map_y) and is_in_view(map_x, map_y, player.x, player.y,
-																			   player.fighter.facing):
-					visible = True
-				else:
-					visible = False
-				wall = map[map_x][map_y].block_sight
-				if not visible:
-					#if it's not visible right now, the player can only see it if it's explored
-					if map[map_x][map_y].explored:
-						if wall:
-							#libtcod.console_set_back(con, x, y, libtcod.desaturated_green, libtcod.BKGND_SET)
-							libtcod.console_set_back(con, x, y, libtcod.darker_blue, libtcod.BKGND_SET)
-						else:
-							libtcod.console_set_back(con, x, y, libtcod.Color(0 ,0 ,51), libtcod.BKGND_SET)
-				else:
-					#it's visible
+
+
+def render_tiles():
+	#the player's FOV, and the background of the tiles on screen that goes with it
+	libtcod.map_compute_fov(fov_map, player.x, player.y, VIEW_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+	background = map_frame.background
+	unexplored = libtcod.col_to_int(libtcod.black)  #unexplored areas stay black
+
+	#go through all tiles, and set their background color according to the FOV
+	for y in range(CAMERA_HEIGHT):
+		for x in range(CAMERA_WIDTH):
+			(map_x, map_y) = (camera_x + x, camera_y + y)
+			view = 0
+			if libtcod.map_is_in_fov(fov_map, map_x, map_y):
+				view = 1
+				if is_in_view(map_x, map_y, player.x, player.y, player.fighter.facing):
+					view = 2
+			view_mask[x * CAMERA_HEIGHT + y] = view
+			visible = view == 2
+			wall = map[map_x][map_y].block_sight
+			color = None
+			if not visible:
+				#if it's not visible right now, the player can only see it if it's explored
+				if map[map_x][map_y].explored:
 					if wall:
-						libtcod.console_set_back(con, x, y, color_light_wall, libtcod.BKGND_SET)
+						#color = libtcod.desaturated_green
+						color = libtcod.darker_blue
 					else:
-						if map[map_x][map_y].seen == 0:
-							libtcod.console_set_back(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-						else:
-							libtcod.console_set_back(con, x, y, libtcod.red * map[map_x][map_y].seen, libtcod.BKGND_SET)
-						#libtcod.console_set_back(con, x, y, color_ground_texture, libtcod.BKGND_SET )
-						libtcod.console_set_back(con, x, y, color_light_ground, libtcod.BKGND_SET)
-					#libtcod.console_set_char(con, x, y, '.')
-					#since it's visible, explore it
-					map[map_x][map_y].explored = True
-
-	#draw all objects in the list, except the player. we want it to
+						color = libtcod.Color(0 ,0 ,51)
+			else:
+				#it's visible
+				if wall:
+					color = color_light_wall
+				else:
+					if map[map_x][map_y].seen == 0:
+						color = color_dark_ground
+					else:
+						color = libtcod.red * map[map_x][map_y].seen
+					#color = color_ground_texture
+					color = color_light_ground
+				#libtcod.console_set_char(con, x, y, '.')
+				#since it's visible, explore it
+				map[map_x][map_y].explored = True
+			if color is None:
+				background[x * CAMERA_HEIGHT + y] = unexplored
+			else:
+				background[x * CAMERA_HEIGHT + y] = libtcod.col_to_int(color)
+
+
+def render_objects():
+	#draw the objects on screen, except the player. we want it to
 	#always appear over all other objects! so it's drawn later.
-	for object in objects:
+	map_frame.clear()
+	for object in object_index.query(camera_x, camera_y, camera_x + CAMERA_WIDTH - 1, camera_y + CAMERA_HEIGHT - 1):
 		if object != player:
 			object.draw()
 	player.draw()
 
-	#blit the contents of "con" to the root console
-	libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
 
-	#prepare to render the GUI panel
-	libtcod.console_set_background_color(panel, RIGHT_PANEL_COLOR)
+def blit_map():
+	#write what changed to "con" and blit the camera part of it to the root console. after a full repaint
+	#blit all of it, which also clears the root console around the panels
+	full = map_frame.shown is None
+	map_frame.flush(con)
+	if full:
+		libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+	else:
+		libtcod.console_blit(con, 0, 0, CAMERA_WIDTH, CAMERA_HEIGHT, 0, 0, 0)
+
+
+def render_panels():
+	#redraw the GUI panels if what they show changed, and blit them to the root console
+	render_message_panel()
+	render_stats_panel()
+	libtcod.console_blit(panel, 0, 0, 20, PANEL_HEIGHT, 0, SCREEN_WIDTH - 20, 0)
+	libtcod.console_blit(panel_bottom, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+
+
+#what the panels were last drawn from. they are only redrawn when it changes
+message_panel_shows = None
+stats_panel_shows = None
+
+
+def render_message_panel():
+	global message_panel_shows
+	shows = (game_msgs, game_msgs.version)
+	if shows == message_panel_shows:
+		return
+	message_panel_shows = shows
+
 	libtcod.console_set_background_color(panel_bottom, BOTTOM_PANEL_COLOR)
 	libtcod.console_clear(panel_bottom)
-	libtcod.console_clear(panel)
 
 	#print 'messages label'
 	libtcod.console_set_foreground_color(panel_bottom, libtcod.white)
@@ -1093,24 +1628,42 @@ def render_all():
 	#print the game messages, one line at a time
 	y = 1
 	mul = 0
-	for (line, color) in game_msgs:
+	for (line, color) in game_msgs.lines(MSG_HEIGHT):
 		libtcod.console_set_foreground_color(panel_bottom, color * mul)
 		libtcod.console_print_left(panel_bottom, 1, y, libtcod.BKGND_NONE, line)
 		y += 1
 		mul += .095
 
+
+def render_stats_panel():
+	global stats_panel_shows
+	if profile_overlay:
+		render_profile_panel()
+		return
+
+	fighter = player.fighter
+	names = get_names_under_mouse()
+	shows = (fighter.hp, fighter.max_hp, fighter.souls, fighter.max_souls, fighter.xp, player.level, dungeon_level,
+			 fighter.power, fighter.defense, fighter.constitution, names)
+	if shows == stats_panel_shows:
+		return
+	stats_panel_shows = shows
+
+	libtcod.console_set_background_color(panel, RIGHT_PANEL_COLOR)
+	libtcod.console_clear(panel)
+
 	#show the player's stats
-	render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp,
+	render_bar(1, 1, BAR_WIDTH, 'HP', fighter.hp, fighter.max_hp,
 			   libtcod.desaturated_red, libtcod.darker_red)
-	render_bar(1, 3, BAR_WIDTH, 'SOULS', player.fighter.souls, player.fighter.max_souls,
+	render_bar(1, 3, BAR_WIDTH, 'SOULS', fighter.souls, fighter.max_souls,
 			   libtcod.desaturated_cyan, libtcod.darker_cyan)
-	render_bar(1, 5, BAR_WIDTH, 'EXP', player.fighter.xp, LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR,
+	render_bar(1, 5, BAR_WIDTH, 'EXP', fighter.xp, LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR,
 			   libtcod.dark_yellow, libtcod.darker_yellow)
 	libtcod.console_print_left(panel, 1, 7, libtcod.BKGND_NONE, 'Dungeon Level: ' + str(dungeon_level))
 	libtcod.console_print_left(panel, 1, 10, libtcod.BKGND_NONE, '[STATS]============')
-	libtcod.console_print_left(panel, 1, 11, libtcod.BKGND_NONE, 'STR:' +  str(player.fighter.power))
-	libtcod.console_print_left(panel, 1, 12, libtcod.BKGND_NONE, 'AGI:' +  str(player.fighter.defense))
-	libtcod.console_print_left(panel, 1, 13, libtcod.BKGND_NONE, 'CON:' +  str(player.fighter.constitution))
+	libtcod.console_print_left(panel, 1, 11, libtcod.BKGND_NONE, 'STR:' +  str(fighter.power))
+	libtcod.console_print_left(panel, 1, 12, libtcod.BKGND_NONE, 'AGI:' +  str(fighter.defense))
+	libtcod.console_print_left(panel, 1, 13, libtcod.BKGND_NONE, 'CON:' +  str(fighter.constitution))
 
 	#determine state of command
 	# if follow_player == True:
@@ -1123,25 +1676,160 @@ def render_all():
 
 	#display names of objects under the mouse
 	libtcod.console_set_foreground_color(panel, libtcod.light_gray)
-	libtcod.console_print_left(panel, 1, 0, libtcod.BKGND_NONE, get_names_under_mouse())
+	libtcod.console_print_left(panel, 1, 0, libtcod.BKGND_NONE, names)
 	#libtcod.console_print_left(panel, player.x - 1, player.y - 1, libtcod.BKGND_NONE, get_names_under_mouse())
 
-	#blit the contents of "panel" to the root console
-	libtcod.console_blit(panel, 0, 0, 20, PANEL_HEIGHT, 0, SCREEN_WIDTH - 20, 0)
-	libtcod.console_blit(panel_bottom, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
 
+def render_profile_panel():
+	#the rolling frame times in place of the stats, refreshed twice a second
+	global stats_panel_shows, profile_shown_at
+	if stats_panel_shows == 'profile' and time.time() - profile_shown_at < 0.5:
+		return
+	stats_panel_shows = 'profile'
+	profile_shown_at = time.time()
 
-def message(new_msg, color=libtcod.white):
-	#split the message if necessary, among multiple lines
-	new_msg_lines = textwrap.wrap(new_msg, )
+	libtcod.console_set_background_color(panel, RIGHT_PANEL_COLOR)
+	libtcod.console_clear(panel)
+	libtcod.console_set_foreground_color(panel, libtcod.light_gray)
+	libtcod.console_print_left(panel, 1, 0, libtcod.BKGND_NONE, 'ms        p50   p95')
+	y = 1
+	for (phase, owner, name) in PROFILE_PHASES:
+		libtcod.console_print_left(panel, 1, y, libtcod.BKGND_NONE, '%-8s%5.1f %5.1f' % (
+			phase, frame_profiler.percentile(phase, 50), frame_profiler.percentile(phase, 95)))
+		y += 1
+	libtcod.console_print_left(panel, 1, y, libtcod.BKGND_NONE, '%-8s%5.1f %5.1f' % (
+		'input', frame_profiler.percentile('input', 50), frame_profiler.percentile('input', 95)))
+	libtcod.console_print_left(panel, 1, y + 2, libtcod.BKGND_NONE, 'cells   %5d' % map_frame.changed)
+
+
+#the phases of a frame the profiler times: (phase, module, function)
+PROFILE_PHASES = [
+	('frame', __name__, 'render_all'),
+	('vision', __name__, 'render_vision'),
+	('fov', 'libtcodpy', 'map_compute_fov'),
+	('tiles', __name__, 'render_tiles'),
+	('objects', __name__, 'render_objects'),
+	('overlay', __name__, 'render_overlays'),
+	('blit', __name__, 'blit_map'),
+	('panels', __name__, 'render_panels'),
+	('keys', __name__, 'handle_keys'),
+	('ai', __name__, 'take_ai_turns'),
+	('flush', 'libtcodpy', 'console_flush'),
+]
+
+frame_profiler = None  #profiler.FrameProfiler while profiling
+startup_times = {}  #startup mark -> seconds after the process started, see mark_startup()
+call_counter = None  #libtcod.CallCounter while counting library calls
+profile_overlay = False  #show the profile in the side panel
+profile_shown_at = 0
+
+
+def process_age():
+	#seconds since the process started. on Linux /proc has its start time, elsewhere this counts from when the
+	#module started loading, which leaves out the interpreter's own startup
+	try:
+		f = open('/proc/self/stat')
+		try:
+			stat = f.read()
+		finally:
+			f.close()
+		f = open('/proc/uptime')
+		try:
+			uptime = float(f.read().split()[0])
+		finally:
+			f.close()
+		#the start time is the 22nd field, counted in clock ticks since boot. the name in brackets can hold spaces
+		started = int(stat.rsplit(')', 1)[1].split()[19]) / float(os.sysconf('SC_CLK_TCK'))
+		return max(uptime - started, time.time() - import_started)
+	except (IOError, OSError, ValueError, IndexError, AttributeError):
+		return time.time() - import_started
+
+
+def mark_startup(name):
+	#note when the game first got somewhere: 'import' (the module is loaded), 'window' (the window is open),
+	#'first_frame' (the first screen was shown) and 'first_tick' (the first game tick ran)
+	if name not in startup_times:
+		startup_times[name] = process_age()
+
+
+def start_profiler():
+	#wrap the functions of every phase with timers. nothing is wrapped unless PROFILE is set, so the game
+	#doesn't pay for the profiler when it isn't used
+	global frame_profiler
+	frame_profiler = profiler.FrameProfiler()
+	for (phase, owner, name) in PROFILE_PHASES:
+		frame_profiler.wrap(sys.modules[owner], name, phase)
+
+
+def stop_profiler():
+	global frame_profiler
+	frame_profiler.unwrap()
+	frame_profiler.dump(PROFILE_FILE)
+	frame_profiler = None
+
+
+def message(text, color=libtcod.white, *args):
+	#add a message to the log. text can be a % template for args, it is only filled in if the message gets shown
+	game_msgs.add(text, color, args)
+
+
+class MessageLog:
+	#the latest messages, oldest first, in a ring buffer that drops the oldest when a new one comes in. messages
+	#are kept as a template and its arguments and only formatted and wrapped into lines when drawn. a message
+	#repeated right away is counted instead of taking another place.
+	def __init__(self, capacity=MSG_HEIGHT, width=MSG_WRAP_WIDTH):
+		self.messages = collections.deque(maxlen=capacity)  #[template, args, color, count]
+		self.width = width
+		self.version = 0  #goes up with every message, to tell when the log has to be drawn again
+		self.wrapped = {}  #text -> its lines
+
+	def add(self, text, color, args=()):
+		self.version += 1
+		if self.messages:
+			last = self.messages[-1]
+			if last[0] == text and last[1] == args and last[2] == color:
+				last[3] += 1
+				return
+		self.messages.append([text, args, color, 1])
+
+	def wrap(self, text):
+		#split a message among multiple lines, remembering the result for the next frames
+		if text not in self.wrapped:
+			if len(self.wrapped) >= 4 * self.messages.maxlen:
+				self.wrapped.clear()
+			self.wrapped[text] = textwrap.wrap(text, self.width)
+		return self.wrapped[text]
+
+	def lines(self, count):
+		#the last count lines of the log, oldest first, as (text, color)
+		lines = []
+		for (text, args, color, repeats) in reversed(self.messages):
+			if args:
+				text = text % args
+			if repeats > 1:
+				text += ' (x' + str(repeats) + ')'
+			for line in reversed(self.wrap(text)):
+				lines.append((line, color))
+			if len(lines) >= count:
+				break
+		lines = lines[:count]
+		lines.reverse()
+		return lines
 
-	for line in new_msg_lines:
-		#if the buffer is full, remove the first line to make room for the new one
-		if len(game_msgs) == MSG_HEIGHT:
-			del game_msgs[0]
 
-		#add the new line as a tuple, with the text and the color
-		game_msgs.append((line, color))
+def log_combat(kind, attacker, target, damage=None, crit=False, limb=None, spell=None):
+	#record a combat event, if the combat log is enabled. attacker can be None (deaths)
+	if combat_log is None:
+		return
+	if attacker is not None:
+		attacker = attacker.name
+	combat_log.write(combatlog.Event(game_tick, kind, attacker, target.name, damage, crit, limb, spell, target.x, target.y,
+									 dungeon_level))
+
+
+combat_log = None  #combatlog.CombatLog when COMBAT_LOG is set
+game_tick = 0  #turns of the game loop since the game started
+game_rng = 0  #libtcod RNG of every roll during the game, seeded from the game seed by new_game()
 
 
 def player_move_or_attack(dx, dy):
@@ -1161,7 +1849,7 @@ def player_move_or_attack(dx, dy):
 	#attack if target found, move otherwise
 	if target is not None:
 		if is_in_view(player.x, player.y, target.x, target.y, target.fighter.facing):
-			if libtcod.random_get_int(0, 0, 30) > 1:
+			if libtcod.random_get_int(game_rng, 0, 30) > 1:
 				player.fighter.attack(target)
 				#chance = libtcod.random_get_int(0, 0, 110)
 			#chance_crit = libtcod.random_get_int(0, 0, 100)
@@ -1169,6 +1857,7 @@ def player_move_or_attack(dx, dy):
 
 			else:
 			 	message('Your swing misses!!', libtcod.white)
+			 	log_combat('miss', player, target, 0)
 		else:
 			player.fighter.backstab(target)
 	else:
@@ -1198,6 +1887,84 @@ def closest_monster(max_range):
 	return closest_enemy
 
 
+def check_for_keypress(flags=libtcod.KEY_RELEASED):
+	#poll_input() and wait_key() read the keyboard and the mouse through these three, so a replay.Recorder
+	#can write down what they return and a replay.Replayer can stand in for the player
+	if input_session is not None:
+		return input_session.check_for_keypress(game_tick, flags)
+	return libtcod.console_check_for_keypress(flags)
+
+
+def wait_for_keypress(flush=True):
+	if input_session is not None:
+		return input_session.wait_for_keypress(game_tick, flush)
+	return libtcod.console_wait_for_keypress(flush)
+
+
+def mouse_get_status():
+	if input_session is not None:
+		return input_session.mouse_get_status(game_tick)
+	return libtcod.mouse_get_status()
+
+
+input_session = None  #replay.Recorder while recording, replay.Replayer while replaying
+
+#the input of one frame, read by poll_input(): the tick and time it was read at, the mouse, and the keys
+#pressed since the frame before
+InputFrame = collections.namedtuple('InputFrame', 'tick time mouse keys')
+
+input_frame = InputFrame(0, 0.0, libtcod.Mouse(), ())
+key_buffer = collections.deque()  #(key, time it was read) of the keys nothing has taken yet
+
+
+def poll_input():
+	#read the keyboard and the mouse, once per frame; everything else uses input_frame and next_key(). keys
+	#pressed while the player can't act, or during an animation, wait in the buffer instead of being lost.
+	#a key that is already the last one waiting isn't added again, so holding a key down doesn't queue moves
+	global input_frame
+	now = time.time()
+	keys = []
+	while len(keys) < KEY_BUFFER_SIZE:
+		key = check_for_keypress(libtcod.KEY_PRESSED)
+		if key.vk == libtcod.KEY_NONE:
+			break
+		keys.append(key)
+		if key_buffer and (key_buffer[-1][0].vk, key_buffer[-1][0].c) == (key.vk, key.c):
+			continue
+		if len(key_buffer) < KEY_BUFFER_SIZE:
+			key_buffer.append((key, now))
+	input_frame = InputFrame(game_tick, now, mouse_get_status(), tuple(keys))
+
+
+def next_key():
+	#take the oldest key waiting, or no key (vk KEY_NONE). the time it waited goes to the frame profile
+	if not key_buffer:
+		return libtcod.Key()
+	(key, read_at) = key_buffer.popleft()
+	if frame_profiler is not None:
+		frame_profiler.add('input', time.time() - read_at)
+	return key
+
+
+def take_escape():
+	#take Escape out of the buffer if it was pressed, leaving the other keys where they are
+	for entry in key_buffer:
+		if entry[0].vk == libtcod.KEY_ESCAPE:
+			key_buffer.remove(entry)
+			return True
+	return False
+
+
+def wait_key(flush=True):
+	#the next key, waiting for one if none is left. with flush, as for the menus, keys pressed before it was
+	#asked for are dropped, so they can't choose an option by accident
+	if flush:
+		key_buffer.clear()
+	elif key_buffer:
+		return next_key()
+	return wait_for_keypress(flush)
+
+
 def menu(header, options, width):
 	if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
 
@@ -1214,14 +1981,9 @@ def menu(header, options, width):
 	libtcod.console_set_foreground_color(window, libtcod.white)
 	libtcod.console_print_left_rect(window, 0, 0, width, height, libtcod.BKGND_NONE, header)
 
-	#print all the options
-	y = header_height
-	letter_index = ord('a')
-	for option_text in options:
-		text = '(' + chr(letter_index) + ') ' + option_text
-		libtcod.console_print_left(window, 0, y, libtcod.BKGND_NONE, text)
-		y += 1
-		letter_index += 1
+	#print all the options, one per line, in one call
+	lines = ['(' + chr(ord('a') + i) + ') ' + option_text for (i, option_text) in enumerate(options)]
+	libtcod.console_print_left(window, 0, header_height, libtcod.BKGND_NONE, '\n'.join(lines))
 
 	#blit the contents of "window" to the root console
 	x = SCREEN_WIDTH / 2 - width / 2
@@ -1230,7 +1992,8 @@ def menu(header, options, width):
 
 	#present the root console to the player and wait for a key-press
 	libtcod.console_flush()
-	key = libtcod.console_wait_for_keypress(True)
+	mark_startup('first_frame')
+	key = wait_key()
 
 	if key.vk == libtcod.KEY_ENTER and key.lalt:  #(special case) Alt+Enter: toggle fullscreen
 		libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
@@ -1264,8 +2027,26 @@ tut = True
 
 
 def handle_keys():
-	global tut, fov_recompute
-	key = libtcod.console_check_for_keypress(libtcod.KEY_PRESSED)
+	global tut, fov_recompute, profile_overlay, stats_panel_shows
+	if targeting is not None:
+		return handle_targeting()
+
+	if TURN_BASED:
+		if key_buffer:
+			skip_animations()  #the player is typing ahead
+		else:
+			finish_animations()  #they would stop while the game waits
+		key = wait_key(False)  #keys typed ahead are kept
+	else:
+		if game_state == 'playing' and player.wait > 0:
+			#still recovering from the last action. the keys typed ahead stay in the buffer for when the
+			#player can act, only Escape is taken now
+			if take_escape():
+				return 'exit'
+			player.wait -= 1
+			fov_recompute = True
+			return
+		key = next_key()
 
 	#FULLSCREEN
 	#if key.vk == key.lalt:
@@ -1276,13 +2057,6 @@ def handle_keys():
 		return 'exit'  #exit game
 
 	if game_state == 'playing':
-		if player.wait > 0:
-			player.wait -= 1
-			fov_recompute = True
-			#player_pass_turn()
-
-			return
-
 		key_char = chr(key.c)
 		#if player.wait > 0:
 		#	player.wait -= 1
@@ -1350,6 +2124,11 @@ def handle_keys():
 				#go to help menu
 				help_menu()
 
+			if key.vk == libtcod.KEY_F3 and frame_profiler is not None:
+				#show or hide the frame profile
+				profile_overlay = not profile_overlay
+				stats_panel_shows = None
+
 			if key_char == 'c':
 				#show character information
 				level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
@@ -1383,9 +2162,8 @@ def monster_death(monster):
 	if player.fighter.souls > MAX_SOULS:
 		player.fighter.souls = 10
 
-	message('Your blade absorbs the soul of the ' + monster.name.capitalize() + '!', libtcod.orange)
-	message('The ' + monster.name + ' is dead! You gain ' + str(monster.fighter.xp) + ' experience points.',
-			libtcod.orange)
+	message('Your blade absorbs the soul of the %s!', libtcod.orange, monster.name.capitalize())
+	message('The %s is dead! You gain %d experience points.', libtcod.orange, monster.name, monster.fighter.xp)
 	monster.char = '%'
 	monster.color = libtcod.red
 	monster.blocks = False
@@ -1428,10 +2206,8 @@ def victory_death(monster):
 	monster.ai = None
 	monster.name = 'remains of ' + monster.name
 	monster.send_to_back()
-	dungeon_level += 1
-	#print("You are are level " + str(dungeon_level))
-	make_map()
-	initialize_fov()
+	#print("You are are level " + str(dungeon_level + 1))
+	change_level(dungeon_level + 1)
 
 
 def check_level_up():
@@ -1459,38 +2235,75 @@ def check_level_up():
 			player.fighter.defense += 1
 
 
-def target_tile(max_range=None):
-	#return the position of a tile left-clicked in player's FOV (optionally in a range), or (None,None) if right-clicked.
-	while True:
-		#render the screen. this erases the inventory and shows the names of objects under the mouse.
-		render_all()
-		libtcod.console_flush()
+class Targeting:
+	#a tile being chosen with the mouse, for a spell or a thrown stone. while it is the global targeting, the
+	#player's turns go to handle_targeting() instead of the keys, and the tiles that can be chosen and the one
+	#under the mouse are drawn over the map. the game goes on meanwhile, unless it is turn-based.
+	def __init__(self, chosen, max_range=None):
+		self.chosen = chosen  #called with the tile clicked
+		self.max_range = max_range
+		self.item = None  #the inventory item used up once a tile is chosen
+		self.cell = (None, None)  #screen cell under the mouse
+		self.shown = None  #cell the overlay was last drawn for
+		self.in_range = None  #cell -> background of the tiles on screen that can be chosen, None to work out again
+
+	def allows(self, x, y):
+		#a tile in the player's FOV, and in range if there is one
+		return libtcod.map_is_in_fov(fov_map, x, y) and (self.max_range is None or player.distance(x, y) <= self.max_range)
+
+	def mark(self, marks):
+		#add the overlay to marks. the tiles in range come from the view mask of the last render_tiles()
+		if self.in_range is None:
+			self.in_range = {}
+			background = map_frame.background
+			for i in xrange(len(view_mask)):
+				if view_mask[i]:
+					(x, y) = divmod(i, CAMERA_HEIGHT)
+					if self.max_range is None or player.distance(camera_x + x, camera_y + y) <= self.max_range:
+						self.in_range[i] = libtcod.col_to_int(libtcod.int_to_col(background[i]) + TARGET_RANGE_COLOR)
+		marks.update(self.in_range)
+		(x, y) = self.cell
+		if x is not None:
+			marks[x * CAMERA_HEIGHT + y] = libtcod.col_to_int(TARGET_CURSOR_COLOR)
+		self.shown = self.cell
 
-		key = libtcod.console_check_for_keypress()
-		mouse = libtcod.mouse_get_status()  #get mouse position and click status
-		(x, y) = (mouse.cx, mouse.cy)
-		(x, y) = (camera_x + x, camera_y + y)  #from screen to map coordinates
 
-		if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE:
-			return (None, None)  #cancel if the player right-clicked or pressed Escape
+targeting = None  #Targeting while the player aims
 
-		#accept the target if the player clicked in FOV, and in case a range is specified, if it's in that range
-		if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and
-				(max_range is None or player.distance(x, y) <= max_range)):
-			return (x, y)
 
+def start_targeting(chosen, max_range=None):
+	#let the player choose a tile from the next frame on, see Targeting. returns 'targeting', which tells
+	#Item.use() to keep the item until then
+	global targeting
+	targeting = Targeting(chosen, max_range)
+	return 'targeting'
 
-def target_monster(max_range=None):
-	#returns a clicked monster inside FOV up to a range, or None if right-clicked
-	while True:
-		(x, y) = target_tile(max_range)
-		if x is None:  #player cancelled
-			return None
 
-		#return the first clicked monster, otherwise continue looping
-		for obj in objects:
-			if obj.x == x and obj.y == y and obj.fighter and obj != player:
-				return obj
+def handle_targeting():
+	#a left-click on a tile that can be chosen ends the targeting with that tile, a right-click or Escape
+	#cancels it and keeps the item. neither takes the player's turn.
+	global targeting
+	key = next_key()
+	mouse = input_frame.mouse
+	aim = targeting
+	aim.cell = (None, None)
+	if mouse.cx < CAMERA_WIDTH and mouse.cy < CAMERA_HEIGHT:
+		aim.cell = (mouse.cx, mouse.cy)
+	(x, y) = (camera_x + mouse.cx, camera_y + mouse.cy)  #from screen to map coordinates
+
+	if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE or game_state != 'playing':
+		end_targeting()
+	elif mouse.lbutton_pressed and aim.cell[0] is not None and aim.allows(x, y):
+		end_targeting()
+		if aim.chosen(x, y) != 'cancelled' and aim.item is not None:
+			inventory.remove(aim.item)
+	return 'didnt-take-turn'
+
+
+def end_targeting():
+	global targeting
+	targeting = None
+	mark_overlays()
 
 
 def closest_monster(max_range):
@@ -1512,7 +2325,10 @@ def throw_stone():
 	#throws a stone! hopefully distracts an enemy as well
 	#ask the player for a target to throw to
 	message('Left-click to choose where to throw the stone, or right-click to cancel.', libtcod.light_cyan)
-	(x, y) = target_tile()
+	return start_targeting(throw_stone_at)
+
+
+def throw_stone_at(x, y):
 	for obj in objects:  #affects every enemy within range if they can't see the player
 		if obj.distance(x, y) <= ENEMY_VIEW_RADIUS and obj.ai:
 			if not (libtcod.map_is_in_fov(fov_map, obj.x, obj.y) and is_in_view(player.x, player.y, obj.x, obj.y,
@@ -1520,7 +2336,7 @@ def throw_stone():
 					obj) < ENEMY_VIEW_RADIUS):
 				obj.ai.memory_x = x
 				obj.ai.memory_y = y
-				message('The ' + obj.name + ' is distracted by the noise!', libtcod.light_green)
+				message('The %s is distracted by the noise!', libtcod.light_green, obj.name)
 
 
 def cast_heal():
@@ -1558,6 +2374,7 @@ def cast_lightning():
 		#zap it!
 		message('A lighting bolt strikes the ' + monster.name + ' for ' + str(LIGHTNING_DAMAGE) + ' hit points.',
 				libtcod.light_blue)
+		log_combat('spell', player, monster, LIGHTNING_DAMAGE, spell='lightning')
 		monster.fighter.take_damage(LIGHTNING_DAMAGE)
 		player.fighter.souls = 0
 
@@ -1573,15 +2390,21 @@ def cast_fireball():
 		Damage caused by the spell.
 	"""
 	message('Left-click to choose where to cast this spell, or right-click to cancel.', libtcod.light_cyan)
-	(x, y) = target_tile()
+	return start_targeting(cast_fireball_at)
+
 
-	if x is None: return 'cancelled'
+def cast_fireball_at(x, y):
 	message('A fireball suddenly appears, engulfing your target!', libtcod.light_green)
 	explosion_effect(x, y, FIREBALL_RADIUS, libtcod.light_orange, libtcod.red)
+	resolve_fireball(x, y)
 
+
+def resolve_fireball(x, y):
+	#the effect of a fireball centered on (x, y), without the targeting and the animation
 	for obj in objects:  #damage every fighter in range, including the player
 		if obj.distance(x, y) <= FIREBALL_RADIUS and obj.ai:
-			message(obj.name + ' hit by fire for ' + str(FIREBALL_DAMAGE) + ' hit points.', libtcod.light_blue)
+			message('%s hit by fire for %d hit points.', libtcod.light_blue, obj.name, FIREBALL_DAMAGE)
+			log_combat('spell', player, obj, FIREBALL_DAMAGE + int(player.fighter.souls / 2), spell='fireball')
 			obj.fighter.take_damage(FIREBALL_DAMAGE + int(player.fighter.souls / 2))
 	player.fighter.souls = 0
 
@@ -1596,15 +2419,21 @@ def cast_freeze():
 		Damage caused by the spell.
 	'''
 	message('Left-click to choose where to cast this spell, or right-click to cancel.', libtcod.light_cyan)
-	(x, y) = target_tile()
+	return start_targeting(cast_freeze_at)
+
 
-	if x is None: return 'cancelled'
+def cast_freeze_at(x, y):
 	message('A gale of frozen air freezes your enemies in place, making it hard for them to move.', libtcod.light_green)
 	explosion_effect(x, y, FREEZE_RADIUS, libtcod.white, libtcod.desaturated_cyan)
+	resolve_freeze(x, y)
 
+
+def resolve_freeze(x, y):
+	#the effect of a freeze spell centered on (x, y)
 	for obj in objects:  #damage every fighter in range, including the player
 		if obj.distance(x, y) <= FREEZE_RADIUS and obj.ai:
-			message(obj.name + ' frozen for ' + str(FREEZE_DAMAGE) + ' hit points.', libtcod.light_blue)
+			message('%s frozen for %d hit points.', libtcod.light_blue, obj.name, FREEZE_DAMAGE)
+			log_combat('spell', player, obj, FREEZE_DAMAGE + int(player.fighter.souls / 2), spell='freeze')
 			obj.fighter.take_damage(FREEZE_DAMAGE + int(player.fighter.souls / 2))
 			obj.fighter.move_speed = 40 #can only move once per second
 
@@ -1621,59 +2450,104 @@ def cast_confuse():
 	Radius of confusion spell.
 	"""
 	message('Left-click to choose where to cast this spell, or right-click to cancel.', libtcod.light_cyan)
-	(x, y) = target_tile()
+	return start_targeting(cast_confuse_at)
+
 
-	if x is None: return 'cancelled'
+def cast_confuse_at(x, y):
 	message('A flash of while light suddenly appears and vanishes.', libtcod.light_green)
 	explosion_effect(x, y, CONFUSION_RADIUS, libtcod.dark_grey, libtcod.white)
+	resolve_confuse(x, y)
 
+
+def resolve_confuse(x, y):
+	#the effect of a confusion spell centered on (x, y)
 	for obj in objects:  #damage  every fighter in range, including the player
 		if obj.distance(x, y) <= CONFUSION_RADIUS and obj.ai:
 			#replace the monster's AI with a "confused" one; after some turns it will restore the old AI
 			old_ai = obj.ai
 			obj.ai = ConfusedMonster(old_ai)
 			obj.ai.owner = obj  #tell the new component who owns it
-			message('The eyes of the ' + obj.name + ' look vacant, as he starts to stumble around!',
-					libtcod.light_green)
+			message('The eyes of the %s look vacant, as he starts to stumble around!', libtcod.light_green, obj.name)
+			log_combat('spell', player, obj, spell='confuse')
+
+
+class Explosion:
+	#color spreading from (cx, cy) over the floor in the player's FOV and fading out, shown as background
+	#marks over the map (see mark_overlays())
+	def __init__(self, cx, cy, radius, inner_color, outer_color):
+		(self.cx, self.cy) = (cx, cy)
+		self.radius = radius
+		self.inner = (inner_color.r, inner_color.g, inner_color.b)
+		self.outer = (outer_color.r, outer_color.g, outer_color.b)
+		self.start = time.time()
+		self.duration = ANIMATION_FRAMES / float(LIMIT_FPS)
+
+	def draw(self, marks, now):
+		#add the colors of the moment now to marks. False once it is over
+		done = (now - self.start) / self.duration
+		if done >= 1:
+			return False
+		r = 0.5 * self.radius * done  #the radius expands as the animation advances
+		limit = 4 * (1 - done)  #an upper limit on alpha that decreases as the animation advances, so it fades out in the end
+		if r == 0:
+			return True
+		(inner, outer) = (self.inner, self.outer)
+		ground = (color_light_ground.r, color_light_ground.g, color_light_ground.b)
+
+		#tiles further than this don't change color by a step
+		reach = int(r * math.sqrt(255)) + 1
+		(cx, cy) = (self.cx - camera_x, self.cy - camera_y)
+		for x in range(max(0, cx - reach), min(CAMERA_WIDTH, cx + reach + 1)):
+			for y in range(max(0, cy - reach), min(CAMERA_HEIGHT, cy + reach + 1)):
+				#only draw on floor tiles in FOV
+				if not view_mask[x * CAMERA_HEIGHT + y] or map[camera_x + x][camera_y + y].blocked:
+					continue
+				sqr_dist = (x - cx) ** 2 + (y - cy) ** 2  #the squared distance from tile to center
+				#alpha increases with radius (0.9*r) and decreases with distance to center. the +0.1 prevents a division by 0 at the center.
+				alpha = min(1, (0.9 * r) ** 2 / (sqr_dist + 0.1))
+				color = [int(outer[i] + (inner[i] - outer[i]) * alpha) for i in range(3)]
+				#interpolate between the ground color and that (fade away from the center)
+				alpha = min(1, r ** 2 / (sqr_dist + 0.1), limit)  #same as before, but with the full radius
+				color = [int(ground[i] + (color[i] - ground[i]) * alpha) for i in range(3)]
+				marks[x * CAMERA_HEIGHT + y] = (color[0] << 16) | (color[1] << 8) | color[2]
+		return True
+
+	def skip(self):
+		pass
+
+
+class Fade:
+	#the whole screen fading from one amount of color to another (libtcod's console fade, 255 is no color),
+	#in steps of 5 a frame. the fade stays when it is over.
+	def __init__(self, color, start, end):
+		self.color = color
+		(self.from_fade, self.to_fade) = (start, end)
+		self.start = time.time()
+		self.duration = max(abs(end - start) / 5.0, 1) / LIMIT_FPS
+
+	def draw(self, marks, now):
+		done = (now - self.start) / self.duration
+		if done >= 1:
+			self.skip()
+			return False
+		libtcod.console_set_fade(int(self.from_fade + (self.to_fade - self.from_fade) * done), self.color)
+		return True
+
+	def skip(self):
+		libtcod.console_set_fade(self.to_fade, self.color)
+
+
+animations = []  #Explosion and Fade objects running, drawn by mark_overlays()
 
 
 def explosion_effect(cx, cy, radius, inner_color, outer_color):
-	global fov_recompute
-	render_all()  #first, re-render the screen
-	num_frames = float(ANIMATION_FRAMES)  #number of frames as a float, so dividing an int by it doesn't yield an int
-
-	for frame in range(ANIMATION_FRAMES):
-		#loop through all tiles in a square around the center. min and max make sure it doesn't go out of the map.
-		for y in range(CAMERA_HEIGHT):
-			#THis is the rang eof the camera
-			for x in range(CAMERA_WIDTH):
-				(map_x, map_y) = (camera_x + x, camera_y + y)
-				#only draw on visible floor tile
-				if not map[map_x][map_y].blocked and libtcod.map_is_in_fov(fov_map, map_x, map_y):
-					#interpolate between inner and outer color
-					r = 0.5 * radius * frame / num_frames  #the radius expands as the animation advances
-					sqr_dist = (map_x - cx) ** 2 + (map_y - cy) ** 2  #the squared distance from tile to center
-					#alpha increases with radius (0.9*r) and decreases with distance to center. the +0.1 prevents a division by 0 at the center.
-					alpha = (0.9 * r) ** 2 / (sqr_dist + 0.1)
-					color = libtcod.color_lerp(outer_color, inner_color,
-											   min(1, alpha))  #interpolate colors. also prevent alpha > 1.
-					#interpolate between previous color and ground color (fade away from the center)
-					alpha = r ** 2 / (sqr_dist + 0.1)  #same as before, but with the full radius (r) instead of (0.9*r)
-					alpha = min(alpha, 4 * (
-						1 - frame / num_frames))  #impose on alpha an upper limit that decreases as the animation advances, so it fades out in the end
-					color = libtcod.color_lerp(color_light_ground, color, min(1, alpha))  #same as before
-					libtcod.console_set_back(con, x, y, color, libtcod.BKGND_SET)  #set the tile color
-					libtcod.console_blit(con, 0, 0, CAMERA_WIDTH, CAMERA_HEIGHT, 0, 0, 0)
-		libtcod.console_check_for_keypress()
-		libtcod.console_flush()  #show result
-	fov_recompute = True  #repair the damage
-	render_all()
-	libtcod.console_flush()
+	#start an explosion, shown over the next frames while the game goes on
+	animations.append(Explosion(cx, cy, radius, inner_color, outer_color))
 
 
 def fade_effect(color, direction, forward_count=255, backwards_count=0):
 	"""
-	Set console color to COLOR based on 255 frames.
+	Start fading the screen to or from COLOR, shown over the next frames.
 	255 = solid color
 
 	:param color:
@@ -1684,24 +2558,34 @@ def fade_effect(color, direction, forward_count=255, backwards_count=0):
 		Direction to transition color:
 			0 = fade to color
 			1 = fade from color
-	:return:
-		Returns color value to console.
 	"""
 	if direction == 0:
-		while forward_count > backwards_count:
-			libtcod.console_set_fade(forward_count, color)
-			libtcod.console_flush()
-			forward_count -= 5
+		animations.append(Fade(color, forward_count, backwards_count))
 	elif direction == 1:
-		while backwards_count < forward_count:
-			libtcod.console_set_fade(backwards_count, color)
-			libtcod.console_flush()
-			backwards_count += 5
-			libtcod.console_set_fade(255, FADE_COLOR_TRANSITION)
+		animations.append(Fade(color, backwards_count, forward_count))
 	else:
 		print "DEBUG: Fade effect"
 
 
+def finish_animations(on_map=True):
+	#show the animations to the end, where the main loop doesn't draw them: in the menus (without the map),
+	#or before waiting for a key in turn-based mode
+	while animations and not libtcod.console_is_window_closed():
+		if on_map:
+			render_overlays()
+		else:
+			mark_overlays()
+		libtcod.console_flush()
+
+
+def skip_animations():
+	#end the animations at once
+	for animation in animations:
+		animation.skip()
+	del animations[:]
+	map_frame.marks = {}
+
+
 def is_in_view(x1, y1, x2, y2, facing):
 	delta_x = x1 - x2
 	delta_y = y1 - y2
@@ -1774,7 +2658,7 @@ def help_menu():
 
 	#present the root console to the player and wait for a key-press
 	libtcod.console_flush()
-	key = libtcod.console_wait_for_keypress(True)
+	key = wait_key()
 
 
 def npc_dialog():
@@ -1798,42 +2682,92 @@ def npc_dialog():
 
 	#present the root console to the player and wait for a key-press
 	libtcod.console_flush()
-	key = libtcod.console_wait_for_keypress(True)
+	key = wait_key()
 
 
 def save_game():
-	#open a new empty shelve (possibly overwriting an old one) to write the game data
+	#open a new empty shelve (possibly overwriting an old one) to write the game data. the level is saved
+	#the way the level store keeps it, without the FOV map, which is rebuilt from the tiles on loading
+	stored = StoredLevel(capture_level())
+	stored.fov_map = None  #still in use by the current level
 	file = shelve.open('savegame', 'n')
-	file['map'] = map
-	file['objects'] = objects
-	file['player_index'] = objects.index(player)  #index of player in objects list
+	file['level'] = stored
+	file['player'] = player
 	file['inventory'] = inventory
 	file['game_msgs'] = game_msgs
 	file['game_state'] = game_state
 	file['dungeon_level'] = dungeon_level
+	file['game_seed'] = game_seed
 	file.close()
 
 
 def load_game():
-	#open the p  objects, player, stairs, inventory, game_msgs, game_state
+	#read back the game saved by save_game(). other levels visited before saving are generated again
+	global player, inventory, game_msgs, game_state, dungeon_level, game_seed, game_rng
 
 	file = shelve.open('savegame', 'r')
-	map = file['map']
-	objects = file['objects']
-	player = objects[file['player_index']]  #get index of player in objects list and access it
+	if 'level' in file:
+		stored = file['level']
+		player = file['player']
+		game_seed = file['game_seed']
+	else:
+		(stored, player) = load_old_level(file)
+		game_seed = libtcod.random_get_int(0, 0, 0x7FFFFFFF)
 	inventory = file['inventory']
 	game_msgs = file['game_msgs']
 	game_state = file['game_state']
 	dungeon_level = file['dungeon_level']
 	file.close()
 
-	initialize_fov()
+	if isinstance(game_msgs, list):
+		#an old save, from when the messages were kept as a list of wrapped lines
+		(lines, game_msgs) = (game_msgs, MessageLog())
+		for (line, color) in lines:
+			game_msgs.add(line, color)
 
+	#the state of the RNG isn't saved, the rolls start over from the seed
+	if game_rng:
+		libtcod.random_delete(game_rng)
+	game_rng = libtcod.random_new_from_seed(game_seed)
 
-def new_game():
-	global player, inventory, game_msgs, game_state, num_directions, directions, facings, unit_directions
+	level_store.clear()
+	if current_level is not None:
+		libtcod.map_delete(current_level.fov_map)
+	enter_level(stored.restore())
+	pregenerate_level(dungeon_level + 1)
 
 
+def load_old_level(file):
+	#saves from before levels had seeds keep the tiles and the objects, player included, as they were.
+	#returns the level as save_game() stores it now, and the player. the game gets a new seed.
+	objects = file['objects']
+	player = objects.pop(file['player_index'])
+	map = file['map']
+	level = Level(len(map), len(map[0]))
+	level.depth = file['dungeon_level']
+	level.map = map
+	level.objects = objects
+	(level.player_x, level.player_y) = (player.x, player.y)
+	return (StoredLevel(level), player)
+
+
+def new_game(seed=None):
+	#start a new game. the levels and every roll of the game come from seed, a random one unless given
+	global player, inventory, game_msgs, game_state, num_directions, directions, facings, unit_directions
+	global game_seed, game_rng, game_tick, dungeon_level
+
+	game_seed = seed
+	if game_seed is None:
+		game_seed = libtcod.random_get_int(0, 0, 0x7FFFFFFF)
+	if game_rng:
+		libtcod.random_delete(game_rng)
+	game_rng = libtcod.random_new_from_seed(game_seed)
+	game_tick = 0
+	dungeon_level = DUNGEON_LEVEL
+	end_targeting()
+	if input_session is not None:
+		input_session.start(game_seed, {'tut': tut, 'turn_based': TURN_BASED})
+
 	#create object representing the player
 	fighter_component = Fighter(hp=100, defense=2, power=7, constitution=0, xp=0, death_function=player_death, move_speed=PLAYER_SPEED,
 								attack_speed=3, protected=0)
@@ -1842,15 +2776,18 @@ def new_game():
 
 
 
+	#forget the levels of any previous game
+	level_store.clear()
+
 	#generate map (at this point it's not drawn to the screen)
-	make_map()
-	initialize_fov()
+	enter_level(generate_level(dungeon_level, level_seed(dungeon_level)))
+	pregenerate_level(dungeon_level + 1)
 
 	game_state = 'playing'
 	inventory = []
 
 	#create the list of game messages and their colors, starts empty
-	game_msgs = []
+	game_msgs = MessageLog()
 
 	#a warm welcoming message!
 	message('You kick open the wizard fortress gates, your blade drawn.', libtcod.white)
@@ -1868,51 +2805,649 @@ def initialize_fov():
 	fov_recompute = True
 
 	#create the FOV map, according to the generated map
-	fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-	for y in range(MAP_HEIGHT):
-		for x in range(MAP_WIDTH):
-			libtcod.map_set_properties(fov_map, x, y, not map[x][y].blocked, not map[x][y].block_sight)
+	fov_map = new_fov_map(map)
 
 	libtcod.console_clear(con)  #unexplored areas start black (which is the default background color)
+	map_frame.invalidate()
 	libtcod.console_set_fade(255, libtcod.black)
 
 
+def new_fov_map(map):
+	#build a libtcod FOV map matching the given tiles
+	width = len(map)
+	height = len(map[0])
+	fov = libtcod.map_new(width, height)
+	for y in range(height):
+		for x in range(width):
+			libtcod.map_set_properties(fov, x, y, not map[x][y].blocked, not map[x][y].block_sight)
+	return fov
+
+
+class Level:
+	#a dungeon level: its tiles, the objects on it (except the player), the rooms it was built from
+	#and the FOV map built from the tiles
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		#walls as a byte plane, column by column (x * height + y). generators carve into it and
+		#build_tiles() turns it into the tile grid the game uses
+		self.blocked = bytearray(b'\x01') * (width * height)
+		self.map = None
+		self.objects = []
+		self.fov_map = None
+		self.player_x = 0
+		self.player_y = 0
+		self.depth = None
+		self.rooms = []
+		self.rng = 0
+		self.blockers = set()  #positions of blocking objects, kept while generating
+		self.regions = None  #RegionMap, once the level is generated
+		self.nav = None  #NavGraph, once the level is generated
+
+	def build_tiles(self):
+		h = self.height
+		blocked = self.blocked
+		self.map = [[Tile(blocked[x * h + y] == 1)
+					 for y in range(h)]
+					for x in range(self.width)]
+
+	def is_blocked(self, x, y):
+		#is_blocked() for a level being generated, which doesn't have to be the current one. the player's
+		#position on this level counts as blocked, objects only if they were added with add_object().
+		if self.blocked[x * self.height + y]:
+			return True
+
+		if x == self.player_x and y == self.player_y:
+			return True
+
+		return (x, y) in self.blockers
+
+	def add_object(self, obj, to_back=False):
+		#add a generated object. objects sent to the back are drawn below the others
+		if obj.blocks:
+			self.blockers.add((obj.x, obj.y))
+		if to_back:
+			self.objects.insert(0, obj)
+		else:
+			self.objects.append(obj)
+
+
+class RegionMap:
+	#labels the 8-connected regions of walkable tiles, so whether one tile can be reached from another is a
+	#lookup instead of a search. walls and blocking features (rubble, idols...) separate regions; monsters
+	#move every turn, so they don't count. features are only placed while generating, before the labels are
+	#made; unblock() keeps them right when repair_level() takes one away. tiles are indexed like Level.blocked
+	#(x * height + y).
+	def __init__(self, width, height, blocked, objects=()):
+		self.width = width
+		self.height = height
+		self.blocked = blocked
+		self.walls = bytearray(blocked)
+		for obj in objects:
+			if obj.blocks and not obj.fighter:
+				self.walls[obj.x * height + obj.y] = 1
+
+		self.labels = [0] * (width * height)  #0 for walls
+		self.regions = {}  #label -> indices of the tiles of that region
+		self.next_label = 1
+		for i in range(width * height):
+			if not self.walls[i] and not self.labels[i]:
+				self.flood(i)
+
+	def flood(self, start):
+		#give the region around the tile start a new label
+		(labels, walls, width, height) = (self.labels, self.walls, self.width, self.height)
+		label = self.next_label
+		self.next_label += 1
+
+		labels[start] = label
+		tiles = [start]
+		for i in tiles:  #the list grows as the flood spreads
+			(x, y) = divmod(i, height)
+			for nx in (x - 1, x, x + 1):
+				if nx < 0 or nx >= width:
+					continue
+				for ny in (y - 1, y, y + 1):
+					if ny < 0 or ny >= height:
+						continue
+					j = nx * height + ny
+					if not walls[j] and not labels[j]:
+						labels[j] = label
+						tiles.append(j)
+		self.regions[label] = tiles
+		return label
+
+	def region_at(self, x, y):
+		#label of the region (x, y) is in, 0 for walls, features and tiles outside the map
+		if x < 0 or y < 0 or x >= self.width or y >= self.height:
+			return 0
+		return self.labels[x * self.height + y]
+
+	def same_region(self, a, b):
+		#true if the tiles a and b, given as (x, y), are walkable and connected
+		region = self.region_at(a[0], a[1])
+		return region != 0 and region == self.region_at(b[0], b[1])
+
+	def region_tiles(self, region):
+		#the (x, y) of every tile of a region
+		return [divmod(i, self.height) for i in self.regions[region]]
+
+	def neighbour_regions(self, x, y):
+		regions = set()
+		for nx in (x - 1, x, x + 1):
+			for ny in (y - 1, y, y + 1):
+				regions.add(self.region_at(nx, ny))
+		regions.discard(0)
+		return regions
+
+	def unblock(self, x, y):
+		#a blocking feature at (x, y) went away, joining the regions around it
+		i = x * self.height + y
+		if not self.walls[i] or self.blocked[i]:
+			return
+		self.walls[i] = 0
+		regions = self.neighbour_regions(x, y)
+		if not regions:
+			self.flood(i)
+			return
+
+		#relabel the smaller regions as the biggest one
+		biggest = max(regions, key=lambda region: len(self.regions[region]))
+		tiles = self.regions[biggest]
+		self.labels[i] = biggest
+		tiles.append(i)
+		for region in regions:
+			if region != biggest:
+				for j in self.regions[region]:
+					self.labels[j] = biggest
+				tiles.extend(self.regions.pop(region))
+
+
+def unreachable_objects(level):
+	#monsters and items of a level that can't be reached from where the player starts
+	start = (level.player_x, level.player_y)
+	return [obj for obj in level.objects
+			if (obj.fighter or obj.item or obj.equipment) and not level.regions.same_region(start, (obj.x, obj.y))]
+
+
+def repair_level(level):
+	#remove features that seal off parts of the level, until everything can be reached or no feature
+	#between the player's region and the rest is left
+	regions = level.regions
+	while unreachable_objects(level):
+		home = regions.region_at(level.player_x, level.player_y)
+		for obj in level.objects:
+			if not obj.blocks or obj.fighter:
+				continue
+			around = regions.neighbour_regions(obj.x, obj.y)
+			if home in around and (len(around) > 1 or feature_next_to(level, obj)):
+				break
+		else:
+			return
+		level.objects.remove(obj)
+		level.blockers.discard((obj.x, obj.y))
+		regions.unblock(obj.x, obj.y)
+
+
+def feature_next_to(level, feature):
+	#true if another blocking feature touches this one
+	for obj in level.objects:
+		if obj is not feature and obj.blocks and not obj.fighter and abs(obj.x - feature.x) <= 1 and abs(obj.y - feature.y) <= 1:
+			return True
+	return False
+
+
+def same_region(a, b):
+	#true if the tiles a and b, given as (x, y), are connected on the current level
+	return current_level.regions.same_region(a, b)
+
+
+class NavGraph:
+	#the rooms of a level as a graph, for routing monsters across the level without searching it tile by tile.
+	#every walkable tile belongs to the room whose center is the fewest steps away (one breadth-first pass
+	#from all the centers at once) and knows the next tile on its way to that center. two rooms are joined
+	#where their tiles meet, usually in the corridor between them. rooms are the indices of level.rooms.
+	def __init__(self, level):
+		(width, height) = (level.width, level.height)
+		self.height = height
+		walls = level.regions.walls
+		size = width * height
+		self.owner = [-1] * size  #room each tile belongs to, -1 for walls
+		self.parent = [-1] * size  #next tile towards the center of the owner, -1 for the centers
+		self.steps = [0] * size  #steps to the center of the owner
+		self.edges = [{} for room in level.rooms]  #room -> {neighbour room: (length, tile of room, tile of neighbour)}
+		self.doorways = [[] for room in level.rooms]  #room -> corridor tiles just outside it, as (x, y)
+		self.hops = {}  #cached rows of the next-hop table, see next_hop()
+
+		(owner, parent, steps, edges) = (self.owner, self.parent, self.steps, self.edges)
+		inside = bytearray(size)
+		queue = []
+		for (room, rect) in enumerate(level.rooms):
+			tiles = [x * height + y for (x, y) in rect.tiles()]
+			for i in tiles:
+				inside[i] = 1
+			#start from the center, or any free tile if a feature stands there
+			(x, y) = rect.center()
+			free = [i for i in [x * height + y] + tiles if not walls[i]]
+			if free:
+				owner[free[0]] = room
+				queue.append(free[0])
+
+		for i in queue:  #the list grows as the search spreads
+			(x, y) = divmod(i, height)
+			room = owner[i]
+			step = steps[i] + 1
+			for nx in (x - 1, x, x + 1):
+				if nx < 0 or nx >= width:
+					continue
+				for ny in (y - 1, y, y + 1):
+					if ny < 0 or ny >= height:
+						continue
+					j = nx * height + ny
+					if walls[j]:
+						continue
+					other = owner[j]
+					if other == -1:
+						owner[j] = room
+						parent[j] = i
+						steps[j] = step
+						queue.append(j)
+						if inside[i] and not inside[j]:
+							self.doorways[room].append((nx, ny))
+					elif other != room:
+						#the corridors of two rooms meet here, keep the shortest way between them
+						length = step + steps[j]
+						if other not in edges[room] or length < edges[room][other][0]:
+							edges[room][other] = (length, i, j)
+							edges[other][room] = (length, j, i)
+
+	def room_at(self, x, y):
+		#room the tile belongs to, -1 for walls
+		return self.owner[x * self.height + y]
+
+	def next_hop(self, source, target):
+		#the room to go to next on the shortest way from the room source to the room target, None if target
+		#can't be reached. a row of the table is made the first time a room is a target, with Dijkstra's
+		#algorithm from that room, and kept for the other monsters heading there.
+		if target not in self.hops:
+			hops = [None] * len(self.edges)
+			distance = {target: 0}
+			queue = [(0, target)]
+			while queue:
+				(length, room) = heapq.heappop(queue)
+				if length > distance[room]:
+					continue
+				for (other, edge) in self.edges[room].items():
+					if other not in distance or length + edge[0] < distance[other]:
+						distance[other] = length + edge[0]
+						hops[other] = room
+						heapq.heappush(queue, (distance[other], other))
+			self.hops[target] = hops
+		return self.hops[target][source]
+
+	def way_out(self, i):
+		#the tiles from tile i to the center of its room
+		tiles = [i]
+		while self.parent[i] != -1:
+			i = self.parent[i]
+			tiles.append(i)
+		return tiles
+
+	def route(self, x1, y1, x2, y2):
+		#waypoints from (x1, y1) to (x2, y2), through the center of every room on the way. only the tiles
+		#where the way turns are kept, so walking straight at each waypoint in turn follows it. empty if
+		#there is no way.
+		(start, end) = (x1 * self.height + y1, x2 * self.height + y2)
+		(room, target) = (self.owner[start], self.owner[end])
+		if room == -1 or target == -1:
+			return []
+
+		tiles = self.way_out(start)
+		while room != target:
+			next = self.next_hop(room, target)
+			if next is None:
+				return []
+			(length, i, j) = self.edges[room][next]
+			tiles.extend(reversed(self.way_out(i)))
+			tiles.extend(self.way_out(j))
+			room = next
+		tiles.extend(reversed(self.way_out(end)))
+
+		points = [divmod(i, self.height) for i in tiles]
+		route = []
+		for k in range(len(points)):
+			if 0 < k < len(points) - 1:
+				(x, y) = points[k]
+				if (x - points[k - 1][0], y - points[k - 1][1]) == (points[k + 1][0] - x, points[k + 1][1] - y):
+					continue  #in the middle of a straight stretch
+			if not route or route[-1] != points[k]:
+				route.append(points[k])
+		return route
+
+
+def find_route(x1, y1, x2, y2):
+	#waypoints across the current level, see NavGraph.route()
+	return current_level.nav.route(x1, y1, x2, y2)
+
+
+class LevelGenerator:
+	#generates a level in a background thread, so it is ready by the time the player gets there
+	def __init__(self, depth, seed):
+		self.depth = depth
+		self.seed = seed
+		self.level = None
+		self.abandoned = False
+		self.lock = threading.Lock()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		level = generate_level(self.depth, self.seed)
+		self.lock.acquire()
+		try:
+			if self.abandoned:
+				libtcod.map_delete(level.fov_map)
+			else:
+				self.level = level
+		finally:
+			self.lock.release()
+
+	def take(self):
+		#return the generated level. if the thread isn't done yet, generate it right now from the same seed
+		#instead of waiting, which gives the same level.
+		level = self.level
+		if level is None:
+			self.abandon()
+			return generate_level(self.depth, self.seed)
+		self.level = None  #it belongs to the game now
+		return level
+
+	def abandon(self):
+		#nobody is going to take the level, free its FOV map now or when the thread is done with it
+		self.lock.acquire()
+		try:
+			self.abandoned = True
+			if self.level is not None:
+				libtcod.map_delete(self.level.fov_map)
+				self.level = None
+		finally:
+			self.lock.release()
+
+
+def pack_tiles(map):
+	#flatten the tiles into three byte planes (blocked, block_sight, explored), column by column
+	blocked = bytearray(tile.blocked for column in map for tile in column)
+	block_sight = bytearray(tile.block_sight for column in map for tile in column)
+	explored = bytearray(tile.explored for column in map for tile in column)
+	return str(blocked + block_sight + explored)
+
+
+def unpack_tiles(data, width, height):
+	#rebuild the tiles from the planes written by pack_tiles()
+	planes = bytearray(data)
+	size = width * height
+	map = []
+	for x in range(width):
+		column = []
+		for y in range(height):
+			i = x * height + y
+			tile = Tile(bool(planes[i]), bool(planes[size + i]))
+			tile.explored = bool(planes[2 * size + i])
+			column.append(tile)
+		map.append(column)
+	return map
+
+
+class StoredLevel:
+	#a level compressed for the level store. the FOV map is kept alive while the level is held in memory,
+	#so restoring it only has to unpack the tiles and objects.
+	def __init__(self, level):
+		self.width = level.width
+		self.height = level.height
+		self.depth = level.depth
+		self.tiles = zlib.compress(pack_tiles(level.map))
+		self.entities = zlib.compress(cPickle.dumps((level.objects, level.rooms), cPickle.HIGHEST_PROTOCOL))
+		self.fov_map = level.fov_map
+		self.player_x = level.player_x
+		self.player_y = level.player_y
+
+	def size(self):
+		#approximate memory held by this level, counting one byte per FOV map property
+		size = len(self.tiles) + len(self.entities)
+		if self.fov_map is not None:
+			size += self.width * self.height * 3
+		return size
+
+	def release_fov(self):
+		#free the FOV map, it will be rebuilt from the tiles when the level is restored
+		if self.fov_map is not None:
+			libtcod.map_delete(self.fov_map)
+			self.fov_map = None
+
+	def restore(self):
+		level = Level(self.width, self.height)
+		level.depth = self.depth
+		tiles = zlib.decompress(self.tiles)
+		level.blocked = bytearray(tiles[:self.width * self.height])
+		level.map = unpack_tiles(tiles, self.width, self.height)
+		(level.objects, level.rooms) = cPickle.loads(zlib.decompress(self.entities))
+		(level.player_x, level.player_y) = (self.player_x, self.player_y)
+		level.regions = RegionMap(level.width, level.height, level.blocked, level.objects)
+		level.nav = NavGraph(level)
+
+		level.fov_map = self.fov_map
+		if level.fov_map is None:
+			level.fov_map = new_fov_map(level.map)
+		self.fov_map = None  #the restored level owns it now
+		return level
+
+
+class LevelStore:
+	#keeps recently visited levels, most recently used last. when more than max_levels are held, or they take
+	#more than memory_budget bytes, the least recently used ones are written to disk and read back on demand.
+	def __init__(self, max_levels=LEVEL_CACHE_SIZE, memory_budget=LEVEL_CACHE_BUDGET, directory=LEVEL_CACHE_DIR):
+		self.max_levels = max_levels
+		self.memory_budget = memory_budget
+		self.directory = directory
+		self.levels = collections.OrderedDict()
+		self.on_disk = set()
+		self.memory_used = 0
+
+	def __contains__(self, depth):
+		return depth in self.levels or depth in self.on_disk
+
+	def put(self, depth, level):
+		self.discard(depth)
+		stored = StoredLevel(level)
+		self.levels[depth] = stored
+		self.memory_used += stored.size()
+		self.evict()
+
+	def get(self, depth):
+		#return the level at this depth and remove it from the store, or None if it isn't stored
+		if depth in self.levels:
+			stored = self.levels.pop(depth)
+			self.memory_used -= stored.size()
+			return stored.restore()
+		if depth in self.on_disk:
+			self.on_disk.remove(depth)
+			path = self.path(depth)
+			file = open(path, 'rb')
+			try:
+				stored = cPickle.load(file)
+			finally:
+				file.close()
+			os.remove(path)
+			return stored.restore()
+		return None
+
+	def discard(self, depth):
+		if depth in self.levels:
+			stored = self.levels.pop(depth)
+			self.memory_used -= stored.size()
+			stored.release_fov()
+		if depth in self.on_disk:
+			self.on_disk.remove(depth)
+			os.remove(self.path(depth))
+
+	def evict(self):
+		#write the least recently used levels to disk until the store is within its limits
+		while self.levels and (len(self.levels) > self.max_levels or self.memory_used > self.memory_budget):
+			depth, stored = self.levels.popitem(last=False)
+			self.memory_used -= stored.size()
+			stored.release_fov()
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			file = open(self.path(depth), 'wb')
+			try:
+				cPickle.dump(stored, file, cPickle.HIGHEST_PROTOCOL)
+			finally:
+				file.close()
+			self.on_disk.add(depth)
+
+	def clear(self):
+		for depth in list(self.levels) + list(self.on_disk):
+			self.discard(depth)
+
+	def path(self, depth):
+		return os.path.join(self.directory, 'level' + str(depth) + '.dat')
+
+
+level_store = LevelStore()
+current_level = None  #the Level the player is on, see enter_level()
+
+
+def capture_level():
+	#bring the current level up to date with the game so it can be put in the level store
+	level = current_level
+	level.objects = [obj for obj in objects if obj != player]
+	(level.player_x, level.player_y) = (player.x, player.y)
+	return level
+
+
+def enter_level(level):
+	#make the given level the current one and put the player on it
+	global current_level, map, objects, fov_map, fov_recompute, object_index
+	current_level = level
+	map = level.map
+	objects = [player] + level.objects
+	fov_map = level.fov_map
+	(player.x, player.y) = (level.player_x, level.player_y)
+	object_index = SpatialIndex(objects)
+
+	fov_recompute = True
+	skip_animations()
+	libtcod.console_clear(con)
+	map_frame.invalidate()
+	libtcod.console_set_fade(255, libtcod.black)
+
+
+def change_level(depth):
+	#leave the current level for the one at the given depth. recently visited levels are restored
+	#from the level store, the next level down is usually generated in the background already.
+	global dungeon_level
+	level_store.put(dungeon_level, capture_level())
+	dungeon_level = depth
+
+	level = level_store.get(depth)
+	if level is None:
+		if next_level is not None and next_level.depth == depth:
+			level = next_level.take()
+		else:
+			level = generate_level(depth, level_seed(depth))
+	enter_level(level)
+	pregenerate_level(depth + 1)
+
+
+def pregenerate_level(depth):
+	#start generating the level at the given depth in the background, unless it was visited already
+	global next_level
+	if next_level is not None:
+		next_level.abandon()
+	next_level = None
+	if depth not in level_store:
+		next_level = LevelGenerator(depth, level_seed(depth))
+
+
+next_level = None
+
+
 def play_game():
-	global camera_x, camera_y, fov_recompute
+	global camera_x, camera_y, fov_recompute, game_tick
 
 	player_action = None
 	(camera_x, camera_y) = (0, 0)
 
 	while not libtcod.console_is_window_closed():
+		game_tick += 1
+		if input_session is not None:
+			input_session.tick(game_tick)
 
 		#handle keys and exit game if needed
 		if player.fighter.tick == 0:  #only do these things if it's the player's turn to move so there's not needless busy work
-
-			#render the screen
-			render_all()
-			libtcod.console_flush()
-			check_level_up()
-
-			player_action = handle_keys()
-			if player_action == 'exit':
-				save_game()
-				break
+			if TURN_BASED and game_state == 'playing' and player.wait > 0:
+				#still recovering from the last action, as in handle_keys() but with no key to read
+				player.wait -= 1
+				fov_recompute = True
+			else:
+				player_action = player_turn()
+				if player_action == 'exit':
+					save_game()
+					break
 		else:
 			player.fighter.tick = player.fighter.tick - 1
 
 		#let monsters take their turn
 		if game_state == 'playing':
-			for object in objects:
-				if object.ai:
-					if object.fighter.tick == 0:
-						#RENDER LOOP
-						if object.wait > 0:
-							object.wait -= 1
-						else:
-							object.ai.take_turn()
-							fov_recompute = True
-					else:
-						object.fighter.tick -= 1
+			take_ai_turns()
+		mark_startup('first_tick')
+
+	if input_session is not None:
+		input_session.stop(game_tick)
+
+
+def player_turn():
+	#draw the screen and let the player act. in turn-based mode this is repeated, without the game ticking,
+	#until the player does something that takes time
+	while True:
+		poll_input()
+		if (targeting is not None or animations) and not fov_recompute:
+			render_overlays()
+		else:
+			render_all()
+		libtcod.console_flush()
+		mark_startup('first_frame')
+		if call_counter is not None:
+			call_counter.end_frame()
+		check_level_up()
+
+		player_action = handle_keys()
+		if not TURN_BASED or player_action != 'didnt-take-turn' or libtcod.console_is_window_closed():
+			return player_action
+
+
+def state_hash():
+	#checksum of where everything is and how it's doing, compared at the checkpoints of a replay
+	state = [dungeon_level, game_state, player.fighter.souls, player.fighter.xp, [obj.name for obj in inventory]]
+	for obj in objects:
+		state.append((obj.name, obj.x, obj.y, obj.fighter and obj.fighter.hp))
+	return zlib.crc32(repr(state)) & 0xFFFFFFFF
+
+
+def take_ai_turns():
+	global fov_recompute
+	for object in objects:
+		if object.ai:
+			if object.fighter.tick == 0:
+				#RENDER LOOP
+				if object.wait > 0:
+					object.wait -= 1
+				else:
+					object.ai.take_turn()
+					fov_recompute = True
+			else:
+				object.fighter.tick -= 1
 
 
 def main_menu():
@@ -1931,6 +3466,7 @@ def main_menu():
 
 		if choice == 0:  #new game
 			fade_effect(FADE_COLOR_TRANSITION, 0)
+			finish_animations(False)
 			new_game()
 			play_game()
 		if choice == 1:  #load last game
@@ -1944,12 +3480,47 @@ def main_menu():
 			break
 
 
-libtcod.console_set_custom_font('Ruterminal_8x8_gs_tc.png', libtcod.FONT_LAYOUT_TCOD | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'POWERLORD', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-panel_bottom = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-panel_story = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-main_menu()
+def init_window(title='POWERLORD', fps=LIMIT_FPS):
+	#open the root console and make the consoles the game draws on. importing the module doesn't load
+	#libtcod, this is the first call into it
+	global con, panel, panel_bottom, panel_story
+	libtcod.console_set_custom_font('Ruterminal_8x8_gs_tc.png', libtcod.FONT_LAYOUT_TCOD | libtcod.FONT_LAYOUT_TCOD)
+	libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, title, False)
+	libtcod.sys_set_fps(fps)
+	con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+	panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+	panel_bottom = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+	panel_story = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+	mark_startup('window')
+
+
+def main():
+	#run the game with the settings above
+	global combat_log, call_counter, input_session
+	init_window()
+	if COMBAT_LOG:
+		combat_log = combatlog.CombatLog(COMBAT_LOG, COMBAT_LOG_MAX_BYTES, COMBAT_LOG_BACKUPS)
+	if PROFILE:
+		start_profiler()
+	if COUNT_LIBTCOD_CALLS:
+		call_counter = libtcod.call_counter_enable(os.path.basename(__file__))
+	if RECORD_INPUT:
+		input_session = replay.Recorder(RECORD_INPUT, state_hash, REPLAY_CHECKPOINT)
+	main_menu()
+	if frame_profiler is not None:
+		stop_profiler()
+	if input_session is not None:
+		input_session.close()
+	if call_counter is not None:
+		libtcod.call_counter_disable()
+		call_counter.dump(LIBTCOD_CALLS_FILE)
+		print call_counter.summary()
+	if combat_log is not None:
+		combat_log.close()
+
+
+mark_startup('import')
+
+#only open the window when run as the game, so tools (and multiprocessing workers) can import the module
+if __name__ == '__main__':
+	main()
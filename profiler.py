@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# POWERLORD frame profiler
+#
+# Times named phases of a frame by wrapping the functions that run them. Nothing is wrapped until
+# the profiler is enabled, so a game running without it pays nothing. Example:
+#
+#   prof = profiler.FrameProfiler()
+#   prof.wrap(powerlord, 'render_tiles', 'tiles')
+#   ...
+#   print prof.percentile('tiles', 95)
+#   prof.dump('profile.json')
+
+import json
+import time
+import collections
+
+WINDOW = 240  #samples kept per phase for the rolling percentiles
+
+
+class FrameProfiler:
+	#phases can nest (the tile pass computes the FOV, for one), each is timed on its own
+	def __init__(self, window=WINDOW):
+		self.window = window
+		self.samples = {}  #phase -> deque of the latest durations, in seconds
+		self.totals = {}  #phase -> [calls, total seconds, longest], for the whole run
+		self.wrapped = []  #(object, attribute, original function)
+		self.started = time.time()
+
+	def add(self, phase, seconds):
+		if phase not in self.samples:
+			self.samples[phase] = collections.deque(maxlen=self.window)
+			self.totals[phase] = [0, 0.0, 0.0]
+		self.samples[phase].append(seconds)
+		total = self.totals[phase]
+		total[0] += 1
+		total[1] += seconds
+		if seconds > total[2]:
+			total[2] = seconds
+
+	def wrap(self, owner, name, phase=None):
+		#replace owner.name (a function of a module or class) with one that times each call as phase
+		function = getattr(owner, name)
+		phase = phase or name
+		add = self.add
+		clock = time.time
+
+		def timed(*args, **kwargs):
+			start = clock()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				add(phase, clock() - start)
+
+		timed.__name__ = function.__name__
+		setattr(owner, name, timed)
+		self.wrapped.append((owner, name, function))
+
+	def unwrap(self):
+		#put the original functions back
+		for (owner, name, function) in reversed(self.wrapped):
+			setattr(owner, name, function)
+		self.wrapped = []
+
+	def percentile(self, phase, percent):
+		#duration in milliseconds that percent of the latest calls of phase stayed under
+		samples = sorted(self.samples.get(phase, ()))
+		if not samples:
+			return 0.0
+		i = min(len(samples) - 1, int(len(samples) * percent / 100.0))
+		return samples[i] * 1000
+
+	def phases(self):
+		return sorted(self.samples)
+
+	def report(self):
+		#summary of every phase: calls, mean, longest and the rolling percentiles, in milliseconds
+		report = {}
+		for phase in self.phases():
+			(calls, total, longest) = self.totals[phase]
+			report[phase] = {
+				'calls': calls,
+				'mean_ms': total * 1000 / calls,
+				'max_ms': longest * 1000,
+				'p50_ms': self.percentile(phase, 50),
+				'p95_ms': self.percentile(phase, 95),
+				'p99_ms': self.percentile(phase, 99),
+			}
+		return report
+
+	def dump(self, path):
+		f = open(path, 'w')
+		try:
+			json.dump({'seconds': time.time() - self.started, 'phases': self.report()}, f, indent=1, sort_keys=True)
+		finally:
+			f.close()
@@ -0,0 +1,328 @@
+#!/usr/bin/python
+#
+# POWERLORD input recording and replay
+#
+# A Recorder writes down the seed of every new game and each key press and mouse change the game logic
+# reads, tagged with the game tick, plus a checksum of the game state every few ticks. A Replayer hands
+# them back to the game in the same order, so it plays out the same way again, as fast as it can go
+# without a player to wait for, and compares the checksums on the way. Example:
+#
+#   set RECORD_INPUT = 'session.rec' in powerlord.py and play a game
+#   python replay.py session.rec                #replay without drawing, print the timings as JSON
+#   python replay.py session.rec --render 10    #draw every 10th frame
+#
+# A replay needs the code and settings the game was recorded with. A change in the game logic shows up
+# as a checksum mismatch at the first checkpoint after it, which stops the replay.
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import argparse
+import tempfile
+import collections
+
+import libtcodpy as libtcod
+
+KEY_FIELDS = [field[0] for field in libtcod.Key._fields_]
+MOUSE_FIELDS = [field[0] for field in libtcod.Mouse._fields_]
+
+#a recording holds one JSON array per line:
+#  ['game', seed, checkpoint interval, state]  a new game, state is what the game needs to start the same way
+#  ['key', tick, call, vk, c, ...]             a key from check_for_keypress() call number call, by KEY_FIELDS
+#  ['wait', tick, call, vk, c, ...]            a key from wait_for_keypress()
+#  ['mouse', tick, call, x, y, ...]            the mouse state when it changed, by MOUSE_FIELDS
+#  ['check', tick, checksum]                   the state checksum at the start of a tick
+#  ['end', tick, key calls, wait calls, mouse calls]
+INPUTS = ['key', 'wait', 'mouse']
+
+
+def fields(structure, names):
+	return [getattr(structure, name) for name in names]
+
+
+class ReplayDiverged(Exception):
+	#the replayed game stopped doing what the recorded one did
+	pass
+
+
+class Recorder:
+	#records the games started while it is the game's input_session. every new game starts the file over.
+	def __init__(self, path, state_hash, checkpoint=100):
+		self.path = path
+		self.state_hash = state_hash
+		self.checkpoint = checkpoint
+		self.file = None
+		self.calls = dict.fromkeys(INPUTS, 0)
+		self.mouse = None
+
+	def start(self, seed, state):
+		self.close()
+		self.file = open(self.path, 'wb')
+		self.calls = dict.fromkeys(INPUTS, 0)
+		self.mouse = None
+		self.write(['game', seed, self.checkpoint, state])
+
+	def write(self, record):
+		if self.file is not None:
+			self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+	def check_for_keypress(self, tick, flags):
+		key = libtcod.console_check_for_keypress(flags)
+		if key.vk != libtcod.KEY_NONE:  #most calls find no key, only the keys are written
+			self.write(['key', tick, self.calls['key']] + fields(key, KEY_FIELDS))
+		self.calls['key'] += 1
+		return key
+
+	def wait_for_keypress(self, tick, flush=True):
+		key = libtcod.console_wait_for_keypress(flush)
+		self.write(['wait', tick, self.calls['wait']] + fields(key, KEY_FIELDS))
+		self.calls['wait'] += 1
+		return key
+
+	def mouse_get_status(self, tick):
+		mouse = libtcod.mouse_get_status()
+		state = fields(mouse, MOUSE_FIELDS)
+		if state != self.mouse:
+			self.write(['mouse', tick, self.calls['mouse']] + state)
+			self.mouse = state
+		self.calls['mouse'] += 1
+		return mouse
+
+	def tick(self, tick):
+		if self.file is not None and tick % self.checkpoint == 0:
+			self.write(['check', tick, self.state_hash()])
+
+	def stop(self, tick):
+		#the game is over, or the player quit to the menu
+		if self.file is not None:
+			self.write(['end', tick] + [self.calls[kind] for kind in INPUTS])
+			self.close()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+
+class Replayer:
+	#plays a recording back as the game's input_session. once everything recorded was played back, the next
+	#key asked for is Escape, which ends the game.
+	def __init__(self, path, state_hash):
+		self.state_hash = state_hash
+		self.seed = None
+		self.state = {}
+		self.events = dict((kind, collections.deque()) for kind in INPUTS)
+		self.checks = {}  #tick -> checksum
+		self.end = None
+
+		f = open(path, 'rb')
+		try:
+			for line in f:
+				record = json.loads(line)
+				if record[0] == 'game':
+					(self.seed, self.checkpoint, self.state) = record[1:]
+				elif record[0] == 'check':
+					self.checks[record[1]] = record[2]
+				elif record[0] == 'end':
+					self.end = dict(zip(INPUTS, record[2:]))
+				else:
+					self.events[record[0]].append(record)
+		finally:
+			f.close()
+		if self.seed is None:
+			raise ValueError('No game recorded in ' + path)
+
+		self.calls = dict.fromkeys(INPUTS, 0)
+		self.mouse = libtcod.Mouse()
+		self.replayed = 0  #events handed to the game
+		self.checked = 0  #checkpoints passed
+
+	def start(self, seed, state):
+		if seed != self.seed:
+			raise ReplayDiverged('the game was started with seed %d, the recording with seed %d' % (seed, self.seed))
+
+	def next_event(self, kind, tick):
+		#the values recorded for this call, None if nothing was
+		call = self.calls[kind]
+		self.calls[kind] += 1
+		events = self.events[kind]
+		if not events or events[0][2] != call:
+			return None
+		event = events.popleft()
+		if event[1] != tick:
+			raise ReplayDiverged('%s call %d came at tick %d, it was recorded at tick %d' % (kind, call, tick, event[1]))
+		self.replayed += 1
+		return event[3:]
+
+	def out_of_input(self, kind):
+		#true once the game asks for more input than was recorded
+		if any(self.events.values()):
+			return False
+		return self.end is None or self.calls[kind] > self.end[kind]
+
+	def check_for_keypress(self, tick, flags):
+		values = self.next_event('key', tick)
+		if values is not None:
+			return libtcod.Key(*values)
+		if self.out_of_input('key'):
+			return libtcod.Key(libtcod.KEY_ESCAPE, 0, 1)
+		return libtcod.Key()
+
+	def wait_for_keypress(self, tick, flush=True):
+		values = self.next_event('wait', tick)
+		if values is not None:
+			return libtcod.Key(*values)
+		if self.out_of_input('wait'):
+			return libtcod.Key(libtcod.KEY_ESCAPE, 0, 1)
+		raise ReplayDiverged('the game waited for a key at tick %d that was not recorded' % tick)
+
+	def mouse_get_status(self, tick):
+		values = self.next_event('mouse', tick)
+		if values is not None:
+			self.mouse = libtcod.Mouse(*values)
+		return self.mouse
+
+	def tick(self, tick):
+		if tick in self.checks:
+			checksum = self.state_hash()
+			if checksum != self.checks[tick]:
+				raise ReplayDiverged('the state at tick %d is %08x, it was recorded as %08x' % (tick, checksum, self.checks[tick]))
+			self.checked += 1
+
+	def stop(self, tick):
+		pass
+
+	def close(self):
+		pass
+
+
+def draw_sampled(game, every):
+	#make the game draw only every every-th frame, or none with 0. the frames in between only move the camera
+	#and update the FOV, which the game logic needs, and the spell and death animations aren't started.
+	#returns (owner, name, original) for every function replaced.
+	replaced = [(game, 'render_all', game.render_all), (game, 'render_overlays', game.render_overlays),
+				(libtcod, 'console_flush', libtcod.console_flush),
+				(game, 'explosion_effect', game.explosion_effect), (game, 'fade_effect', game.fade_effect)]
+	(render_all, render_overlays, console_flush) = (game.render_all, game.render_overlays, libtcod.console_flush)
+	frames = [0, False]  #frames so far, whether the last one was drawn
+
+	def sampled_render_all():
+		frames[0] += 1
+		frames[1] = every > 0 and frames[0] % every == 0
+		if frames[1]:
+			game.fov_recompute = True
+			render_all()
+		else:
+			game.update_view()
+
+	def sampled_render_overlays():
+		frames[0] += 1
+		frames[1] = every > 0 and frames[0] % every == 0
+		if frames[1]:
+			render_overlays()
+
+	def sampled_console_flush():
+		if frames[1]:
+			frames[1] = False
+			console_flush()
+
+	def explosion_effect(cx, cy, radius, inner_color, outer_color):
+		pass
+
+	def fade_effect(color, direction, forward_count=255, backwards_count=0):
+		pass
+
+	game.render_all = sampled_render_all
+	game.render_overlays = sampled_render_overlays
+	libtcod.console_flush = sampled_console_flush
+	game.explosion_effect = explosion_effect
+	game.fade_effect = fade_effect
+	return replaced
+
+
+def run(game, path, render_every=0):
+	#replay a recording with the game module, whose consoles must be set up (see bench.init_headless()),
+	#drawing every render_every-th frame. returns the timings.
+	session = Replayer(path, game.state_hash)
+	replaced = []
+	if render_every != 1:
+		replaced = draw_sampled(game, render_every)
+	game.input_session = session
+	game.tut = session.state.get('tut', True)
+	game.TURN_BASED = session.state.get('turn_based', False)
+	clock = timeit.default_timer
+	try:
+		start = clock()
+		game.new_game(session.seed)
+		game.play_game()
+		elapsed = clock() - start
+	finally:
+		game.input_session = None
+		for (owner, name, function) in reversed(replaced):
+			setattr(owner, name, function)
+
+	return {
+		'recording': path,
+		'seed': session.seed,
+		'render_every': render_every,
+		'ticks': game.game_tick,
+		'events': session.replayed,
+		'checkpoints': session.checked,
+		'complete': not any(session.events.values()),
+		'seconds': elapsed,
+		'ticks_per_s': game.game_tick / max(elapsed, 1e-9),
+	}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Replay a recorded POWERLORD game without a window.')
+	parser.add_argument('recording', help='file written with RECORD_INPUT')
+	parser.add_argument('--render', type=int, default=0, metavar='N',
+						help='draw every Nth frame, 0 for none (default 0)')
+	parser.add_argument('--repeat', type=int, default=1, help='times to replay it (default 1)')
+	parser.add_argument('--output', default=None, help='file to write the results to (default: stdout)')
+	args = parser.parse_args(argv)
+
+	import powerlord
+	import bench
+
+	recording = os.path.abspath(args.recording)
+	output = args.output and os.path.abspath(args.output)
+	bench.init_headless()
+	#the game saves when it ends, keep that out of the game directory
+	home = os.getcwd()
+	directory = tempfile.mkdtemp(prefix='powerlord-replay')
+	os.chdir(directory)
+	results = []
+	status = 0
+	try:
+		for i in range(args.repeat):
+			try:
+				result = run(powerlord, recording, args.render)
+			except ReplayDiverged, e:
+				results.append({'recording': recording, 'diverged': str(e), 'ticks': powerlord.game_tick})
+				sys.stderr.write('replay diverged: %s\n' % e)
+				status = 1
+				break
+			sys.stderr.write('%d ticks in %.2fs: %.0f ticks/s, %d checkpoints passed\n' % (
+				result['ticks'], result['seconds'], result['ticks_per_s'], result['checkpoints']))
+			results.append(result)
+		bench.finish_pregeneration()
+	finally:
+		os.chdir(home)
+		shutil.rmtree(directory, ignore_errors=True)
+
+	out = sys.stdout
+	if output:
+		out = open(output, 'w')
+	json.dump(results, out, indent=1, sort_keys=True)
+	out.write('\n')
+	if out is not sys.stdout:
+		out.close()
+	return status
+
+
+if __name__ == '__main__':
+	sys.exit(main())
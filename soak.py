@@ -0,0 +1,450 @@
+#!/usr/bin/python
+#
+# POWERLORD soak test
+#
+# Plays many seeded games at once, each in its own process and without a window, with a bot in place of
+# the player, to find what only shows after hours of play: slowdowns as objects pile up, memory growth,
+# hangs. The workers report their progress every few thousand ticks; games whose turn rate drops or that
+# stop reporting are flagged. The results are written as JSON. Example:
+#
+#   python soak.py --games 8 --ticks 50000
+#   python soak.py --games 64 --processes 8 --ticks 200000 --output soak.json
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import traceback
+import multiprocessing
+
+try:  #peak memory is only measured where the resource module exists (not on Windows)
+	import resource
+	resource_available = True
+except ImportError:
+	resource_available = False
+
+import powerlord
+import replay
+import bench
+
+libtcod = powerlord.libtcod
+
+REPORT_TICKS = 2000  #game ticks between progress reports
+STALL_SECONDS = 60.0  #a game that doesn't report for this long is taken to be hung
+DEGRADED_RATIO = 0.5  #a game is flagged when its turn rate falls below this part of its best early rate
+BASELINE_REPORTS = 3  #reports the best early rate is taken from
+STUCK_TURNS = 20  #turns without moving before the bot starts walking at random
+
+#keys for the eight directions
+MOVE_KEYS = {(-1, 0): 'h', (0, 1): 'j', (0, -1): 'k', (1, 0): 'l', (-1, -1): 'y', (1, -1): 'u', (-1, 1): 'b', (1, 1): 'n'}
+ATTACK_SPELLS = ['cast_lightning', 'cast_fireball', 'cast_freeze', 'cast_confuse']
+
+
+def char_key(char):
+	return libtcod.Key(libtcod.KEY_CHAR, ord(char), 1)
+
+
+def sign(n):
+	return (n > 0) - (n < 0)
+
+
+def peak_memory():
+	#most memory this process has used, in kilobytes (Linux reports ru_maxrss in kilobytes)
+	if not resource_available:
+		return None
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Bot:
+	#plays the game as its input_session (see replay.py). it heads for the boss of the level and kills it to
+	#go down, fights what it meets, picks up the items it passes and uses them, and quits once max_ticks
+	#have passed, max_depth is reached or it died. report(kind, values) sends progress to the runner.
+	def __init__(self, game, seed, max_ticks, max_depth, report):
+		self.game = game
+		self.rng = random.Random(seed)
+		self.max_ticks = max_ticks
+		self.max_depth = max_depth
+		self.report = report
+		self.keys = []  #answers for the menus the bot opened
+		self.aim = None  #map position to click when the game asks for a target
+		self.polled = None  #tick of the last key pressed
+		self.goal_room = None  #room of the place the route leads to
+		self.route = []
+		self.last_position = None
+		self.still = 0  #turns the player didn't move
+		self.wander = 0  #random steps left to get unstuck
+
+		self.started = time.time()
+		self.last_tick = self.started
+		self.last_report = (self.started, 0)
+		self.depth = None
+		self.level_started = (self.started, 0)
+		self.levels = []  #time spent on every level
+
+	def start(self, seed, state):
+		pass
+
+	def tick(self, tick):
+		game = self.game
+		self.last_tick = time.time()
+		if game.dungeon_level != self.depth:
+			self.end_level(tick)
+			self.depth = game.dungeon_level
+		if tick % REPORT_TICKS == 0:
+			now = time.time()
+			(last_time, last_tick) = self.last_report
+			self.last_report = (now, tick)
+			self.report('progress', self.status(tick, (tick - last_tick) / max(now - last_time, 1e-9)))
+
+	def end_level(self, tick):
+		now = time.time()
+		if self.depth is not None:
+			(start, start_tick) = self.level_started
+			self.levels.append({'depth': self.depth, 'ticks': tick - start_tick, 'seconds': now - start})
+		self.level_started = (now, tick)
+
+	def status(self, tick, rate):
+		objects = self.game.objects
+		return {
+			'tick': tick,
+			'seconds': time.time() - self.started,
+			'ticks_per_s': rate,
+			'depth': self.game.dungeon_level,
+			'objects': len(objects),
+			'monsters': sum(1 for obj in objects if obj.ai),
+			'corpses': sum(1 for obj in objects if obj.name.startswith('remains of ')),
+			'hp': self.game.player.fighter.hp,
+			'peak_memory_kb': peak_memory(),
+		}
+
+	def stop(self, tick):
+		self.end_level(tick)
+
+	def close(self):
+		pass
+
+	def check_for_keypress(self, tick, flags):
+		#the game reads the keys of a frame until there are none, the bot presses one a frame
+		if tick == self.polled:
+			return libtcod.Key()
+		self.polled = tick
+		return self.next_key(tick)
+
+	def next_key(self, tick):
+		game = self.game
+		if tick >= self.max_ticks or game.dungeon_level > self.max_depth or game.game_state != 'playing':
+			return libtcod.Key(libtcod.KEY_ESCAPE, 0, 1)
+		if game.targeting is not None or game.player.wait > 0:
+			return libtcod.Key()  #aiming, the mouse answers, or still moving, keys would wait
+		return self.decide()
+
+	def wait_for_keypress(self, tick, flush=True):
+		if self.keys:
+			return self.keys.pop(0)
+		if not flush:  #the player's turn in turn-based mode
+			return self.next_key(tick)
+		return char_key(self.rng.choice('abc'))  #the help screen, or a stat to raise when levelling up
+
+	def mouse_get_status(self, tick):
+		#while the game asks for a target, click where the bot aims, or right-click to cancel once it has
+		game = self.game
+		mouse = libtcod.Mouse()
+		if game.targeting is None:
+			return mouse
+		if self.aim is None:
+			mouse.rbutton_pressed = 1
+		else:
+			(mouse.cx, mouse.cy) = (self.aim[0] - game.camera_x, self.aim[1] - game.camera_y)
+			mouse.lbutton_pressed = 1
+			self.aim = None
+		return mouse
+
+	def decide(self):
+		#the key for the player's turn
+		game = self.game
+		player = game.player
+		position = (player.x, player.y)
+		if position == self.last_position:
+			self.still += 1
+		else:
+			self.still = 0
+		self.last_position = position
+
+		monsters = [obj for obj in game.objects
+					if obj.ai and obj.fighter and libtcod.map_is_in_fov(game.fov_map, obj.x, obj.y)]
+		nearest = None
+		if monsters:
+			nearest = min(monsters, key=player.distance_to)
+
+		if player.fighter.hp < player.fighter.max_hp / 2 and self.has_item('cast_heal'):
+			return self.use_item('cast_heal')
+		if nearest is not None and player.distance_to(nearest) < 2:
+			self.still = 0  #fighting, not stuck
+			return self.step(nearest.x - player.x, nearest.y - player.y)
+		if nearest is not None and player.distance_to(nearest) <= 6 and self.rng.random() < 0.3:
+			for spell in ATTACK_SPELLS:
+				if self.has_item(spell):
+					return self.use_item(spell, (nearest.x, nearest.y))
+		for obj in game.inventory:
+			if obj.equipment and not obj.equipment.is_equipped:
+				return self.use_item(obj.item)
+		if nearest is None and self.has_item('throw_stone') and self.rng.random() < 0.02:
+			return self.use_item('throw_stone', position)
+		for obj in game.objects:
+			if obj.item and (obj.x, obj.y) == position and len(game.inventory) < 26:
+				return char_key('g')
+
+		if self.still >= STUCK_TURNS:
+			self.wander = STUCK_TURNS
+			self.still = 0
+		if self.wander > 0:
+			self.wander -= 1
+			(dx, dy) = self.rng.choice(MOVE_KEYS.keys())
+			return self.step(dx, dy)
+		goal = self.choose_goal(nearest)
+		if goal is None:
+			return char_key('.')
+		(x, y) = self.next_waypoint(goal)
+		return self.step(x - player.x, y - player.y)
+
+	def choose_goal(self, nearest):
+		#the nearest item in sight, then the nearest monster, then the boss, if they can be reached
+		game = self.game
+		player = game.player
+		position = (player.x, player.y)
+		items = [obj for obj in game.objects if obj.item and libtcod.map_is_in_fov(game.fov_map, obj.x, obj.y) and
+				 player.distance_to(obj) <= 8 and game.same_region(position, (obj.x, obj.y))]
+		if items and len(game.inventory) < 26:
+			target = min(items, key=player.distance_to)
+			return (target.x, target.y)
+		if nearest is not None and game.same_region(position, (nearest.x, nearest.y)):
+			return (nearest.x, nearest.y)
+		for obj in game.objects:
+			if obj.fighter and obj.fighter.death_function == game.victory_death:
+				return (obj.x, obj.y)
+		return None
+
+	def next_waypoint(self, goal):
+		#routes lead through the room centers, so one found again from a tile further on may turn back. the
+		#route is kept while the goal stays in the same room, and dropped for a straight line in that room.
+		game = self.game
+		player = game.player
+		nav = game.current_level.nav
+		room = nav.room_at(goal[0], goal[1])
+		if room == nav.room_at(player.x, player.y):
+			self.route = []
+			return goal
+		if room != self.goal_room or not self.route:
+			self.goal_room = room
+			self.route = game.find_route(player.x, player.y, goal[0], goal[1])
+		while self.route and self.route[0] == (player.x, player.y):
+			del self.route[0]
+		if self.route:
+			return self.route[0]
+		return goal
+
+	def step(self, dx, dy):
+		(dx, dy) = (sign(dx), sign(dy))
+		if (dx, dy) == (0, 0):
+			return char_key('.')
+		return char_key(MOVE_KEYS[(dx, dy)])
+
+	def has_item(self, use_function):
+		return any(obj.item and obj.item.use_function and obj.item.use_function.__name__ == use_function
+				   for obj in self.game.inventory)
+
+	def use_item(self, item, aim=None):
+		#open the inventory and pick the item, given as an Item or by the name of its use function
+		inventory = self.game.inventory
+		for (index, obj) in enumerate(inventory):
+			if obj.item is item or (obj.item.use_function and obj.item.use_function.__name__ == item):
+				self.keys.append(char_key(chr(ord('a') + index)))
+				self.aim = aim
+				return char_key('i')
+		return char_key('.')
+
+
+def play(seed, max_ticks, max_depth, conn):
+	#worker process: play one game and send its progress and result to the runner. the game and the watchdog
+	#both send, one message at a time
+	lock = threading.Lock()
+
+	def report(kind, values):
+		with lock:
+			conn.send((kind, values))
+
+	bench.init_headless()
+	directory = tempfile.mkdtemp(prefix='powerlord-soak')
+	os.chdir(directory)  #the game saves when it ends
+	try:
+		bot = Bot(powerlord, seed, max_ticks, max_depth, report)
+		watchdog = threading.Thread(target=watch, args=(bot, report))
+		watchdog.daemon = True
+		watchdog.start()
+		replay.draw_sampled(powerlord, 0)
+		powerlord.input_session = bot
+		powerlord.new_game(seed)
+		powerlord.play_game()
+		bench.finish_pregeneration()
+		tick = powerlord.game_tick
+		result = bot.status(tick, tick / max(time.time() - bot.started, 1e-9))
+		result['levels'] = bot.levels
+		result['state'] = powerlord.game_state
+		report('done', result)
+	except Exception:
+		report('error', traceback.format_exc())
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+
+def watch(bot, report):
+	#worker thread: when the game stops ticking for half of STALL_SECONDS, send the stacks of all the threads,
+	#which shows where it is stuck before the runner gives up on it. this works from a thread where a signal
+	#handler wouldn't, as it can't run while the main thread waits on a lock.
+	while True:
+		time.sleep(1.0)
+		if time.time() - bot.last_tick > STALL_SECONDS / 2:
+			stacks = []
+			for (thread, frame) in sys._current_frames().items():
+				if thread != threading.current_thread().ident:
+					stacks.append('thread %d:\n%s' % (thread, ''.join(traceback.format_stack(frame))))
+			report('stack', '\n'.join(stacks))
+			return
+
+
+class Game:
+	#what the runner knows about one worker
+	def __init__(self, seed, max_ticks, max_depth):
+		self.seed = seed
+		#a pipe of its own rather than a queue shared by all the workers, whose lock a worker killed
+		#at the wrong moment would leave taken for the others
+		(self.conn, child) = multiprocessing.Pipe(duplex=False)
+		self.process = multiprocessing.Process(target=play, args=(seed, max_ticks, max_depth, child))
+		self.process.daemon = True
+		self.reports = []
+		self.flags = []
+		self.result = None
+		self.status = 'running'
+		self.last_heard = None
+
+	def start(self):
+		self.process.start()
+		self.last_heard = time.time()
+
+	def baseline(self):
+		#the best turn rate of the first reports, the first one or two include generating the level
+		rates = [report['ticks_per_s'] for report in self.reports[:BASELINE_REPORTS]]
+		return max(rates) if rates else None
+
+	def progress(self, report):
+		self.reports.append(report)
+		baseline = self.baseline()
+		if len(self.reports) > BASELINE_REPORTS and report['ticks_per_s'] < DEGRADED_RATIO * baseline:
+			self.flag('degraded', 'tick %d: %.0f ticks/s, down from %.0f, %d objects' % (
+				report['tick'], report['ticks_per_s'], baseline, report['objects']))
+
+	def flag(self, kind, text):
+		self.flags.append({'kind': kind, 'text': text})
+		sys.stderr.write('game %d %s: %s\n' % (self.seed, kind, text))
+
+	def summary(self):
+		summary = {'seed': self.seed, 'status': self.status, 'flags': self.flags, 'reports': self.reports}
+		if self.result is not None:
+			summary.update(self.result)
+		return summary
+
+
+	def receive(self):
+		#the messages the worker has sent since the last call
+		messages = []
+		try:
+			while self.conn.poll():
+				messages.append(self.conn.recv())
+		except (EOFError, IOError):  #the worker is gone
+			pass
+		return messages
+
+
+def soak(seeds, max_ticks, max_depth, processes):
+	#play a game for every seed, processes at a time. returns the summaries of the games
+	waiting = [Game(seed, max_ticks, max_depth) for seed in seeds]
+	waiting.reverse()
+	running = {}
+	finished = []
+	while waiting or running:
+		while waiting and len(running) < processes:
+			game = waiting.pop()
+			game.start()
+			running[game.seed] = game
+
+		time.sleep(0.5)
+		now = time.time()
+		for game in running.values():
+			#a worker's last messages are read before it is seen to have exited
+			alive = game.process.is_alive()
+			for (kind, values) in game.receive():
+				game.last_heard = now
+				if kind == 'progress':
+					game.progress(values)
+				elif kind == 'stack':
+					game.flag('stack', values)
+				elif kind == 'done':
+					(game.result, game.status) = (values, 'finished')
+				elif kind == 'error':
+					game.status = 'crashed'
+					game.flag('error', values)
+
+			if game.status == 'running' and not alive:
+				game.status = 'crashed'
+				game.flag('error', 'worker exited with code %s' % game.process.exitcode)
+			elif game.status == 'running' and now - game.last_heard > STALL_SECONDS:
+				game.status = 'hung'
+				game.flag('hung', 'no progress for %d seconds after tick %d' % (
+					now - game.last_heard, game.reports[-1]['tick'] if game.reports else 0))
+			elif game.status == 'running':
+				continue
+
+			if game.status == 'hung':
+				game.process.terminate()
+			game.process.join()
+			game.conn.close()
+			del running[game.seed]
+			finished.append(game)
+			sys.stderr.write('game %d %s after %d reports, %d running, %d waiting\n' % (
+				game.seed, game.status, len(game.reports), len(running), len(waiting)))
+	return [game.summary() for game in sorted(finished, key=lambda game: game.seed)]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Play many POWERLORD games with a bot to find slowdowns and hangs.')
+	parser.add_argument('--games', type=int, default=8, help='number of games (default 8)')
+	parser.add_argument('--seed', type=int, default=1, help='seed of the first game, the others follow (default 1)')
+	parser.add_argument('--ticks', type=int, default=50000, help='game ticks to play each game for (default 50000)')
+	parser.add_argument('--depth', type=int, default=10, help='stop a game below this dungeon level (default 10)')
+	parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+						help='games played at once (default: one per core)')
+	parser.add_argument('--output', default=None, help='file to write the results to (default: stdout)')
+	args = parser.parse_args(argv)
+
+	start = time.time()
+	games = soak(range(args.seed, args.seed + args.games), args.ticks, args.depth, args.processes)
+	flagged = [game for game in games if game['flags']]
+	sys.stderr.write('%d games in %.0fs, %d flagged\n' % (len(games), time.time() - start, len(flagged)))
+
+	out = sys.stdout
+	if args.output:
+		out = open(args.output, 'w')
+	json.dump({'ticks': args.ticks, 'depth': args.depth, 'games': games}, out, indent=1, sort_keys=True)
+	out.write('\n')
+	if out is not sys.stdout:
+		out.close()
+	return 1 if flagged else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
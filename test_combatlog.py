@@ -0,0 +1,83 @@
+#!/usr/bin/python
+#
+# tests for the combat log. run with: python -m unittest test_combatlog
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import combatlog
+
+
+def event(tick):
+	return combatlog.Event(tick, 'attack', 'orc', 'player', 3, False, None, None, 10, 12, 1)
+
+
+def windows_rename(src, dst):
+	#os.rename() as it behaves on Windows, where an existing target is an error
+	if os.path.exists(dst):
+		raise OSError(17, 'File exists', dst)
+	real_rename(src, dst)
+
+real_rename = os.rename
+
+
+def locked_remove(path):
+	#another program holds the file open
+	raise OSError(13, 'Permission denied', path)
+
+real_remove = os.remove
+
+
+class RotateTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'combat.log')
+		os.rename = windows_rename
+		self.log = combatlog.CombatLog(self.path, max_bytes=1, backups=3)
+		#stop the writer thread so the test decides when to flush
+		self.log.closed = True
+		self.log.wake.set()
+		self.log.thread.join()
+
+	def tearDown(self):
+		os.rename = real_rename
+		self.log.close()
+		shutil.rmtree(self.dir)
+
+	def test_rotate_more_than_backups(self):
+		#every flush passes max_bytes, so each event ends up in its own backup
+		for tick in range(7):
+			self.log.write(event(tick))
+			self.log.flush()
+		self.assertEqual(self.log.pending, combatlog.collections.deque())
+		self.assertEqual(combatlog.log_files(self.path),
+			[self.path + '.3', self.path + '.2', self.path + '.1', self.path])
+		self.assertEqual([e.tick for e in combatlog.read_events(self.path)], [4, 5, 6])
+
+	def test_no_backups(self):
+		self.log.backups = 0
+		for tick in range(3):
+			self.log.write(event(tick))
+			self.log.flush()
+		self.assertEqual(combatlog.log_files(self.path), [self.path])
+		self.assertEqual(list(combatlog.read_events(self.path)), [])
+
+	def test_failed_rotation_keeps_logging(self):
+		#a backup that can't be removed only delays the rotation, later events still get written
+		open(self.path + '.3', 'wb').close()
+		os.remove = locked_remove
+		try:
+			self.log.write(event(0))
+			self.log.flush()
+			self.log.write(event(1))
+			self.log.flush()
+		finally:
+			os.remove = real_remove
+		self.assertFalse(self.log.file.closed)
+		self.assertEqual([e.tick for e in combatlog.read_events(self.path)], [0, 1])
+
+
+if __name__ == '__main__':
+	unittest.main()